@@ -10,6 +10,9 @@ import gc
 import multiprocessing as mp
 import concurrent.futures as concur_f
 import tariff_functions as tFuncs
+import hourly_profiles
+import bisect
+import config
 import sqlalchemy
 
 # GLOBAL SETTINGS
@@ -530,6 +533,117 @@ def get_and_apply_agent_load_profiles(con, agent):
     
     return df
 
+#%%
+@decorators.fn_timer(logger=logger, tab_level=2, prefix='')
+def get_agent_load_profiles_bulk(con, dataframe, chunk_size=None):
+    """
+    Load the normalized load profile of every distinct (bldg_id, sector_abbr, state_abbr)
+    in the agent set with a few set-based queries, instead of one query per agent.
+
+    Parameters
+    ----------
+    con : 'SQL connection'
+        Connection to the database
+    dataframe : 'pd.df'
+        Agent dataframe with bldg_id, sector_abbr and state_abbr columns
+    chunk_size : 'int'
+        Maximum number of profiles fetched per query. Defaults to config.LOAD_PROFILE_QUERY_CHUNK_SIZE
+
+    Returns
+    -------
+    'hourly_profiles.HourlyProfiles'
+        Load profiles keyed by (bldg_id, sector_abbr, state_abbr), each normalized to sum to 1.
+        Scale by load_kwh_per_customer_in_bin to get an agent's consumption_hourly.
+    """
+    if chunk_size is None:
+        chunk_size = config.LOAD_PROFILE_QUERY_CHUNK_SIZE
+
+    keys_df = dataframe[['bldg_id', 'sector_abbr', 'state_abbr']].drop_duplicates()
+
+    keys = []
+    profiles = []
+    for sector_abbr, sector_keys_df in keys_df.groupby('sector_abbr'):
+        sector_keys = list(sector_keys_df[['bldg_id', 'state_abbr']].itertuples(index=False, name=None))
+        for start in range(0, len(sector_keys), chunk_size):
+            inputs = {'sector_abbr': sector_abbr}
+            inputs['key_list'] = ', '.join("({}, '{}')".format(bldg_id, state_abbr) for bldg_id, state_abbr in sector_keys[start:start + chunk_size])
+
+            sql = """SELECT bldg_id, sector_abbr, state_abbr,
+                            kwh_load_profile as consumption_hourly
+                     FROM diffusion_load_profiles.{sector_abbr}stock_load_profiles
+                         WHERE sector_abbr = '{sector_abbr}'
+                         AND (bldg_id, state_abbr) IN ({key_list});""".format(**inputs)
+
+            df = pd.read_sql(sql, con, coerce_float=False)
+
+            for row in df.itertuples(index=False):
+                keys.append((row.bldg_id, row.sector_abbr, row.state_abbr))
+                profiles.append(np.array(row.consumption_hourly, dtype='float64'))
+
+    n_missing = keys_df.shape[0] - len(keys)
+    if n_missing > 0:
+        logger.warning('\t\t{} agent load profiles were not found in bulk load and will be queried per agent'.format(n_missing))
+
+    # normalize once so that each agent only needs to scale by its annual load
+    profiles = (profile / profile.sum() for profile in profiles)
+
+    return hourly_profiles.HourlyProfiles.from_profiles(keys, profiles, dtype=config.HOURLY_PROFILE_DTYPE)
+
+
+#%%
+@decorators.fn_timer(logger=logger, tab_level=2, prefix='')
+def get_normalized_hourly_resource_solar_bulk(con, dataframe, max_profiles=None, chunk_size=None):
+    """
+    Load the hourly solar capacity factor profile of the distinct (solar_re_9809_gid, tilt, azimuth)
+    keys in the agent set with a few set-based queries. Keys shared by the most agents are loaded
+    first, up to max_profiles. Profiles are decoded from the 1e6 scale offset once.
+
+    Parameters
+    ----------
+    con : 'SQL connection'
+        Connection to the database
+    dataframe : 'pd.df'
+        Agent dataframe with solar_re_9809_gid, tilt and azimuth columns
+    max_profiles : 'int'
+        Maximum number of profiles to load. Defaults to config.SOLAR_CF_PREFETCH_MAX_PROFILES
+    chunk_size : 'int'
+        Maximum number of profiles fetched per query. Defaults to config.LOAD_PROFILE_QUERY_CHUNK_SIZE
+
+    Returns
+    -------
+    'hourly_profiles.HourlyProfiles'
+        Capacity factor profiles keyed by (solar_re_9809_gid, tilt, azimuth)
+    """
+    if max_profiles is None:
+        max_profiles = config.SOLAR_CF_PREFETCH_MAX_PROFILES
+    if chunk_size is None:
+        chunk_size = config.LOAD_PROFILE_QUERY_CHUNK_SIZE
+
+    key_counts = dataframe.groupby(['solar_re_9809_gid', 'tilt', 'azimuth']).size().sort_values(ascending=False)
+    resource_keys = list(key_counts.index[:max_profiles])
+
+    keys = []
+    profiles = []
+    for start in range(0, len(resource_keys), chunk_size):
+        inputs = {}
+        inputs['key_list'] = ', '.join("('{}', '{}', '{}')".format(*key) for key in resource_keys[start:start + chunk_size])
+
+        sql = """SELECT solar_re_9809_gid, tilt, azimuth,
+                        cf as generation_hourly
+                FROM diffusion_resource_solar.solar_resource_hourly
+                    WHERE (solar_re_9809_gid, tilt, azimuth) IN ({key_list});""".format(**inputs)
+
+        df = pd.read_sql(sql, con, coerce_float=False)
+
+        for row in df.itertuples(index=False):
+            keys.append((row.solar_re_9809_gid, row.tilt, row.azimuth))
+            profiles.append(np.array(row.generation_hourly, dtype='float64') / 1e6)
+
+    logger.info('\t\tLoaded {} of {} solar resource profiles'.format(len(keys), key_counts.shape[0]))
+
+    return hourly_profiles.HourlyProfiles.from_profiles(keys, profiles, dtype=config.HOURLY_PROFILE_DTYPE)
+
+
 #%%
 def get_and_apply_normalized_hourly_resource_solar(con, agent):
 
@@ -680,11 +794,12 @@ def apply_state_incentives(dataframe, state_incentives, year, start_year, state_
     state_incentives_mg = state_incentives_mg.loc[pd.isnull(state_incentives_mg['incentive_cap_total_mw']) | (state_incentives_mg['cum_system_mw'] < state_incentives_mg['incentive_cap_total_mw'])]
     state_incentives_mg = state_incentives_mg.loc[pd.isnull(state_incentives_mg['budget_total_usd']) | (state_incentives_mg['cum_incentive_spending_usd'] < state_incentives_mg['budget_total_usd'])]
 
+    # compile the incentives of each state and sector once, agents only assign the result
     output  =[]
     for i in state_incentives_mg.groupby(['state_abbr', 'sector_abbr']):
         row = i[1]
         state, sector = i[0]
-        output.append({'state_abbr':state, 'sector_abbr':sector,"state_incentives":row})
+        output.append({'state_abbr':state, 'sector_abbr':sector,"state_incentives":compile_state_incentives(row)})
 
     state_inc_df = pd.DataFrame(columns=['state_abbr', 'sector_abbr', 'state_incentives'])
     state_inc_df = pd.concat([state_inc_df, pd.DataFrame.from_records(output)], sort=False)
@@ -695,6 +810,60 @@ def apply_state_incentives(dataframe, state_incentives, year, start_year, state_
 
     return dataframe
 
+#%%
+def compile_state_incentives(incentive_df):
+    """
+    Convert the incentives applicable to a state and sector into Cashloan PaymentIncentives inputs.
+    At most two each of the capacity-, production- and investment-based incentives are used,
+    the largest as PySAM's "state" option and the second largest as its "other" option.
+
+    Parameters
+    ----------
+    incentive_df : 'pd.df'
+        Incentives applicable to one state and sector
+
+    Returns
+    -------
+    incentives : 'dict'
+        Cashloan PaymentIncentives inputs as plain floats
+    """
+    incentives = dict()
+
+    # Fill NaNs in incentive_df - assume max incentive duration of 5 years and max incentive value of $10,000
+    incentive_df = incentive_df.fillna(value={'incentive_duration_yrs' : 5, 'max_incentive_usd' : 10000})
+
+    # Capacity-based incentives (CBI), tax flags are only set when two CBIs apply
+    cbi_df = incentive_df.loc[pd.notnull(incentive_df['cbi_usd_p_w'])].sort_values(['cbi_usd_p_w'], axis=0, ascending=False)
+    cbi_tax = 1 if len(cbi_df) >= 2 else 0
+    for option, (_, cbi) in zip(['sta', 'oth'], cbi_df.head(2).iterrows()):
+        incentives['cbi_{}_amount'.format(option)] = float(cbi['cbi_usd_p_w'])
+        incentives['cbi_{}_deprbas_fed'.format(option)] = 0
+        incentives['cbi_{}_deprbas_sta'.format(option)] = 0
+        incentives['cbi_{}_maxvalue'.format(option)] = float(cbi['max_incentive_usd'])
+        incentives['cbi_{}_tax_fed'.format(option)] = cbi_tax
+        incentives['cbi_{}_tax_sta'.format(option)] = cbi_tax
+
+    # Production-based incentives (PBI), amount input [$/kWh] requires sequence -- repeat pbi_usd_p_kwh using incentive_duration_yrs
+    pbi_df = incentive_df.loc[pd.notnull(incentive_df['pbi_usd_p_kwh'])].sort_values(['pbi_usd_p_kwh'], axis=0, ascending=False)
+    for option, (_, pbi) in zip(['sta', 'oth'], pbi_df.head(2).iterrows()):
+        incentives['pbi_{}_amount'.format(option)] = [float(pbi['pbi_usd_p_kwh'])] * int(pbi['incentive_duration_yrs'])
+        incentives['pbi_{}_escal'.format(option)] = 0.
+        incentives['pbi_{}_tax_fed'.format(option)] = 1
+        incentives['pbi_{}_tax_sta'.format(option)] = 1
+        incentives['pbi_{}_term'.format(option)] = float(pbi['incentive_duration_yrs'])
+
+    # Investment-based incentives (IBI), specified as a percentage instead of an absolute amount
+    ibi_df = incentive_df.loc[pd.notnull(incentive_df['ibi_pct'])].sort_values(['ibi_pct'], axis=0, ascending=False)
+    for option, (_, ibi) in zip(['sta', 'oth'], ibi_df.head(2).iterrows()):
+        incentives['ibi_{}_percent'.format(option)] = float(ibi['ibi_pct'])
+        incentives['ibi_{}_percent_deprbas_fed'.format(option)] = 0
+        incentives['ibi_{}_percent_deprbas_sta'.format(option)] = 0
+        incentives['ibi_{}_percent_maxvalue'.format(option)] = float(ibi['max_incentive_usd'])
+        incentives['ibi_{}_percent_tax_fed'.format(option)] = 1
+        incentives['ibi_{}_percent_tax_sta'.format(option)] = 1
+
+    return incentives
+
 #%%
 @decorators.fn_timer(logger=logger, tab_level=2, prefix='')
 def estimate_initial_market_shares(dataframe, state_starting_capacities_df):
@@ -840,8 +1009,75 @@ def get_rate_switch_table(con):
     
     return rate_switch_table
 
+def index_rate_switch_table(rate_switch_table):
+    """
+    Index the rate switch table for apply_rate_switch. 
+
+    Parameters
+    ----------
+    rate_switch_table : 'pd.df'
+        Rate switch table, see get_rate_switch_table
+
+    Returns
+    -------
+    rate_switch_index : 'dict'
+        Keyed by (tech, eia_id, res_com). Each value holds the [min_kw_limit, max_kw_limit) 
+        intervals of the key sorted by min_kw_limit, the (tariff_id, tariff_dict, one_time_charge) 
+        of each interval, and whether any of the intervals overlap.
+    """
+    rate_switch_index = dict()
+    rate_switch_table = rate_switch_table.sort_values('min_kw_limit', kind='mergesort')
+    for key, group in rate_switch_table.groupby(['tech', 'eia_id', 'res_com'], sort=False):
+        min_kw = group['min_kw_limit'].tolist()
+        max_kw = group['max_kw_limit'].tolist()
+        rate_switch_index[key] = {'min_kw': min_kw,
+                                  'max_kw': max_kw,
+                                  'rates': list(zip(group['rate_id_alias'], group['json'], group['one_time_charge'])),
+                                  'overlapping': any(max_kw[i] > min_kw[i+1] for i in range(len(min_kw) - 1))}
+
+    return rate_switch_index
+
+
+def lookup_rate_switch(rate_switch_index, eia_id, res_com, system_size_kw, tech='solar'):
+    """
+    Find the DG rate whose [min_kw_limit, max_kw_limit) interval contains system_size_kw.
+
+    Returns
+    -------
+    'tuple'
+        (tariff_id, tariff_dict, one_time_charge), or None unless exactly one rate applies
+    """
+    entry = rate_switch_index.get((tech, eia_id, res_com))
+    if entry is None:
+        return None
+
+    # intervals starting at or below the system size
+    n = bisect.bisect_right(entry['min_kw'], system_size_kw)
+    if not entry['overlapping']:
+        if n > 0 and entry['max_kw'][n-1] > system_size_kw:
+            return entry['rates'][n-1]
+        return None
+
+    matches = [i for i in range(n) if entry['max_kw'][i] > system_size_kw]
+    if len(matches) == 1:
+        return entry['rates'][matches[0]]
+
+    return None
+
+
 def apply_rate_switch(rate_switch_table, agent, system_size_kw, tech='solar'):
     
+    # use the prebuilt index if given, see index_rate_switch_table
+    if isinstance(rate_switch_table, dict):
+        rate = lookup_rate_switch(rate_switch_table, agent.loc['eia_id'], str(agent.loc['sector_abbr']).upper()[0], system_size_kw, tech)
+        if (system_size_kw > 0) & (rate is not None):
+            agent['nem_system_kw_limit'] = 1e6
+            agent['tariff_id'], agent['tariff_dict'], one_time_charge = rate
+        else:
+            one_time_charge = 0.
+
+        return agent, one_time_charge
+
     rate_switch_table = rate_switch_table.loc[rate_switch_table['tech'] == tech]
     rate_switch_table.rename(columns={'rate_id_alias':'tariff_id', 'json':'tariff_dict'}, inplace=True)
     rate_switch_table = rate_switch_table[(rate_switch_table['eia_id'] == agent.loc['eia_id']) &
@@ -1,13 +1,207 @@
 import concurrent.futures as cf
 from functools import partial
 import os
+import threading
+import numpy as np
 import pandas as pd
 import utility_functions as utilfunc
+import settings
 import config
 
 # load logger
 logger = utilfunc.get_logger()
 
+# per-process state populated once by init_worker and read by every task run in that process
+WORKER_CONTEXT = {}
+
+# database connection of each worker thread, see get_worker_connection
+_worker_connection = threading.local()
+
+
+def init_worker(shared_tables=None, connect=True):
+    """
+    Initializer for AgentPool workers. Loads the lookup tables shared by every task
+    and, optionally, the model settings and a database connection, once per worker process.
+
+    Parameters
+    ----------
+    shared_tables : 'dict'
+        Lookup tables keyed by name. Tasks reference them with a SharedTable handle.
+    connect : 'bool'
+        If True, initialize model settings and open a database connection for the worker
+    """
+    WORKER_CONTEXT.update(shared_tables or {})
+
+    if connect:
+        get_worker_connection()
+
+
+def get_worker_settings():
+    """
+    Return the model settings of this worker, initialized on first use
+    """
+    if 'model_settings' not in WORKER_CONTEXT:
+        WORKER_CONTEXT['model_settings'] = settings.init_model_settings()
+
+    return WORKER_CONTEXT['model_settings']
+
+
+def get_worker_connection():
+    """
+    Return the database connection and cursor of this worker, opened on first use (or if closed)
+    and reused by every task the worker runs. Threaded workers each get their own connection.
+
+    Returns
+    -------
+    con : 'psycopg2.connection'
+    cur : 'psycopg2.cursor'
+    """
+    if getattr(_worker_connection, 'con', None) is None or _worker_connection.con.closed:
+        close_worker_connection()
+        model_settings = get_worker_settings()
+        _worker_connection.con, _worker_connection.cur = utilfunc.make_con(model_settings.pg_conn_string, model_settings.role)
+
+    return _worker_connection.con, _worker_connection.cur
+
+
+def close_worker_connection():
+    """
+    Return the database connection of this worker to the connection pool, if open
+    """
+    if getattr(_worker_connection, 'con', None) is not None:
+        utilfunc.release_con(_worker_connection.con)
+    _worker_connection.con = _worker_connection.cur = None
+
+
+class SharedTable(object):
+    """
+    Handle to a lookup table loaded into each worker by init_worker.
+    Passed as a kwarg in place of the table so that the table is not pickled with every task.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'SharedTable({})'.format(self.name)
+
+    def resolve(self):
+        try:
+            return WORKER_CONTEXT[self.name]
+        except KeyError:
+            raise KeyError('Shared table {} was not loaded by the worker initializer'.format(self.name))
+
+
+def resolve_shared_tables(kwargs):
+    """
+    Replace any SharedTable handles in kwargs with the tables they reference.
+    """
+    return {k: v.resolve() if isinstance(v, SharedTable) else v for k, v in kwargs.items()}
+
+
+def apply_func_to_row(func, row, **kwargs):
+    """
+    Apply a row-wise function to a single agent inside a worker.
+    """
+    return func(row, **resolve_shared_tables(kwargs))
+
+
+def apply_func_to_chunk(func, agent_chunk, chunk_func=None, **kwargs):
+    """
+    Apply a row-wise function to every agent in a chunk of the agent dataframe.
+    Runs inside a worker so that the chunk is pickled once and the results are
+    returned to the parent as a single dataframe rather than one pd.Series per agent.
+
+    Parameters
+    ----------
+    func : 'function'
+        Function to be applied to each agent. Must take a pd.Series as the argument
+    agent_chunk : 'pd.df'
+        Chunk of the agent dataframe
+    chunk_func : 'function'
+        If given, applied to the whole chunk in place of func, e.g. to batch work across
+        the chunk's agents. Must return the results of func for each agent, indexed as the chunk
+    **kwargs
+        Any kwargs for func
+
+    Returns
+    -------
+    results_df : 'pd.df'
+        Dataframe with one row of func outputs per agent in the chunk
+    """
+    kwargs = resolve_shared_tables(kwargs)
+    if chunk_func is not None:
+        return chunk_func(agent_chunk, **kwargs)
+
+    results = [func(row, **kwargs) for _, row in agent_chunk.iterrows()]
+
+    return pd.DataFrame(results)
+
+
+class AgentPool(object):
+    """
+    Long-lived pool of workers used to apply functions to agents.
+    Created once per scenario and reused across model years. Each worker runs
+    init_worker once, so lookup tables, settings, and the database connection
+    are loaded per worker rather than per task.
+    """
+    def __init__(self, cores=None, shared_tables=None, connect=True):
+        """
+        Initialize AgentPool Class
+        Parameters
+        ----------
+        cores : 'int'
+            Number of workers. If None, tasks run serially in this process
+            and the shared tables are loaded into this process instead.
+        shared_tables : 'dict'
+            Lookup tables keyed by name to be loaded once into each worker
+        connect : 'bool'
+            If True, each worker initializes model settings and a database connection
+        """
+        self.cores = cores
+        self.shared_tables = shared_tables or {}
+
+        if cores is None:
+            init_worker(self.shared_tables, connect)
+            self.executor = None
+        else:
+            if 'ix' not in os.name:
+                EXECUTOR = cf.ThreadPoolExecutor
+            else:
+                EXECUTOR = cf.ProcessPoolExecutor
+
+            self.executor = EXECUTOR(max_workers=cores, initializer=init_worker, initargs=(self.shared_tables, connect))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def __repr__(self):
+        return ('{a} with {n} workers and shared tables {t}'
+                .format(a=self.__class__.__name__,
+                        n=self.cores,
+                        t=list(self.shared_tables.keys())))
+
+    def handle(self, name):
+        """
+        Return a handle to a shared table to pass as a kwarg in place of the table itself
+        """
+        if name not in self.shared_tables:
+            raise KeyError('{} is not a shared table of this pool'.format(name))
+
+        return SharedTable(name)
+
+    def shutdown(self):
+        """
+        Shut down the workers, or close the serial worker context
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        else:
+            close_worker_connection()
+
 
 class Agents(object):
     """
@@ -299,7 +493,7 @@ class Agents(object):
 
         return results_df
 
-    def apply_chunk_on_row(self, func, cores=None, **kwargs):
+    def apply_chunk_on_row(self, func, cores=None, executor_mode=None, pool=None, dedupe_cols=None, chunk_func=None, **kwargs):
         """
         Divide the dataframe into chunks according to the number of processors and 
         then apply function to agents on an agent by agent basis within that 
@@ -310,12 +504,25 @@ class Agents(object):
             Function to be applied to each agent
             Must take a pd.Series as the argument
         cores : 'int'
-            Number of cores to use for computation
+            Number of cores to use for computation. Ignored if pool is given
+        executor_mode : 'str'
+            'chunk' submits one task per chunk; each worker applies func to every 
+            agent in its chunk and returns a single result block. 'row' submits 
+            one task per agent. Defaults to config.CHUNK_EXECUTOR_MODE
+        pool : 'AgentPool'
+            Persistent pool of workers to use. If None, a pool is created for this call
+        dedupe_cols : 'list'
+            If given, func is applied to one agent of each set of agents with equal values 
+            in these columns, and its result is copied to the other agents of the set.
+            The columns must include every input of func that differs between agents
+        chunk_func : 'function'
+            If given, applied to each chunk of agents in place of func, except in 'row' 
+            executor_mode. See apply_func_to_chunk
         in_place : 'bool'
             If true, set self.df = results of compute
             else return results of compute
         **kwargs
-            Any kwargs for func
+            Any kwargs for func. SharedTable handles are resolved within each worker
 
         Returns
         -------
@@ -324,28 +531,59 @@ class Agents(object):
         """
         print('\t\t\t============ APPLY CHUNK ON ROW ============')
 
-        # --- apply function ---
-        if cores is None:
-            apply_func = partial(func, **kwargs)
-            results_df = self.df.apply(apply_func, axis=1)
-        else:
-            if 'ix' not in os.name:
-                EXECUTOR = cf.ThreadPoolExecutor
+        if executor_mode is None:
+            executor_mode = config.CHUNK_EXECUTOR_MODE
+
+        # --- select one representative of each set of equivalent agents ---
+        df = self.df
+        if dedupe_cols is not None:
+            fingerprints = utilfunc.fingerprint_rows(self.df, dedupe_cols)
+            df = self.df.loc[~fingerprints.duplicated().values]
+            logger.info('Applying function to {r} representatives of {n} agents'.format(r=len(df), n=len(self.df)))
+
+        temp_pool = None
+        if pool is None and cores is not None:
+            temp_pool = pool = AgentPool(cores=cores, connect=False)
+
+        try:
+            # --- apply function ---
+            if pool is None or pool.executor is None:
+                if chunk_func is not None:
+                    results_df = chunk_func(df, **resolve_shared_tables(kwargs))
+                else:
+                    apply_func = partial(func, **resolve_shared_tables(kwargs))
+                    results_df = df.apply(apply_func, axis=1)
             else:
-                EXECUTOR = cf.ProcessPoolExecutor
+                logger.info('Number of Workers inside chunk_on_row is {}'.format(pool.cores)) 
+                futures = []
+                n_chunks = min(df.shape[0], pool.cores * config.CHUNKS_PER_CORE)
+                chunks = [df.iloc[idx] for idx in np.array_split(np.arange(df.shape[0]), n_chunks)]
+
+                if executor_mode == 'chunk':
+                    for agent_chunk in chunks:
+                        futures.append(pool.executor.submit(apply_func_to_chunk, func, agent_chunk, chunk_func=chunk_func, **kwargs))
+
+                    results = [future.result() for future in futures]
+                    results_df = pd.concat(results, axis=0, sort=False)
+                elif executor_mode == 'row':
+                    for agent_chunk in chunks:
+                        for _, row in agent_chunk.iterrows():
+                            futures.append(pool.executor.submit(apply_func_to_row, func, row, **kwargs))
 
-            logger.info('Number of Workers inside chunk_on_row is {}'.format(cores)) 
-            futures = []
-            chunk_size = int(self.df.shape[0]/cores)
-            chunks = [self.df.loc[self.df.index[i:i + chunk_size]] for i in range(0, self.df.shape[0], chunk_size)]
-            
-            with EXECUTOR(max_workers=cores) as executor:
-                for agent_chunks in chunks:
-                    for _, row in agent_chunks.iterrows():
-                        futures.append(executor.submit(func, row, **kwargs))
-    
                     results = [future.result() for future in futures]
-                results_df = pd.concat(results, axis=1, sort=False).T              
+                    results_df = pd.concat(results, axis=1, sort=False).T
+                else:
+                    raise ValueError("Invalid executor_mode: {}. Valid options are 'chunk' and 'row'".format(executor_mode))
+        finally:
+            if temp_pool is not None:
+                temp_pool.shutdown()
+
+        # --- copy each representative's result to its equivalent agents ---
+        if dedupe_cols is not None:
+            results_df = results_df.set_index(fingerprints.loc[results_df.index].values)
+            results_df = results_df.loc[fingerprints.values]
+            results_df.index = self.df.index
+            results_df['agent_id'] = self.df['agent_id'].values
 
         return results_df
 
@@ -0,0 +1,384 @@
+"""
+Name: cashflow_functions
+Purpose: Vectorized cash flow engine computing the PySAM Cashloan outputs dGen consumes
+
+    (1) Read the Cashloan inputs assigned by financial_functions.calc_system_performance;
+    (2) Stack the inputs of many agents and system sizes into arrays;
+    (3) Calculate npv, payback, cf_payback_with_expenses and the CBI/IBI/PBI totals for all of them at once;
+    (4) Compare against Cashloan results to validate the engine.
+
+The engine follows the Cashloan formulation for the inputs dGen uses: a standard loan,
+no insurance, property tax or salvage value, federal ITC, MACRS depreciation for commercial
+agents, capacity- and production-based O&M, scheduled battery replacement, and the CBI, IBI
+and PBI payment incentives.
+"""
+
+import numpy as np
+import utility_functions as utilfunc
+
+#==============================================================================
+# Load logger
+logger = utilfunc.get_logger()
+#==============================================================================
+
+# Incentive sources of the Cashloan PaymentIncentives group
+INCENTIVE_SOURCES = ['fed', 'sta', 'uti', 'oth']
+
+# MACRS 5 year half-year convention depreciation schedule
+MACRS_5_YR = np.array([0.2, 0.32, 0.192, 0.1152, 0.1152, 0.0576])
+
+# Cashloan outputs computed by calc_cashloan_outputs
+CASHLOAN_OUTPUTS = ['npv', 'payback', 'cf_payback_with_expenses',
+                    'cbi_total', 'cbi_total_fed', 'cbi_total_oth', 'cbi_total_sta', 'cbi_total_uti',
+                    'ibi_total', 'ibi_total_fed', 'ibi_total_oth', 'ibi_total_sta', 'ibi_total_uti',
+                    'cf_pbi_total', 'cf_pbi_total_fed', 'cf_pbi_total_oth', 'cf_pbi_total_sta', 'cf_pbi_total_uti']
+
+
+#%%
+def first(value):
+    """
+    Return the first element of a PySAM sequence input, or the value if it is a number
+    """
+    if isinstance(value, (list, tuple)):
+        return value[0] if len(value) > 0 else 0.
+
+    return value
+
+
+def get_cashloan_inputs(loan):
+    """
+    Read the inputs used by calc_cashloan_outputs from a PySAM Cashloan model.
+
+    Parameters
+    ----------
+    loan : 'PySAM.Cashloan'
+        Cashloan model with all inputs assigned
+
+    Returns
+    -------
+    inputs : 'dict'
+        Scalars, and sequences for the inputs given by year
+    """
+    fin = loan.FinancialParameters.export()
+    costs = loan.SystemCosts.export()
+    depr = loan.Depreciation.export()
+    itc = loan.TaxCreditIncentives.export()
+    batt = loan.BatterySystem.export()
+    output = loan.SystemOutput.export()
+    payment_incentives = loan.PaymentIncentives.export()
+
+    inputs = {'analysis_period': int(fin['analysis_period']),
+              'market': fin.get('market', 0),
+              'system_capacity': fin['system_capacity'],
+              'debt_fraction': fin['debt_fraction'] / 100.,
+              'loan_rate': fin['loan_rate'] / 100.,
+              'loan_term': int(fin['loan_term']),
+              'inflation_rate': fin['inflation_rate'] / 100.,
+              'real_discount_rate': fin['real_discount_rate'] / 100.,
+              'federal_tax_rate': first(fin['federal_tax_rate']) / 100.,
+              'state_tax_rate': first(fin['state_tax_rate']) / 100.,
+              'depr_fed_type': depr.get('depr_fed_type', 0),
+              'depr_sta_type': depr.get('depr_sta_type', 0),
+              'itc_fed_percent': first(itc.get('itc_fed_percent', 0.)) / 100.,
+              'itc_fed_percent_maxvalue': first(itc.get('itc_fed_percent_maxvalue', 1e38)),
+              'total_installed_cost': costs['total_installed_cost'],
+              'om_fixed': first(costs.get('om_fixed', 0.)),
+              'om_capacity': first(costs.get('om_capacity', 0.)),
+              'om_production': first(costs.get('om_production', 0.)),
+              'om_fixed_escal': costs.get('om_fixed_escal', 0.) / 100.,
+              'om_capacity_escal': costs.get('om_capacity_escal', 0.) / 100.,
+              'om_production_escal': costs.get('om_production_escal', 0.) / 100.,
+              'add_om_num_types': costs.get('add_om_num_types', 0),
+              'om_capacity1': first(costs.get('om_capacity1', 0.)),
+              'om_capacity1_nameplate': costs.get('om_capacity1_nameplate', 0.),
+              'om_production1': first(costs.get('om_production1', 0.)),
+              'om_production1_values': first(costs.get('om_production1_values', 0.)),
+              'om_replacement_cost1': first(costs.get('om_replacement_cost1', 0.)),
+              'om_replacement_cost_escal': costs.get('om_replacement_cost_escal', 0.) / 100.,
+              'en_batt': batt.get('en_batt', 0),
+              'batt_replacement_option': batt.get('batt_replacement_option', 0),
+              'batt_replacement_schedule': list(batt.get('batt_replacement_schedule', [])),
+              'batt_computed_bank_capacity': batt.get('batt_computed_bank_capacity', 0.),
+              'annual_energy_value': list(output['annual_energy_value']),
+              'annual_gen': float(np.sum(output['gen'])),
+              'degradation': first(output['degradation']) / 100.}
+
+    for source in INCENTIVE_SOURCES:
+        get = lambda name, default=0.: payment_incentives.get(name.format(source), default)
+        inputs['cbi_{}_amount'.format(source)] = get('cbi_{}_amount')
+        inputs['cbi_{}_maxvalue'.format(source)] = get('cbi_{}_maxvalue', 1e38)
+        inputs['cbi_{}_taxable'.format(source)] = get('cbi_{}_tax_fed')
+        inputs['ibi_{}_amount'.format(source)] = get('ibi_{}_amount')
+        inputs['ibi_{}_percent'.format(source)] = get('ibi_{}_percent') / 100.
+        inputs['ibi_{}_percent_maxvalue'.format(source)] = get('ibi_{}_percent_maxvalue', 1e38)
+        inputs['ibi_{}_taxable'.format(source)] = get('ibi_{}_percent_tax_fed')
+        inputs['pbi_{}_amount'.format(source)] = list(np.atleast_1d(get('pbi_{}_amount')))
+        inputs['pbi_{}_term'.format(source)] = get('pbi_{}_term')
+        inputs['pbi_{}_escal'.format(source)] = get('pbi_{}_escal') / 100.
+        inputs['pbi_{}_taxable'.format(source)] = get('pbi_{}_tax_fed')
+
+    return inputs
+
+
+def stack_cashloan_inputs(inputs_list):
+    """
+    Stack the inputs of many cases into arrays with the cases in the first dimension.
+    All cases must have the same analysis period. Inputs given by year are padded with zeros.
+
+    Parameters
+    ----------
+    inputs_list : 'list'
+        Inputs of each case, see get_cashloan_inputs
+
+    Returns
+    -------
+    inputs : 'dict'
+        (n,) arrays of scalars and (n x analysis_period + 1) arrays of inputs by year (year 0 first)
+    """
+    n_years = inputs_list[0]['analysis_period']
+    if any(inputs['analysis_period'] != n_years for inputs in inputs_list):
+        raise ValueError('Cases stacked for the cash flow engine must have the same analysis period')
+
+    def by_year(values, offset):
+        # pad or truncate to n_years + 1 entries starting at year offset
+        row = np.zeros(n_years + 1)
+        values = np.asarray(values, float)[:n_years + 1 - offset]
+        row[offset:offset + len(values)] = values
+        return row
+
+    stacked = dict()
+    for key in inputs_list[0]:
+        if key == 'annual_energy_value':
+            stacked[key] = np.stack([by_year(inputs[key], 0) for inputs in inputs_list])
+        elif key == 'batt_replacement_schedule' or key.startswith('pbi_') and key.endswith('_amount'):
+            stacked[key] = np.stack([by_year(inputs[key], 1) for inputs in inputs_list])
+        else:
+            stacked[key] = np.array([inputs[key] for inputs in inputs_list], float)
+
+    return stacked
+
+
+def calc_cashloan_outputs(inputs):
+    """
+    Calculate the Cashloan outputs dGen consumes for a batch of cases.
+
+    Parameters
+    ----------
+    inputs : 'dict'
+        Stacked inputs, see stack_cashloan_inputs
+
+    Returns
+    -------
+    outputs : 'dict'
+        CASHLOAN_OUTPUTS, (n,) arrays for totals and (n x analysis_period + 1) arrays for cash flows
+    """
+    n_years = int(inputs['analysis_period'][0])
+    years = np.arange(n_years + 1)
+    in_operation = (years >= 1)[np.newaxis, :]
+
+    col = lambda key: inputs[key][:, np.newaxis]
+
+    installed_cost = inputs['total_installed_cost']
+    system_w = inputs['system_capacity'] * 1000.
+
+    # --- incentives ---
+    outputs = dict()
+    taxable_incentives = np.zeros(installed_cost.shape)
+    cf_pbi_total = np.zeros((installed_cost.size, n_years + 1))
+    cf_pbi_taxable = np.zeros(cf_pbi_total.shape)
+    for source in INCENTIVE_SOURCES:
+        cbi = np.minimum(inputs['cbi_{}_amount'.format(source)] * system_w, inputs['cbi_{}_maxvalue'.format(source)])
+        ibi = (inputs['ibi_{}_amount'.format(source)] +
+               np.minimum(inputs['ibi_{}_percent'.format(source)] * installed_cost, inputs['ibi_{}_percent_maxvalue'.format(source)]))
+        outputs['cbi_total_{}'.format(source)] = cbi
+        outputs['ibi_total_{}'.format(source)] = ibi
+        taxable_incentives += cbi * inputs['cbi_{}_taxable'.format(source)] + ibi * inputs['ibi_{}_taxable'.format(source)]
+
+        pbi_term = (years[np.newaxis, :] <= col('pbi_{}_term'.format(source))) & in_operation
+        gen = col('annual_gen') * (1. - col('degradation')) ** (years[np.newaxis, :] - 1)
+        pbi_escal = (1. + col('pbi_{}_escal'.format(source))) ** (years[np.newaxis, :] - 1)
+        cf_pbi = inputs['pbi_{}_amount'.format(source)] * pbi_escal * gen * pbi_term
+        outputs['cf_pbi_total_{}'.format(source)] = cf_pbi
+        cf_pbi_total += cf_pbi
+        cf_pbi_taxable += cf_pbi * col('pbi_{}_taxable'.format(source))
+
+    outputs['cbi_total'] = sum(outputs['cbi_total_{}'.format(source)] for source in INCENTIVE_SOURCES)
+    outputs['ibi_total'] = sum(outputs['ibi_total_{}'.format(source)] for source in INCENTIVE_SOURCES)
+    outputs['cf_pbi_total'] = cf_pbi_total
+
+    # --- operating expenses ---
+    annual_gen = col('annual_gen') * (1. - col('degradation')) ** (years[np.newaxis, :] - 1)
+    escalation = lambda escal: (1. + col('inflation_rate') + col(escal)) ** (years[np.newaxis, :] - 1)
+    has_om1 = col('add_om_num_types') >= 1
+    cf_om = ((col('om_fixed') * escalation('om_fixed_escal') +
+              (col('om_capacity') * col('system_capacity') + has_om1 * col('om_capacity1') * col('om_capacity1_nameplate')) * escalation('om_capacity_escal') +
+              (col('om_production') * annual_gen + has_om1 * col('om_production1') * col('om_production1_values')) / 1000. * escalation('om_production_escal')) *
+             in_operation)
+
+    # replacements are costed at om_replacement_cost1 per kWh of the bank, as in Cashloan
+    batt_replacement = ((col('en_batt') == 1) & (col('batt_replacement_option') == 2)) * inputs['batt_replacement_schedule']
+    cf_batt_replacement = (batt_replacement * col('om_replacement_cost1') * col('batt_computed_bank_capacity') *
+                           escalation('om_replacement_cost_escal'))
+
+    # --- debt ---
+    adjusted_installed_cost = installed_cost - outputs['cbi_total'] - outputs['ibi_total']
+    loan_amount = inputs['debt_fraction'] * adjusted_installed_cost
+    loan_rate = inputs['loan_rate']
+    loan_term = inputs['loan_term']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        payment = np.where(loan_rate > 0,
+                           loan_amount * loan_rate / (1. - (1. + loan_rate) ** -loan_term),
+                           loan_amount / np.maximum(loan_term, 1))
+    in_term = (years[np.newaxis, :] <= loan_term[:, np.newaxis]) & in_operation
+    # balance at the start of each year
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = (1. + loan_rate[:, np.newaxis]) ** (years[np.newaxis, :] - 1)
+        balance = np.where(loan_rate[:, np.newaxis] > 0,
+                           loan_amount[:, np.newaxis] * growth - payment[:, np.newaxis] * (growth - 1.) / loan_rate[:, np.newaxis],
+                           loan_amount[:, np.newaxis] - payment[:, np.newaxis] * (years[np.newaxis, :] - 1))
+    cf_interest = np.clip(balance, 0, None) * loan_rate[:, np.newaxis] * in_term
+    cf_debt_payment = payment[:, np.newaxis] * in_term
+
+    # --- taxes ---
+    itc = np.minimum(inputs['itc_fed_percent'] * installed_cost, inputs['itc_fed_percent_maxvalue'])
+    cf_itc = np.where(years == 1, itc[:, np.newaxis], 0.)
+
+    depr_basis = installed_cost - 0.5 * itc
+    depr_schedule = np.zeros(n_years + 1)
+    depr_schedule[1:1 + min(len(MACRS_5_YR), n_years)] = MACRS_5_YR[:n_years]
+    cf_depr_fed = (col('depr_fed_type') == 1) * depr_basis[:, np.newaxis] * depr_schedule[np.newaxis, :]
+    cf_depr_sta = (col('depr_sta_type') == 1) * depr_basis[:, np.newaxis] * depr_schedule[np.newaxis, :]
+
+    energy_value = inputs['annual_energy_value'] * in_operation
+    commercial = col('market') == 1
+    taxable_incentive_year1 = np.where(years == 1, taxable_incentives[:, np.newaxis], 0.)
+
+    # commercial agents pay tax on savings net of deductible expenses, residential agents only on taxable incentives
+    taxable_base = cf_pbi_taxable + taxable_incentive_year1
+    deductions_sta = commercial * (cf_om + cf_interest + cf_depr_sta)
+    deductions_fed = commercial * (cf_om + cf_interest + cf_depr_fed)
+    taxable_sta = taxable_base + commercial * energy_value - deductions_sta
+    cf_sta_tax = -col('state_tax_rate') * taxable_sta
+    taxable_fed = taxable_base + commercial * energy_value - deductions_fed + cf_sta_tax
+    cf_fed_tax = -col('federal_tax_rate') * taxable_fed
+
+    # tax savings of the expenses that are not financing
+    interest_shield = commercial * cf_interest * (col('state_tax_rate') + col('federal_tax_rate') * (1. - col('state_tax_rate')))
+
+    # --- cash flows ---
+    cf_operating = energy_value - cf_om - cf_batt_replacement + cf_pbi_total + cf_itc + cf_sta_tax + cf_fed_tax
+    cf_after_tax = cf_operating - cf_debt_payment
+    cf_after_tax[:, 0] = -(adjusted_installed_cost - loan_amount)
+
+    nominal_discount_rate = (1. + inputs['real_discount_rate']) * (1. + inputs['inflation_rate']) - 1.
+    discount = (1. + nominal_discount_rate[:, np.newaxis]) ** -years[np.newaxis, :]
+    outputs['npv'] = (cf_after_tax * discount).sum(axis=1)
+
+    # payback ignores financing: the full adjusted cost is paid in year 0 and the interest tax shield is removed
+    cf_payback = cf_operating - interest_shield
+    cf_payback[:, 0] = -adjusted_installed_cost
+    outputs['cf_payback_with_expenses'] = cf_payback
+    outputs['payback'] = calc_payback(cf_payback)
+
+    return outputs
+
+
+def calc_payback(cash_flows):
+    """
+    Simple payback period of each row of cash flows, interpolated within the year the
+    cumulative cash flow turns positive. NaN if it never does.
+
+    Parameters
+    ----------
+    cash_flows : 'numpy.ndarray'
+        (n x years) cash flows, year 0 first
+
+    Returns
+    -------
+    payback : 'numpy.ndarray'
+        (n,) payback periods [years]
+    """
+    cumulative = np.cumsum(cash_flows, axis=1)
+    paid_back = cumulative >= 0
+    paid_back[:, 0] = False
+
+    payback = np.full(cash_flows.shape[0], np.nan)
+    has_payback = paid_back.any(axis=1)
+    year = np.argmax(paid_back, axis=1)
+
+    rows = np.where(has_payback)[0]
+    year = year[rows]
+    payback[rows] = (year - 1) - cumulative[rows, year - 1] / cash_flows[rows, year]
+
+    return payback
+
+
+def calc_cashloan_outputs_single(loan):
+    """
+    Calculate the Cashloan outputs for one PySAM Cashloan model in place of loan.execute()
+
+    Returns
+    -------
+    outputs : 'dict'
+        CASHLOAN_OUTPUTS as scalars and lists, as read from loan.Outputs
+    """
+    outputs = calc_cashloan_outputs(stack_cashloan_inputs([get_cashloan_inputs(loan)]))
+
+    return {key: (value[0].tolist() if np.ndim(value) == 2 else float(value[0])) for key, value in outputs.items()}
+
+
+def get_no_system_outputs(analysis_period):
+    """
+    Cashloan outputs of not installing a system, which Cashloan does not run for (system_capacity of 0):
+    no cash flows, an NPV of 0, no payback and no incentives
+
+    Parameters
+    ----------
+    analysis_period : 'int'
+        Analysis period [years]
+
+    Returns
+    -------
+    outputs : 'dict'
+        CASHLOAN_OUTPUTS as scalars and lists, as read from loan.Outputs
+    """
+    outputs = {key: (np.zeros(int(analysis_period) + 1).tolist() if key.startswith('cf_') else 0.) for key in CASHLOAN_OUTPUTS}
+    outputs['payback'] = np.nan
+
+    return outputs
+
+
+def validate_cashloan_outputs(outputs, loan, tolerance=0.01, label=''):
+    """
+    Compare engine outputs with the outputs of an executed Cashloan model and log mismatches
+
+    Parameters
+    ----------
+    outputs : 'dict'
+        Outputs of calc_cashloan_outputs_single
+    loan : 'PySAM.Cashloan'
+        Cashloan model that has been executed with the same inputs
+    tolerance : 'float'
+        Relative difference above which a mismatch is logged
+    label : 'str'
+        Identifies the case in the log
+
+    Returns
+    -------
+    mismatches : 'list'
+        Names of the outputs that differ by more than tolerance
+    """
+    mismatches = []
+    for output in ['npv', 'payback', 'cbi_total', 'ibi_total']:
+        numpy_value = outputs[output]
+        pysam_value = getattr(loan.Outputs, output)
+        if np.isnan(numpy_value) and np.isnan(pysam_value):
+            continue
+
+        rel_diff = abs(numpy_value - pysam_value) / max(abs(pysam_value), 1.)
+        if not rel_diff <= tolerance:
+            mismatches.append(output)
+            logger.warning('Cash flow engine mismatch {l}: {o} numpy {n:.2f} vs pysam {p:.2f}'
+                           .format(l=label, o=output, n=numpy_value, p=pysam_value))
+
+    return mismatches
@@ -62,4 +62,112 @@ VERBOSE = False
 cwd = os.getcwd() #should be /python
 pdir = os.path.abspath('..') #should be /dgen or whatever it is called
 
-OBSERVED_DEPLOYMENT_BY_STATE = os.path.join(pdir, 'input_data','observed_deployment_by_state_sector_2020.csv')
\ No newline at end of file
+OBSERVED_DEPLOYMENT_BY_STATE = os.path.join(pdir, 'input_data','observed_deployment_by_state_sector_2020.csv')
+
+#==============================================================================
+#  Parallel execution of row-wise agent functions (Agents.chunk_on_row)
+#==============================================================================
+# 'chunk' sends each worker a whole chunk of agents and returns one result block per chunk,
+# 'row' submits one task per agent
+CHUNK_EXECUTOR_MODE = 'chunk'
+# number of chunks per worker, more than one evens out load across workers
+CHUNKS_PER_CORE = 4
+
+#==============================================================================
+#  Bulk loading of hourly profiles
+#==============================================================================
+# maximum number of load profiles fetched per query
+LOAD_PROFILE_QUERY_CHUNK_SIZE = 1000
+# maximum number of solar capacity factor profiles loaded at scenario start, most shared first
+SOLAR_CF_PREFETCH_MAX_PROFILES = 20000
+# maximum number of solar capacity factor profiles each worker caches beyond those loaded at scenario start
+SOLAR_CF_CACHE_MAX_PROFILES = 1000
+# data type of the shared hourly profile stores and of batt_dispatch_profile
+HOURLY_PROFILE_DTYPE = 'float32'
+
+#==============================================================================
+#  Caches used while sizing agents
+#==============================================================================
+# maximum number of compiled tariffs each worker keeps
+TARIFF_CACHE_MAX_SIZE = 500
+# maximum number of net billing sell rates whose energy rates table each compiled tariff keeps
+TARIFF_CACHE_MAX_SELL_RATES = 20
+
+#==============================================================================
+#  System sizing
+#==============================================================================
+# start each agent's sizing search around its optimum from last model year
+SIZING_WARM_START = False
+# half width of the warm start search bracket as a fraction of the agent's maximum system size
+SIZING_WARM_START_BRACKET_FRAC = 0.2
+# decimals of system size (kW) at which repeated objective evaluations of an agent are reused
+SIZING_EVAL_CACHE_DECIMALS = 3
+# electricity bill calculation used in sizing: 'pysam' (Utilityrate5) or 'numpy' (tariff_functions.calc_annual_bills)
+BILL_BACKEND = 'pysam'
+# fraction of numpy bill calculations also run with Utilityrate5 and compared
+BILL_VALIDATION_SAMPLE_FRAC = 0.
+# relative difference in first year bills above which a mismatch is logged
+BILL_VALIDATION_TOLERANCE = 0.01
+# cash flow backend for sizing: 'pysam' (Cashloan) or 'numpy' (cashflow_functions)
+CASHFLOW_BACKEND = 'pysam'
+# fraction of numpy cash flow calculations also run with Cashloan and compared
+CASHFLOW_VALIDATION_SAMPLE_FRAC = 0.
+# relative difference in npv, payback and incentive totals above which a mismatch is logged
+CASHFLOW_VALIDATION_TOLERANCE = 0.01
+# system size search: 'brent' (bounded Brent search) or 'grid' (grid search refined around the best grid point)
+SIZING_METHOD = 'brent'
+# number of evenly spaced system sizes, including 0 and the maximum size, in the grid search
+SIZING_GRID_POINTS = 11
+# number of agents whose grid points are evaluated in one batch, with the numpy bill and cash flow backends (financial_functions.evaluate_system_grids)
+SIZING_GRID_BATCH_AGENTS = 50
+# size one agent of each set of agents with equal sizing inputs (financial_functions.get_sizing_dedupe_cols) and copy its results to the others
+SIZING_DEDUPE = True
+# directory of the sizing result cache shared across runs and scenarios (utilfunc.DiskCache); None to disable
+SIZING_CACHE_DIR = None
+# label of the version of the input data (agents, load and solar profiles, tariffs) in the database, part of every sizing cache key; change it when the data changes
+SIZING_CACHE_DATA_VERSION = None
+# keep last year's sizing results for agents whose sizing inputs have not changed (financial_functions.fingerprint_sizing_inputs)
+SIZING_CARRY_FORWARD = False
+# skip the size optimization of agents whose NPV upper bound is not positive (financial_functions.screen_sizing_agents)
+SIZING_SCREENING = False
+# tolerance on system size of each sizing fidelity tier: min(tol_frac * max_system_kw, max_tol_kw)
+SIZING_FIDELITY_TIERS = {'fine': {'tol_frac': 0.25, 'max_tol_kw': 0.5},
+                         'coarse': {'tol_frac': 0.25, 'max_tol_kw': 2.5}}
+# size every agent with the coarse tier, for exploratory runs
+SIZING_EXPLORATORY = False
+# size agents with a developable agent weight below this with the coarse tier; None to disable
+SIZING_COARSE_MAX_DEVELOPABLE_WEIGHT = None
+# size agents whose maximum market share last model year was at most this with the coarse tier; None to disable
+SIZING_COARSE_MAX_MARKET_SHARE = None
+
+#==============================================================================
+#  Database connections
+#==============================================================================
+# maximum number of database connections each process opens per role (utilfunc.ConnectionManager)
+DB_POOL_MAX_CONNECTIONS = 32
+# maximum number of released database connections each process keeps open for reuse per role
+DB_POOL_MAX_IDLE = 8
+# seconds to wait for a database connection when the pool is exhausted
+DB_POOL_TIMEOUT = 300
+# check that pooled database connections are alive before reusing them
+DB_POOL_PRE_PING = True
+# connections kept open by each SQLAlchemy engine (utilfunc.make_engine), and extra connections opened under load
+DB_ENGINE_POOL_SIZE = 4
+DB_ENGINE_MAX_OVERFLOW = 4
+
+#==============================================================================
+#  Model outputs
+#==============================================================================
+# number of rows loaded per COPY when writing dataframes to the database (input_data_functions.df_to_psql)
+PSQL_COPY_BATCH_ROWS = 50000
+# write each model year's outputs on a background thread while the next year runs (output_writer.OutputWriter)
+OUTPUT_WRITER_BACKGROUND = True
+# maximum number of output writes waiting for the background writer; the model waits when the queue is full
+OUTPUT_WRITER_MAX_QUEUED = 2
+# files written with each model year's agent outputs: 'parquet' (dataset in agent_outputs/ of the run directory,
+# partitioned by scenario, year and state) and/or 'pickle' (agent_df_{year}.pkl in the scenario directory)
+AGENT_OUTPUT_FILES = ['pickle', 'parquet']
+# compression codec of the agent output parquet dataset, e.g. 'snappy', 'zstd' or 'gzip'; None for no compression
+AGENT_PARQUET_COMPRESSION = 'snappy'
+# array columns written as list columns to the agent output parquet dataset (they are not written to the database)
+AGENT_PARQUET_LIST_COLUMNS = ['cash_flow', 'batt_dispatch_profile']
@@ -144,24 +144,26 @@ def create_output_schema(pg_conn_string, role, suffix, scenario_list, source_sch
     logger.info('Creating output schema based on {source_schema}'.format(**inputs))
 
     con, cur = utilfunc.make_con(pg_conn_string, role)
-
-    # check that the source schema exists
-    sql = """SELECT count(*)
-            FROM pg_catalog.pg_namespace
-            WHERE nspname = '{source_schema}';""".format(**inputs)
-    check = pd.read_sql(sql, con)
-    if check['count'][0] != 1:
-        msg = "Specified source_schema ({source_schema}) does not exist.".format(**inputs)
-        raise ValueError(msg)
-
-    scen_suffix = os.path.split(scenario_list[0])[1].split('_')[2].rstrip('.xlsm')
-
-    dest_schema = 'diffusion_results_{}'.format(suffix+suffix_microsecond+'_'+scen_suffix)
-    inputs['dest_schema'] = dest_schema
-
-    sql = '''SELECT diffusion_shared.clone_schema('{source_schema}', '{dest_schema}', '{role}', {include_data});'''.format(**inputs)
-    cur.execute(sql)
-    con.commit()
+    try:
+        # check that the source schema exists
+        sql = """SELECT count(*)
+                FROM pg_catalog.pg_namespace
+                WHERE nspname = '{source_schema}';""".format(**inputs)
+        check = pd.read_sql(sql, con)
+        if check['count'][0] != 1:
+            msg = "Specified source_schema ({source_schema}) does not exist.".format(**inputs)
+            raise ValueError(msg)
+
+        scen_suffix = os.path.split(scenario_list[0])[1].split('_')[2].rstrip('.xlsm')
+
+        dest_schema = 'diffusion_results_{}'.format(suffix+suffix_microsecond+'_'+scen_suffix)
+        inputs['dest_schema'] = dest_schema
+
+        sql = '''SELECT diffusion_shared.clone_schema('{source_schema}', '{dest_schema}', '{role}', {include_data});'''.format(**inputs)
+        cur.execute(sql)
+        con.commit()
+    finally:
+        utilfunc.release_con(con)
 
     logger.info('\tOutput schema is: {}'.format(dest_schema))
 
@@ -192,8 +194,11 @@ def drop_output_schema(pg_conn_string, schema, delete_output_schema):
         con, cur = utilfunc.make_con(pg_conn_string, role="postgres")
         #con, cur = utilfunc.make_con(pg_conn_string, role="diffusion-schema-writers")
         sql = '''DROP SCHEMA IF EXISTS {schema} CASCADE;'''.format(**inputs)
-        cur.execute(sql)
-        con.commit()
+        try:
+            cur.execute(sql)
+            con.commit()
+        finally:
+            utilfunc.release_con(con)
     else:
         logger.warning(
             "The output schema  (%(schema)s) has not been deleted. Please delete manually when you are finished analyzing outputs." % inputs)
@@ -18,6 +18,10 @@ import agent_mutation
 import diffusion_functions_elec
 import financial_functions
 import input_data_functions as iFuncs
+import hourly_profiles
+import output_writer
+import config
+from agents import Agents, AgentPool
 import PySAM
 
 #==============================================================================
@@ -132,6 +136,28 @@ def main(mode = None, resume_year = None, endyear = None, ReEDS_inputs = None):
                 nem_selected_scenario = datfunc.get_selected_scenario(con, scenario_settings.schema)
                 rate_switch_table = agent_mutation.elec.get_rate_switch_table(con)
 
+                # load hourly profiles into shared stores, agents carry only the column of their profile
+                load_profiles = agent_mutation.elec.get_agent_load_profiles_bulk(con, solar_agents.df).share()
+                solar_cf_store = agent_mutation.elec.get_normalized_hourly_resource_solar_bulk(con, solar_agents.df).share()
+                solar_cf_profiles = hourly_profiles.ProfileCache(solar_cf_store, max_size=config.SOLAR_CF_CACHE_MAX_PROFILES)
+
+                solar_agents.df['load_profile_idx'] = load_profiles.index_of(solar_agents.df[['bldg_id', 'sector_abbr', 'state_abbr']].itertuples(index=False, name=None))
+                solar_agents.df['solar_cf_idx'] = solar_cf_store.index_of(solar_agents.df[['solar_re_9809_gid', 'tilt', 'azimuth']].itertuples(index=False, name=None))
+                cols_base += ['load_profile_idx', 'solar_cf_idx']
+
+                # start the sizing workers once per scenario, they are reused across model years
+                if 'ix' not in os.name: 
+                    cores = None
+                else:
+                    cores = model_settings.local_cores
+
+                rate_switch_index = agent_mutation.elec.index_rate_switch_table(rate_switch_table)
+                sizing_pool = AgentPool(cores=cores, shared_tables={'rate_switch_table': rate_switch_index, 'load_profiles': load_profiles, 'solar_cf_profiles': solar_cf_profiles})
+
+                # sizing results cached on disk and reused across runs and scenarios
+                sizing_cache = utilfunc.DiskCache(config.SIZING_CACHE_DIR) if config.SIZING_CACHE_DIR else None
+                sizing_data_source = financial_functions.get_sizing_data_source(model_settings)
+
                 #==========================================================================================================
                 # INGEST SCENARIO ENVIRONMENTAL VARIABLES
                 #==========================================================================================================
@@ -151,6 +177,9 @@ def main(mode = None, resume_year = None, endyear = None, ReEDS_inputs = None):
                 #==========================================================================================================
                 # Calculate Tariff Components from ReEDS data
                 #==========================================================================================================
+                # write each year's outputs while the next year runs
+                outputs = output_writer.OutputWriter()
+
                 for i, year in enumerate(scenario_settings.model_years):
 
                     logger.info('\tWorking on {}'.format(year))
@@ -214,22 +243,58 @@ def main(mode = None, resume_year = None, endyear = None, ReEDS_inputs = None):
                     # Apply host-owned financial parameters
                     solar_agents.on_frame(agent_mutation.elec.apply_financial_params, [financing_terms, itc_options, inflation_rate])
 
-                    if 'ix' not in os.name: 
-                        cores = None
-                    else:
-                        cores = model_settings.local_cores
-
                     # Apply state incentives
                     solar_agents.on_frame(agent_mutation.elec.apply_state_incentives, [state_incentives, year, model_settings.start_year, state_capacity_by_year])
                     
+                    # Carry last year's optimal system sizes forward to warm start sizing
+                    if config.SIZING_WARM_START and not is_first_year:
+                        solar_agents.on_frame(financial_functions.apply_sizing_warm_start, sizing_optima_last_year)
+
+                    # Set the tolerance of each agent's system size
+                    solar_agents.on_frame(financial_functions.assign_sizing_fidelity, None if is_first_year else max_market_share_last_year)
+
+                    # Flag agents that cannot reach a positive NPV, which are not optimized
+                    if config.SIZING_SCREENING:
+                        solar_agents.on_frame(financial_functions.screen_sizing_agents, [solar_cf_profiles, rate_switch_index])
+
+                    # Agents sized once per set of equal sizing inputs share the finest of their sizing settings
+                    if config.SIZING_DEDUPE:
+                        solar_agents.on_frame(financial_functions.align_sizing_settings)
+
+                    # Keep last year's sizing results for agents whose sizing inputs have not changed
+                    if config.SIZING_CARRY_FORWARD:
+                        sizing_fingerprints = financial_functions.fingerprint_sizing_inputs(solar_agents.df)
+                    if config.SIZING_CARRY_FORWARD and not is_first_year:
+                        resize_df, carried_df = financial_functions.split_unchanged_agents(solar_agents.df, sizing_fingerprints, sizing_results_last_year)
+                        logger.info('\t\tCarrying forward sizing results of {c} of {n} agents'.format(c=len(carried_df), n=len(solar_agents)))
+                        sizing_agents = Agents(resize_df)
+                    else:
+                        carried_df = None
+                        sizing_agents = solar_agents
+
                     # Calculate System Financial Performance
-                    solar_agents.chunk_on_row(financial_functions.calc_system_size_and_performance, sectors=scenario_settings.sectors, cores=cores, rate_switch_table=rate_switch_table)
+                    if len(sizing_agents) > 0:
+                        sizing_agents.chunk_on_row(financial_functions.calc_system_size_and_performance, chunk_func=financial_functions.calc_system_size_and_performance_chunk, sectors=scenario_settings.sectors, pool=sizing_pool, dedupe_cols=financial_functions.get_sizing_dedupe_cols() if config.SIZING_DEDUPE else None, rate_switch_table=sizing_pool.handle('rate_switch_table'), load_profiles=sizing_pool.handle('load_profiles'), solar_cf_profiles=sizing_pool.handle('solar_cf_profiles'), sizing_cache=sizing_cache, data_source=sizing_data_source)
+
+                    if carried_df is not None:
+                        solar_agents.df = financial_functions.combine_carried_agents(solar_agents.df, sizing_agents.df, carried_df)
+                        solar_agents.update_attrs
+
+                    financial_functions.log_sizing_evaluations(solar_agents.df)
+
+                    if config.SIZING_CARRY_FORWARD:
+                        sizing_results_last_year = solar_agents.df[financial_functions.SIZING_OUTPUT_COLS].copy()
+                        sizing_results_last_year['sizing_fingerprint'] = sizing_fingerprints.loc[sizing_results_last_year['agent_id'].values].values
+
+                    if config.SIZING_WARM_START:
+                        sizing_optima_last_year = solar_agents.df[['agent_id', 'system_kw_with_batt', 'system_kw_no_batt']].copy()
 
                     # Calculate the financial performance of the S+S systems
                     #solar_agents.on_frame(financial_functions.calc_financial_performance)
 
                     # Calculate Maximum Market Share
                     solar_agents.on_frame(financial_functions.calc_max_market_share, max_market_share)
+                    max_market_share_last_year = solar_agents.df.reset_index()[['agent_id', 'max_market_share']].copy()
 
                     # determine "developable" population
                     solar_agents.on_frame(agent_mutation.elec.calculate_developable_customers_and_load)
@@ -256,31 +321,45 @@ def main(mode = None, resume_year = None, endyear = None, ReEDS_inputs = None):
                     last_year_installed_capacity = last_year_installed_capacity.groupby('state_abbr')[['system_kw_cum','batt_kw_cum','batt_kwh_cum']].sum().reset_index()
 
                     #==========================================================================================================
-                    # WRITE AGENT DF AS PICKLES FOR POST-PROCESSING
+                    # WRITE AGENT DF FOR POST-PROCESSING
                     #==========================================================================================================
-                    write_annual_agents = True
                     drop_fields = ['index', 'reeds_reg', 'customers_in_bin_initial', 'load_kwh_per_customer_in_bin_initial',
                                    'load_kwh_in_bin_initial', 'sector', 'roof_adjustment', 'load_kwh_in_bin', 'naep',
                                    'first_year_elec_bill_savings_frac', 'metric', 'developable_load_kwh_in_bin', 'initial_number_of_adopters', 'initial_pv_kw', 
                                    'initial_market_share', 'initial_market_value', 'market_value_last_year', 'teq_yr1', 'mms_fix_zeros', 'ratio', 
                                    'teq2', 'f', 'new_adopt_fraction', 'bass_market_share', 'diffusion_market_share', 'new_market_value', 'market_value', 'total_gen_twh',
-                                   'consumption_hourly', 'solar_cf_profile', 'tariff_dict', 'deprec_sch', 'batt_dispatch_profile',
+                                   'consumption_hourly', 'solar_cf_profile', 'load_profile_idx', 'solar_cf_idx',
+                                   'system_kw_with_batt', 'system_kw_no_batt', 'system_kw_with_batt_last_year', 'system_kw_no_batt_last_year', 'tariff_dict', 'deprec_sch', 'batt_dispatch_profile',
                                    'cash_flow', 'cbi', 'ibi', 'pbi', 'cash_incentives', 'state_incentives', 'export_tariff_results']
                     drop_fields = [x for x in drop_fields if x in solar_agents.df.columns]
+                    # (drop returns a new frame, which the writer owns from here on)
                     df_write = solar_agents.df.drop(drop_fields, axis=1)
 
-                    if write_annual_agents==True:
-                        df_write.to_pickle(out_scen_path + '/agent_df_{}.pkl'.format(year))
+                    if 'pickle' in config.AGENT_OUTPUT_FILES:
+                        outputs.submit(df_write.to_pickle, out_scen_path + '/agent_df_{}.pkl'.format(year))
+
+                    if 'parquet' in config.AGENT_OUTPUT_FILES:
+                        # keep the array columns dropped from the database outputs as list columns
+                        list_cols = [x for x in config.AGENT_PARQUET_LIST_COLUMNS if x in solar_agents.df.columns]
+                        df_parquet = pd.concat([df_write, solar_agents.df[list_cols]], axis=1)
+                        outputs.submit(output_writer.write_agent_parquet, df_parquet, os.path.join(model_settings.out_dir, 'agent_outputs'), os.path.basename(out_scen_path))
+                        del df_parquet
 
                     # Write Outputs to the database
                     if i == 0:
                         write_mode = 'replace'
                     else:
                         write_mode = 'append'
-                    iFuncs.df_to_psql(df_write, engine, schema, owner,'agent_outputs', if_exists=write_mode, append_transformations=True)
+                    outputs.submit(iFuncs.df_to_psql, df_write, engine, schema, owner,'agent_outputs', if_exists=write_mode, append_transformations=True)
 
                     del df_write
 
+                # wait for the outputs of the last years to be written
+                outputs.close()
+                sizing_pool.shutdown()
+                load_profiles.close()
+                solar_cf_profiles.close()
+
             elif scenario_settings.techs == ['wind']:
                 logger.error('Wind not yet supported')
                 break
@@ -293,8 +372,9 @@ def main(mode = None, resume_year = None, endyear = None, ReEDS_inputs = None):
 
             #####################################################################
             # drop the new scenario_settings.schema
-            engine.dispose()
-            con.close()
+            # (end the open transaction of the connection first or the query will hang)
+            con.rollback()
+            utilfunc.close_connections()
             datfunc.drop_output_schema(model_settings.pg_conn_string, scenario_settings.schema, model_settings.delete_output_schema)
             #####################################################################
             
@@ -303,11 +383,18 @@ def main(mode = None, resume_year = None, endyear = None, ReEDS_inputs = None):
             logger.info('Completed in: {} seconds'.format(round(time_to_complete, 1)))
 
     except Exception as e:
-        # close the connection (need to do this before dropping schema or query will hang)
-        if 'engine' in locals():
-            engine.dispose()
+        # stop the output writer and the sizing workers and close their connections
+        if 'outputs' in locals():
+            outputs.close(discard=True)
+        if 'sizing_pool' in locals():
+            sizing_pool.shutdown()
+        if 'load_profiles' in locals():
+            load_profiles.close()
+        if 'solar_cf_profiles' in locals():
+            solar_cf_profiles.close()
+        # release the connection (need to do this before dropping schema or query will hang)
         if 'con' in locals():
-            con.close()
+            utilfunc.release_con(con)
         if 'logger' in locals():
             logger.error(e.__str__(), exc_info = True)
         if 'scenario_settings' in locals() and scenario_settings.schema is not None:
@@ -318,7 +405,8 @@ def main(mode = None, resume_year = None, endyear = None, ReEDS_inputs = None):
 
     finally:
         if 'con' in locals():
-            con.close()
+            utilfunc.release_con(con)
+        utilfunc.close_connections()
         if 'scenario_settings' in locals() and scenario_settings.schema is not None:
             # drop the output schema
             datfunc.drop_output_schema(model_settings.pg_conn_string, scenario_settings.schema, model_settings.delete_output_schema)
@@ -2,10 +2,17 @@ import numpy as np
 import pandas as pd
 import decorators
 import datetime
+import hashlib
+import os
+import threading
+from collections import OrderedDict
 from scipy import optimize
 
-import settings
+import agents
 import utility_functions as utilfunc
+import tariff_functions as tFuncs
+import cashflow_functions as cFuncs
+import config
 import agent_mutation
 
 import pyarrow as pa
@@ -23,11 +30,104 @@ import PySAM.Cashloan as cashloan
 logger = utilfunc.get_logger()
 #==============================================================================
 
+# SAM defaults of the PySAM module configs, loaded once per thread, see get_pysam_module
+_pysam_defaults = threading.local()
+# compiled tariffs shared by the agents sized in a worker thread, see get_compiled_tariff
+_compiled_tariffs = threading.local()
+# draws sampling the evaluations validated against the PySAM modules, seeded so that validation runs are reproducible
+_validation_rng = np.random.RandomState(0)
+
+# Dictionary to map dGen compensation styles to PySAM options
+NEM_OPTIONS = {'net metering':0, 'net billing':2, 'buy all sell all':4, 'none':2}
+
+
+#%%
+def get_pysam_module(module, config_name):
+    """
+    Return a new instance of a PySAM module loaded with the defaults of config_name.
+    Each config's defaults are read from SAM once per worker and assigned to an empty 
+    instance on later calls, so that no input set for a previous agent is kept.
+
+    Parameters
+    ----------
+    module : 'module'
+        PySAM module, e.g. PySAM.Battwatts
+    config_name : 'str'
+        SAM default configuration, e.g. 'PVWattsBatteryResidential'
+
+    Returns
+    -------
+    model : 'PySAM module instance'
+        Instance with the config defaults assigned
+    """
+    if not hasattr(_pysam_defaults, 'cache'):
+        _pysam_defaults.cache = {}
+
+    key = (module.__name__, config_name)
+    if key not in _pysam_defaults.cache:
+        defaults = module.default(config_name).export()
+        defaults.pop('Outputs', None)
+        _pysam_defaults.cache[key] = defaults
+
+    model = module.new()
+    model.assign(_pysam_defaults.cache[key])
+
+    return model
+
+
 
 #%%
 def calc_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt=True, batt_simple_dispatch=0):
     """
-    Executes Battwatts, Utilityrate5, and Cashloan PySAM modules with system sizes (kw) as input
+    Executes Battwatts, Utilityrate5, and Cashloan PySAM modules with system sizes (kw) as input.
+    See evaluate_system_performance.
+
+    Returns
+    -------
+    -npv: the negative net present value of system + storage to be optimized for system sizing
+    """
+    return -evaluate_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt, batt_simple_dispatch)['npv']
+
+
+def evaluate_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt=True, batt_simple_dispatch=0):
+    """
+    Executes Battwatts, Utilityrate5, and Cashloan PySAM modules with system sizes (kw) as input.
+    See setup_system_performance for the parameters.
+
+    Returns
+    -------
+    outputs : 'dict'
+        Cashloan outputs in cFuncs.CASHLOAN_OUTPUTS, from loan.execute() or the cash flow engine (see execute_cashloan),
+        first year bills with and without the system and annual_energy_kwh
+    """
+    utilityrate, loan, agent, system_gen, net_billing_sell_rate, value_of_resiliency = setup_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt, batt_simple_dispatch)
+
+    # Execute utility rate module, or the vectorized bill engine (config.BILL_BACKEND)
+    bills = calc_utility_bills(utilityrate, agent, system_gen, pv['consumption_hourly'], net_billing_sell_rate)
+
+    # Add value_of_resiliency -- should only apply from year 1 onwards, not to year 0
+    annual_energy_value = ([bills['annual_energy_value'][0]] + 
+                           [x + value_of_resiliency for i,x in enumerate(bills['annual_energy_value']) if i!=0])
+    loan.SystemOutput.annual_energy_value = annual_energy_value 
+    loan.SystemOutput.gen = to_pysam_array(system_gen)
+    loan.ThirdPartyOwnership.elec_cost_with_system = bills['elec_cost_with_system']
+    loan.ThirdPartyOwnership.elec_cost_without_system = bills['elec_cost_without_system']
+    
+    # Execute financial module, or the vectorized cash flow engine (config.CASHFLOW_BACKEND)
+    outputs = execute_cashloan(loan, agent)
+
+    # system outputs, kept here rather than read back from the PySAM modules
+    outputs['elec_cost_with_system_year1'] = bills['elec_cost_with_system'][1]
+    outputs['elec_cost_without_system_year1'] = bills['elec_cost_without_system'][1]
+    outputs['annual_energy_kwh'] = float(np.sum(system_gen))
+
+    return outputs
+
+
+def setup_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt=True, batt_simple_dispatch=0):
+    """
+    Run Battwatts and apply any rate switch for a system size (kw), and assign every Cashloan 
+    input that does not depend on the electricity bills
     
     Parameters
     ----------
@@ -46,28 +146,31 @@ def calc_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_
 
     Returns
     -------
-    -loan.Outputs.npv: the negative net present value of system + storage to be optimized for system sizing
+    'tuple'
+        (utilityrate, loan, agent, system_gen, net_billing_sell_rate, value_of_resiliency): the agent and 
+        its Utilityrate5 model on the tariff after any rate switch, and the hourly generation net of any battery [kWh]
     """
 
     inv_eff = 0.96  # default SAM inverter efficiency for PV
     gen_hourly = pv['generation_hourly']
     load_hourly = pv['consumption_hourly']  # same field as 'load_kwh_per_customer_in_bin_initial' when summed
 
-    dc = [(i * kw) * 1000 for i in gen_hourly] # W
-    ac = [i * inv_eff for i in dc] # W
-    gen = [i / 1000 for i in ac] # W to kW
+    # hourly arrays are float64 numpy arrays, converted once where assigned to PySAM (see to_pysam_array)
+    dc = gen_hourly * (kw * 1000.) # W
+    ac = dc * inv_eff # W
+    gen = ac / 1000. # W to kW
     
     # Set up battery, with system generation conditional on the battery generation being included
     if en_batt:
 
-        batt.Battery.dc = dc
-        batt.Battery.ac = ac
+        batt.Battery.dc = to_pysam_array(dc)
+        batt.Battery.ac = to_pysam_array(ac)
         batt.Battery.batt_simple_enable = 1
         batt.Battery.batt_simple_chemistry = 1  # default value is 1: li ion for residential
         batt.Battery.batt_simple_dispatch = batt_simple_dispatch
         batt.Battery.batt_simple_meter_position = 0  # default value
         batt.Battery.inverter_efficiency = 100  # recommended by Darice for dc-connected
-        batt.Battery.load = load_hourly
+        batt.Battery.load = to_pysam_array(load_hourly)
 
         # PV to Battery ratio (kW) - From Ashreeta, 02/08/2020
         pv_to_batt_ratio = 1.31372
@@ -119,8 +222,8 @@ def calc_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_
         else:
             net_billing_sell_rate = agent.loc['wholesale_elec_price_dollars_per_kwh'] * agent.loc['elec_price_multiplier']
         
-        utilityrate = process_tariff(utilityrate, agent.loc['tariff_dict'], net_billing_sell_rate)
-        utilityrate.SystemOutput.gen = batt.Outputs.gen
+        utilityrate = process_tariff(utilityrate, agent.loc['tariff_dict'], net_billing_sell_rate, agent.loc['tariff_id'])
+        system_gen = batt.Outputs.gen
 
         loan.BatterySystem.en_batt = 1
         loan.BatterySystem.batt_computed_bank_capacity = batt.Outputs.batt_bank_installed_capacity
@@ -196,16 +299,10 @@ def calc_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_
         else:
             net_billing_sell_rate = agent.loc['wholesale_elec_price_dollars_per_kwh'] * agent.loc['elec_price_multiplier']
         
-        utilityrate = process_tariff(utilityrate, agent.loc['tariff_dict'], net_billing_sell_rate)
-        utilityrate.SystemOutput.gen = gen
+        utilityrate = process_tariff(utilityrate, agent.loc['tariff_dict'], net_billing_sell_rate, agent.loc['tariff_id'])
+        system_gen = gen
 
-        loan.BatterySystem.en_batt = 1
-        
-        # specify number of O&M types (0 = PV only)
-        loan.SystemCosts.add_om_num_types = 0
-        # since battery system size is zero, specify standalone PV O&M costs
-        loan.SystemCosts.om_capacity = [costs['system_om_per_kw'] + costs['system_variable_om_per_kw']]
-        loan.SystemCosts.om_replacement_cost1 = [0.]
+        loan = assign_pv_only_costs(loan, costs)
         
         system_costs = costs['system_capex_per_kw'] * kw
 
@@ -216,23 +313,10 @@ def calc_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_
 
         value_of_resiliency = 0.
 
-    # Execute utility rate module
-    utilityrate.Load.load = load_hourly
-    #utilityrate.ElectricityRates.ur_metering_option = ur_metering_option
-    
-    utilityrate.execute()
-
     loan = process_incentives(loan, kw, computed_power, computed_size, gen_hourly, agent)
     
     # Specify final Cashloan parameters
     loan.FinancialParameters.system_capacity = kw
-    # Add value_of_resiliency -- should only apply from year 1 onwards, not to year 0
-    annual_energy_value = ([utilityrate.Outputs.annual_energy_value[0]] + 
-                           [x + value_of_resiliency for i,x in enumerate(utilityrate.Outputs.annual_energy_value) if i!=0])
-    loan.SystemOutput.annual_energy_value = annual_energy_value 
-    loan.SystemOutput.gen = utilityrate.SystemOutput.gen
-    loan.ThirdPartyOwnership.elec_cost_with_system = utilityrate.Outputs.elec_cost_with_system
-    loan.ThirdPartyOwnership.elec_cost_without_system = utilityrate.Outputs.elec_cost_without_system
 
     # Calculate system costs
     #system_costs = costs['system_capex_per_kw'] * kw
@@ -240,14 +324,422 @@ def calc_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_
 
     sales_tax = 0.
     loan.SystemCosts.total_installed_cost = direct_costs + linear_constant + sales_tax + one_time_charge
+
+    return utilityrate, loan, agent, system_gen, net_billing_sell_rate, value_of_resiliency
+
+
+def assign_pv_only_costs(loan, costs):
+    """
+    Assign the Cashloan system cost inputs of a system without battery
+    """
+    loan.BatterySystem.en_batt = 1
     
-    # Execute financial module 
+    # specify number of O&M types (0 = PV only)
+    loan.SystemCosts.add_om_num_types = 0
+    # since battery system size is zero, specify standalone PV O&M costs
+    loan.SystemCosts.om_capacity = [costs['system_om_per_kw'] + costs['system_variable_om_per_kw']]
+    loan.SystemCosts.om_replacement_cost1 = [0.]
+
+    return loan
+
+
+#%%
+def execute_cashloan(loan, agent):
+    """
+    Calculate the Cashloan outputs dGen uses with the backend set by config.CASHFLOW_BACKEND:
+    'pysam' runs loan.execute(), 'numpy' runs the cash flow engine in cashflow_functions.
+
+    With the numpy backend, a fraction config.CASHFLOW_VALIDATION_SAMPLE_FRAC of calls also runs
+    loan.execute() and logs outputs that differ by more than config.CASHFLOW_VALIDATION_TOLERANCE.
+    Cashloan does not run without a system (system_capacity of 0), so with the pysam backend a 0 kW 
+    system, e.g. the first point of the grid search, has the outputs of cFuncs.get_no_system_outputs: 
+    an NPV of 0 and no payback.
+
+    Parameters
+    ----------
+    loan : 'PySAM.Cashloan'
+        Cashloan model with all inputs assigned
+    agent : 'pd.Series'
+        Individual agent object
+
+    Returns
+    -------
+    outputs : 'dict'
+        Outputs in cFuncs.CASHLOAN_OUTPUTS
+    """
+    if config.CASHFLOW_BACKEND == 'numpy':
+        outputs = cFuncs.calc_cashloan_outputs_single(loan)
+
+        if sample_validation(config.CASHFLOW_VALIDATION_SAMPLE_FRAC):
+            loan.execute()
+            cFuncs.validate_cashloan_outputs(outputs, loan, config.CASHFLOW_VALIDATION_TOLERANCE, 
+                                             label='for agent {a} at {kw:.2f} kW'.format(a=agent.loc['agent_id'], kw=loan.FinancialParameters.system_capacity))
+
+        return outputs
+
+    elif config.CASHFLOW_BACKEND != 'pysam':
+        raise ValueError("Invalid CASHFLOW_BACKEND: {}. Valid options are 'pysam' and 'numpy'".format(config.CASHFLOW_BACKEND))
+
+    if loan.FinancialParameters.system_capacity <= 0:
+        return cFuncs.get_no_system_outputs(loan.FinancialParameters.analysis_period)
+
     loan.execute()
 
-    return -loan.Outputs.npv
+    return {output: getattr(loan.Outputs, output) for output in cFuncs.CASHLOAN_OUTPUTS}
+
+
+#%%
+def to_pysam_array(values):
+    """
+    Convert an hourly numpy array to the list PySAM modules take, in one pass in C rather than 
+    element by element. Sequences already in PySAM form (e.g. module outputs) are returned as is.
+    """
+    if isinstance(values, np.ndarray):
+        return values.tolist()
+
+    return values
+
+
+def calc_utility_bills(utilityrate, agent, system_gen, load_hourly, net_billing_sell_rate):
+    """
+    Calculate the agent's electricity bills over the analysis period with the backend set by 
+    config.BILL_BACKEND: 'pysam' runs Utilityrate5, 'numpy' runs the vectorized bill engine 
+    in tariff_functions. Tariffs the vectorized engine does not support are run with Utilityrate5.
+
+    With the numpy backend, a fraction config.BILL_VALIDATION_SAMPLE_FRAC of calls also runs
+    Utilityrate5 and logs the difference in first year bills.
+
+    Parameters
+    ----------
+    utilityrate : 'PySAM.Utilityrate5'
+        Utilityrate5 model of the agent, with its tariff assigned
+    agent : 'pd.Series'
+        Individual agent object
+    system_gen : 'numpy.ndarray'
+        Hourly generation of the system, net of any battery [kWh]
+    load_hourly : 'numpy.ndarray'
+        Hourly load [kWh]
+    net_billing_sell_rate : 'float'
+        Sell rate for exported generation [$/kWh]
+
+    Returns
+    -------
+    bills : 'dict'
+        annual_energy_value, elec_cost_with_system and elec_cost_without_system by year, 
+        indexed as the Utilityrate5 outputs (year 0 first)
+    """
+    if config.BILL_BACKEND == 'numpy':
+        compiled = get_compiled_tariff(agent.loc['tariff_id'], agent.loc['tariff_dict'])
+        if 'bill_arrays' not in compiled:
+            compiled['bill_arrays'] = tFuncs.compile_bill_arrays(agent.loc['tariff_dict'])
+
+        if compiled['bill_arrays'] is not None:
+            bills = calc_utility_bills_numpy(compiled['bill_arrays'], agent, system_gen, load_hourly, net_billing_sell_rate)
+
+            if sample_validation(config.BILL_VALIDATION_SAMPLE_FRAC):
+                validate_utility_bills(bills, calc_utility_bills_pysam(utilityrate, system_gen, load_hourly), agent)
+
+            return bills
+
+    elif config.BILL_BACKEND != 'pysam':
+        raise ValueError("Invalid BILL_BACKEND: {}. Valid options are 'pysam' and 'numpy'".format(config.BILL_BACKEND))
+
+    return calc_utility_bills_pysam(utilityrate, system_gen, load_hourly)
+
+
+def sample_validation(sample_frac):
+    """
+    Draw whether to validate an evaluation, with probability sample_frac. Draws come from the 
+    seeded _validation_rng, and none is drawn if sample_frac is 0.
+    """
+    if sample_frac <= 0:
+        return False
+
+    return _validation_rng.random_sample() < sample_frac
+
+
+def calc_utility_bills_pysam(utilityrate, system_gen, load_hourly):
+    """
+    Execute the Utilityrate5 module, see calc_utility_bills
+    """
+    utilityrate.SystemOutput.gen = to_pysam_array(system_gen)
+    utilityrate.Load.load = to_pysam_array(load_hourly)
+
+    utilityrate.execute()
+
+    return {'annual_energy_value': utilityrate.Outputs.annual_energy_value,
+            'elec_cost_with_system': utilityrate.Outputs.elec_cost_with_system,
+            'elec_cost_without_system': utilityrate.Outputs.elec_cost_without_system}
+
+
+def calc_utility_bills_numpy(bill_arrays, agent, system_gen, load_hourly, net_billing_sell_rate):
+    """
+    Calculate the bills of every year of the analysis period in one call to tFuncs.calc_annual_bills.
+    As in Utilityrate5, generation degrades by pv_degradation_factor per year and rates escalate 
+    by inflation plus elec_price_escalator per year. See calc_utility_bills.
+    """
+    bills = calc_utility_bills_numpy_batch(bill_arrays, agent, np.asarray(system_gen, dtype='float64')[np.newaxis, :], load_hourly, net_billing_sell_rate)
+
+    return {output: list(values[0]) for output, values in bills.items()}
+
+
+def calc_utility_bills_numpy_batch(bill_arrays, agent, system_gens, load_hourly, net_billing_sell_rate):
+    """
+    Calculate the bills of every year of the analysis period for many generation profiles of one agent
+    in one call to tFuncs.calc_annual_bills, see calc_utility_bills_numpy.
+
+    Parameters
+    ----------
+    system_gens : 'numpy.ndarray'
+        (n x 8760) hourly generation of each system [kWh]
+
+    Returns
+    -------
+    bills : 'dict'
+        (n x analysis_period + 1) arrays of annual_energy_value, elec_cost_with_system and 
+        elec_cost_without_system by year (year 0 first)
+    """
+    n_years = int(agent.loc['economic_lifetime_yrs'])
+    years = np.arange(n_years)
+    gen_scale = (1. - agent.loc['pv_degradation_factor']) ** years
+    rate_scale = (1. + agent.loc['inflation_rate'] + agent.loc['elec_price_escalator']) ** years
+
+    load_hourly = np.asarray(load_hourly, dtype='float64')
+    system_gens = np.asarray(system_gens, dtype='float64')
+    n_systems = system_gens.shape[0]
+
+    bill_args = dict(bill_arrays = bill_arrays,
+                     metering_option = NEM_OPTIONS[agent.loc['compensation_style']],
+                     sell_rate = net_billing_sell_rate,
+                     yearend_sell_rate = agent.loc['wholesale_elec_price_dollars_per_kwh'] * agent.loc['elec_price_multiplier'])
+
+    # one row per system and year
+    gen = (gen_scale[np.newaxis, :, np.newaxis] * system_gens[:, np.newaxis, :]).reshape(n_systems * n_years, -1)
+    bill_with_system = tFuncs.calc_annual_bills(np.broadcast_to(load_hourly, gen.shape), gen, **bill_args).reshape(n_systems, n_years)
+    bill_without_system = tFuncs.calc_annual_bills(load_hourly[np.newaxis, :], np.zeros((1, load_hourly.size)), **bill_args)
+
+    elec_cost_with_system = np.zeros((n_systems, n_years + 1))
+    elec_cost_with_system[:, 1:] = bill_with_system * rate_scale
+    elec_cost_without_system = np.zeros((n_systems, n_years + 1))
+    elec_cost_without_system[:, 1:] = bill_without_system[0] * rate_scale
+
+    return {'annual_energy_value': elec_cost_without_system - elec_cost_with_system,
+            'elec_cost_with_system': elec_cost_with_system,
+            'elec_cost_without_system': elec_cost_without_system}
+
+
+def validate_utility_bills(bills, pysam_bills, agent):
+    """
+    Log the difference in first year bills between the numpy and Utilityrate5 backends
+    """
+    for output in ['elec_cost_with_system', 'elec_cost_without_system']:
+        numpy_bill = bills[output][1]
+        pysam_bill = pysam_bills[output][1]
+        rel_diff = abs(numpy_bill - pysam_bill) / max(abs(pysam_bill), 1.)
+        if rel_diff > config.BILL_VALIDATION_TOLERANCE:
+            logger.warning('Bill engine mismatch for agent {a} on tariff {t}: {o} year 1 numpy {n:.2f} vs pysam {p:.2f}'
+                           .format(a=agent.loc['agent_id'], t=agent.loc['tariff_id'], o=output, n=numpy_bill, p=pysam_bill))
+
+
+#%%
+# Cashloan outputs kept for each objective evaluation
+SIZING_LOAN_OUTPUTS = cFuncs.CASHLOAN_OUTPUTS
+
+
+def calc_system_performance_cached(kw, evaluations, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt=True, batt_simple_dispatch=0):
+    """
+    calc_system_performance memoized per agent. Each evaluation is stored in evaluations keyed by 
+    (kw rounded to config.SIZING_EVAL_CACHE_DECIMALS, en_batt) together with the PySAM outputs 
+    used to report the chosen system, so a repeated point costs nothing.
+
+    Returns
+    -------
+    -npv: the negative net present value of system + storage to be optimized for system sizing
+    """
+    return get_cached_evaluation(kw, evaluations, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt, batt_simple_dispatch)['neg_npv']
+
+
+def get_cached_evaluation(kw, evaluations, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt=True, batt_simple_dispatch=0):
+    """
+    Return the stored evaluation of calc_system_performance at (kw, en_batt), running it if not yet evaluated.
+
+    Returns
+    -------
+    outputs : 'dict'
+        neg_npv, the Cashloan outputs in SIZING_LOAN_OUTPUTS, first year bills with and without the system, 
+        annual_energy_kwh and, with battery, batt_kw, batt_kwh and batt_dispatch_profile
+    """
+    key = (round(kw, config.SIZING_EVAL_CACHE_DECIMALS), en_batt)
+    if key in evaluations:
+        return evaluations[key]
+
+    loan_outputs = evaluate_system_performance(kw, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt, batt_simple_dispatch)
+
+    outputs = {'neg_npv': -loan_outputs['npv']}
+    for output in SIZING_LOAN_OUTPUTS:
+        outputs[output] = loan_outputs[output]
+    outputs['elec_cost_with_system_year1'] = loan_outputs['elec_cost_with_system_year1']
+    outputs['elec_cost_without_system_year1'] = loan_outputs['elec_cost_without_system_year1']
+    outputs['annual_energy_kwh'] = loan_outputs['annual_energy_kwh']
+
+    if en_batt:
+        outputs['batt_kw'] = batt.Battery.batt_simple_kw
+        outputs['batt_kwh'] = batt.Battery.batt_simple_kwh
+        outputs['batt_dispatch_profile'] = np.array(batt.Outputs.batt_power, dtype=config.HOURLY_PROFILE_DTYPE)
+
+    evaluations[key] = outputs
+
+    return outputs
+
+
+#%%
+# Agent attributes read by calc_system_size_and_performance. Agents with equal values of these are 
+# sized once, see get_sizing_dedupe_cols. tariff_id stands in for tariff_dict, 
+# and state_abbr and sector_abbr for the state incentives compiled per state and sector.
+SIZING_INPUT_COLS = ['bldg_id', 'sector_abbr', 'state_abbr', 'load_kwh_per_customer_in_bin', 'load_profile_idx',
+                     'solar_re_9809_gid', 'tilt', 'azimuth', 'solar_cf_idx',
+                     'tariff_id', 'eia_id', 'compensation_style',
+                     'wholesale_elec_price_dollars_per_kwh', 'elec_price_multiplier', 'elec_price_escalator',
+                     'inflation_rate', 'economic_lifetime_yrs', 'pv_degradation_factor',
+                     'developable_roof_sqft', 'pv_kw_per_sqft',
+                     'down_payment_fraction', 'loan_interest_rate', 'loan_term_yrs', 'real_discount_rate',
+                     'tax_rate', 'itc_fraction_of_capex', 'batt_lifetime_yrs', 'value_of_resiliency_usd',
+                     'system_capex_per_kw', 'system_om_per_kw', 'system_variable_om_per_kw', 'cap_cost_multiplier',
+                     'batt_capex_per_kw', 'batt_capex_per_kwh', 'batt_om_per_kw', 'batt_om_per_kwh', 'linear_constant',
+                     'system_capex_per_kw_combined', 'batt_capex_per_kw_combined', 'batt_capex_per_kwh_combined',
+                     'batt_om_per_kw_combined', 'batt_om_per_kwh_combined', 'linear_constant_combined',
+                     'system_kw_with_batt_last_year', 'system_kw_no_batt_last_year', 'sizing_screened_out',
+                     'sizing_fidelity']
+
+# Warm start inputs, see apply_sizing_warm_start
+SIZING_WARM_START_COLS = ['system_kw_with_batt_last_year', 'system_kw_no_batt_last_year']
+
+# Sizing settings, which set how an agent's optimal system is searched for, see screen_sizing_agents and assign_sizing_fidelity
+SIZING_SETTING_COLS = ['sizing_screened_out', 'sizing_fidelity']
+
+# Attributes returned by calc_system_size_and_performance
+SIZING_OUTPUT_COLS = ['agent_id',
+                      'system_kw',
+                      'batt_kw',
+                      'batt_kwh',
+                      'npv',
+                      'payback_period',
+                      'cash_flow',
+                      'batt_dispatch_profile',
+                      'annual_energy_production_kwh',
+                      'naep',
+                      'capacity_factor',
+                      'first_year_elec_bill_with_system',
+                      'first_year_elec_bill_savings',
+                      'first_year_elec_bill_savings_frac',
+                      'max_system_kw',
+                      'first_year_elec_bill_without_system',
+                      'avg_elec_price_cents_per_kwh',
+                      'cbi',
+                      'ibi',
+                      'pbi',
+                      'cash_incentives',
+                      'export_tariff_results',
+                      'system_kw_with_batt',
+                      'system_kw_no_batt',
+                      'sizing_evaluations']
+
+
+# Positions of profiles in this run's stores; the profiles are identified by their keys in SIZING_INPUT_COLS
+SIZING_RUN_LOCAL_COLS = ['load_profile_idx', 'solar_cf_idx']
+
+# config settings that change sizing results
+SIZING_CONFIG_SETTINGS = ['BILL_BACKEND', 'CASHFLOW_BACKEND', 'SIZING_METHOD', 'SIZING_GRID_POINTS', 'SIZING_WARM_START',
+                          'SIZING_WARM_START_BRACKET_FRAC', 'SIZING_EVAL_CACHE_DECIMALS', 'HOURLY_PROFILE_DTYPE', 'SIZING_FIDELITY_TIERS']
+
+_sizing_code_version = None
+
+
+def get_sizing_code_version():
+    """
+    Hash of the source of the modules used in sizing, the PySAM, pandas and numpy versions (cached 
+    results are pickled pandas objects) and the config settings that change sizing results. Part of every sizing cache key, so that cached results are not 
+    reused after any of these change.
+    """
+    global _sizing_code_version
+    if _sizing_code_version is None:
+        code_hash = hashlib.sha256()
+        for module_file in [__file__, tFuncs.__file__, cFuncs.__file__, agent_mutation.elec.__file__]:
+            with open(os.path.abspath(module_file), 'rb') as f:
+                code_hash.update(f.read())
+        for version in [PySAM.__version__, pd.__version__, np.__version__]:
+            code_hash.update(str(version).encode('utf-8'))
+        code_hash.update(repr([getattr(config, setting, None) for setting in SIZING_CONFIG_SETTINGS]).encode('utf-8'))
+        _sizing_code_version = code_hash.hexdigest()
+
+    return _sizing_code_version
+
+
+def get_sizing_data_source(model_settings):
+    """
+    Identifier of the input data the agents and their profiles are read from, part of every sizing 
+    cache key: the database, and config.SIZING_CACHE_DATA_VERSION, which labels versions of its data
+
+    Parameters
+    ----------
+    model_settings : 'settings.ModelSettings'
+        Model settings, with the database connection parameters
+
+    Returns
+    -------
+    data_source : 'dict'
+    """
+    pg_params = model_settings.pg_params
+
+    return {'host': pg_params.get('host'), 'port': pg_params.get('port'), 'dbname': pg_params.get('dbname'),
+            'data_version': config.SIZING_CACHE_DATA_VERSION}
+
+
+def get_agent_rate_switch_entries(rate_switch_table, agent):
+    """
+    Rate switch entries of the agent's utility and sector, solar first and storage second. Entries 
+    are those of the index built by agent_mutation.elec.index_rate_switch_table, or rows of the rate switch table.
+    """
+    res_com = str(agent.loc['sector_abbr']).upper()[0]
+
+    if rate_switch_table is None:
+        return None
+    elif isinstance(rate_switch_table, dict):
+        return [rate_switch_table.get((tech, agent.loc['eia_id'], res_com)) for tech in ['solar', 'storage']]
+
+    rows = rate_switch_table.loc[(rate_switch_table['eia_id'] == agent.loc['eia_id']) & (rate_switch_table['res_com'] == res_com)]
+
+    return [rows.loc[rows['tech'] == tech].sort_values('min_kw_limit', kind='mergesort').to_dict('records') for tech in ['solar', 'storage']]
 
 
-def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
+def get_sizing_cache_key(agent, sectors, rate_switch_table=None, data_source=None):
+    """
+    Key of an agent's sizing results in a utilfunc.DiskCache, from every input calc_system_size_and_performance reads
+
+    Parameters
+    ----------
+    agent : 'pd.Series'
+        Individual agent object
+    sectors : 'dict'
+        Sectors of the scenario
+    rate_switch_table : 'dict'
+        Rate switch index or table, see calc_system_size_and_performance. Only the entries of the 
+        agent's utility and sector are part of the key
+    data_source : 'dict'
+        Identifier of the input data, see get_sizing_data_source
+
+    Returns
+    -------
+    key : 'str'
+    """
+    inputs = {col: agent.get(col) for col in SIZING_INPUT_COLS if col not in SIZING_RUN_LOCAL_COLS}
+
+    return utilfunc.DiskCache.make_key(get_sizing_code_version(), data_source, inputs, sectors,
+                                       agent.loc['tariff_dict'], agent.get('state_incentives'),
+                                       get_agent_rate_switch_entries(rate_switch_table, agent))
+
+
+def calc_system_size_and_performance(agent, sectors, rate_switch_table=None, load_profiles=None, solar_cf_profiles=None, sizing_cache=None, data_source=None):
     """
     Calculate the optimal system and battery size and generation profile, and resulting bill savings and financial metrics.
     
@@ -255,6 +747,19 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
     ----------
     agent : 'pd.df'
         individual agent object.
+    load_profiles : 'hourly_profiles.HourlyProfiles'
+        Normalized load profiles keyed by (bldg_id, sector_abbr, state_abbr), see 
+        agent_mutation.elec.get_agent_load_profiles_bulk. Agents index into the store with 
+        their load_profile_idx column; agents with an index of -1 are queried per agent.
+    solar_cf_profiles : 'hourly_profiles.ProfileCache'
+        Decoded solar capacity factor profiles keyed by (solar_re_9809_gid, tilt, azimuth).
+        Agents index into the prefetched store with their solar_cf_idx column; 
+        other profiles are queried per agent and cached.
+    sizing_cache : 'utilfunc.DiskCache'
+        Cache of sizing results shared across runs, keyed by get_sizing_cache_key. Agents found in 
+        the cache are not sized again.
+    data_source : 'dict'
+        Identifier of the input data in the sizing cache keys, see get_sizing_data_source
 
     Returns
     -------
@@ -282,40 +787,150 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
         - pbi - ndarray of performance-based incentives applicable to agent
         - cash_incentives - ndarray of cash-based incentives applicable to agent
         - export_tariff_result - summary of structure of retail tariff applied to agent
+        - system_kw_with_batt - optimal system capacity with battery, used to warm start next year's sizing
+        - system_kw_no_batt - optimal system capacity without battery, used to warm start next year's sizing
+        - sizing_evaluations - number of system sizes evaluated
+    """
+    if sizing_cache is not None:
+        cache_key, cached = get_cached_sizing_results(agent, sectors, sizing_cache, rate_switch_table, data_source)
+        if cached is not None:
+            return cached
+
+    sizing = setup_system_sizing(agent, load_profiles, solar_cf_profiles)
+    agent = size_system(sizing, rate_switch_table)
+
+    if sizing_cache is not None:
+        sizing_cache.set(cache_key, agent)
+
+    return agent
+
+
+def calc_system_size_and_performance_chunk(agent_chunk, sectors, rate_switch_table=None, load_profiles=None, solar_cf_profiles=None, sizing_cache=None, data_source=None):
+    """
+    Apply calc_system_size_and_performance to every agent of a chunk of the agent dataframe, see agents.apply_func_to_chunk.
+
+    With grid search sizing and the vectorized engines (see use_batched_grid), the grid points of 
+    config.SIZING_GRID_BATCH_AGENTS agents at a time are evaluated together in one batch before
+    each agent's grid search, see evaluate_system_grids.
+
+    Returns
+    -------
+    results_df : 'pd.df'
+        One row of SIZING_OUTPUT_COLS per agent, indexed as agent_chunk
+    """
+    batched_grid = config.SIZING_METHOD == 'grid' and use_batched_grid()
+    batch_size = max(int(config.SIZING_GRID_BATCH_AGENTS) if batched_grid else len(agent_chunk), 1)
+
+    results = []
+    for start in range(0, len(agent_chunk), batch_size):
+        batch = []
+        for _, agent in agent_chunk.iloc[start:start + batch_size].iterrows():
+            cache_key = None
+            if sizing_cache is not None:
+                cache_key, cached = get_cached_sizing_results(agent, sectors, sizing_cache, rate_switch_table, data_source)
+                if cached is not None:
+                    batch.append((cached, None, None))
+                    continue
+
+            batch.append((None, setup_system_sizing(agent, load_profiles, solar_cf_profiles), cache_key))
+
+        if batched_grid:
+            grids = []
+            for _, sizing, _ in batch:
+                if sizing is not None and not sizing['agent'].get('sizing_screened_out', False):
+                    grid = get_sizing_grid(sizing['max_system_kw'])
+                    grids += [(grid, get_sizing_args(sizing, rate_switch_table, en_batt)) for en_batt in [True, False]]
+            evaluate_system_grids(grids)
+
+        for cached, sizing, cache_key in batch:
+            if sizing is None:
+                results.append(cached)
+                continue
+
+            agent = size_system(sizing, rate_switch_table)
+            if sizing_cache is not None:
+                sizing_cache.set(cache_key, agent)
+            results.append(agent)
+
+    return pd.DataFrame(results)
+
+
+def get_cached_sizing_results(agent, sectors, sizing_cache, rate_switch_table=None, data_source=None):
     """
+    Look up the agent's sizing results in sizing_cache
 
+    Returns
+    -------
+    'tuple'
+        (cache_key, results): the key of the agent's results, see get_sizing_cache_key, and the 
+        results of calc_system_size_and_performance for the agent, None if not cached
+    """
+    cache_key = get_sizing_cache_key(agent, sectors, rate_switch_table, data_source)
+    cached = sizing_cache.get(cache_key)
+    if cached is not None:
+        cached.loc['agent_id'] = agent.loc['agent_id']
+        cached.name = agent.name
+
+    return cache_key, cached
 
-    # Initialize new DB connection    
-    model_settings = settings.init_model_settings()
-    con, cur = utilfunc.make_con(model_settings.pg_conn_string, model_settings.role)
 
+def setup_system_sizing(agent, load_profiles=None, solar_cf_profiles=None):
+    """
+    Load the agent's hourly profiles and set up its PySAM modules, costs and sizing bounds, 
+    see calc_system_size_and_performance
+
+    Returns
+    -------
+    sizing : 'dict'
+        agent, pv, utilityrate, loan, batt, costs, max_system_kw, tol and the agent's objective
+        evaluations, see size_system
+    """
     # PV
     pv = dict()
     
-    load_profile_df = agent_mutation.elec.get_and_apply_agent_load_profiles(con, agent)
+    load_profile_idx = int(agent.get('load_profile_idx', -1))
+    if load_profiles is not None and load_profile_idx >= 0:
+        pv['consumption_hourly'] = load_profiles.column(load_profile_idx).astype('float64') * np.float64(agent.loc['load_kwh_per_customer_in_bin'])
+    else:
+        # Database connection of this worker, opened on first use and reused across agents
+        con, cur = agents.get_worker_connection()
+        load_profile_df = agent_mutation.elec.get_and_apply_agent_load_profiles(con, agent)
 
-    pv['consumption_hourly'] = pd.Series(load_profile_df['consumption_hourly']).iloc[0]
-    del load_profile_df
+        pv['consumption_hourly'] = pd.Series(load_profile_df['consumption_hourly']).iloc[0]
+        del load_profile_df
 
     # Using the scale offset factor of 1E6 for capacity factors
-    norm_scaled_pv_cf_profiles_df = agent_mutation.elec.get_and_apply_normalized_hourly_resource_solar(con, agent)
-    pv['generation_hourly'] = pd.Series(norm_scaled_pv_cf_profiles_df['solar_cf_profile'].iloc[0]) /  1e6
-    del norm_scaled_pv_cf_profiles_df
+    def load_solar_cf_profile():
+        con, cur = agents.get_worker_connection()
+        norm_scaled_pv_cf_profiles_df = agent_mutation.elec.get_and_apply_normalized_hourly_resource_solar(con, agent)
+        return np.array(norm_scaled_pv_cf_profiles_df['solar_cf_profile'].iloc[0], dtype='float64') / 1e6
+
+    solar_cf_idx = int(agent.get('solar_cf_idx', -1))
+    if solar_cf_profiles is not None and solar_cf_idx >= 0:
+        pv['generation_hourly'] = solar_cf_profiles.store.column(solar_cf_idx).astype('float64')
+    elif solar_cf_profiles is not None:
+        solar_cf_key = (agent.loc['solar_re_9809_gid'], agent.loc['tilt'], agent.loc['azimuth'])
+        pv['generation_hourly'] = solar_cf_profiles.get(solar_cf_key, load_solar_cf_profile)
+    else:
+        pv['generation_hourly'] = load_solar_cf_profile()
     
+    # contiguous float64 arrays for the vectorized generation and bill calculations
+    pv['consumption_hourly'] = np.ascontiguousarray(pv['consumption_hourly'], dtype='float64')
+    pv['generation_hourly'] = np.ascontiguousarray(pv['generation_hourly'], dtype='float64')
+
     agent.loc['naep'] = float(np.sum(pv['generation_hourly']))
 
     # Battwatts
     if agent.loc['sector_abbr'] == 'res':
-        batt = battery.default("PVWattsBatteryResidential")
+        batt = get_pysam_module(battery, "PVWattsBatteryResidential")
     else:
-        batt = battery.default("PVWattsBatteryCommercial")
+        batt = get_pysam_module(battery, "PVWattsBatteryCommercial")
 
     # Instantiate utilityrate5 model based on agent sector
     if agent.loc['sector_abbr'] == 'res':
-        utilityrate = utility.default("PVWattsBatteryResidential")
+        utilityrate = get_pysam_module(utility, "PVWattsBatteryResidential")
     else:
-        utilityrate = utility.default("PVWattsBatteryCommercial")
-    tariff_dict = agent.loc['tariff_dict']
+        utilityrate = get_pysam_module(utility, "PVWattsBatteryCommercial")
     
 
     ######################################
@@ -354,10 +969,8 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
     ###---- NET METERING SETTINGS -----###
     ######################################
     
-    # Dictionary to map dGen compensation styles to PySAM options
-    nem_options = {'net metering':0, 'net billing':2, 'buy all sell all':4, 'none':2}
     # Metering options [0=net energy metering,1=net energy metering with $ credits,2=net billing,3=net billing with carryover to next month,4=buy all - sell all]
-    utilityrate.ElectricityRates.ur_metering_option = nem_options[agent.loc['compensation_style']]
+    utilityrate.ElectricityRates.ur_metering_option = NEM_OPTIONS[agent.loc['compensation_style']]
     # Year end sell rate [$/kWh]
     utilityrate.ElectricityRates.ur_nm_yearend_sell_rate = agent.loc['wholesale_elec_price_dollars_per_kwh'] * agent.loc['elec_price_multiplier']
 
@@ -510,7 +1123,7 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
     ###--------- UTILITYRATE5 ---------###
     ###----- TARIFF RESTRUCTURING -----###
     ######################################
-    utilityrate = process_tariff(utilityrate, agent.loc['tariff_dict'], net_billing_sell_rate)
+    utilityrate = process_tariff(utilityrate, agent.loc['tariff_dict'], net_billing_sell_rate, agent.loc['tariff_id'])
     
     
     ######################################
@@ -522,11 +1135,11 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
     # Assume res agents do not evaluate depreciation at all
     # Assume non-res agents only evaluate federal depreciation (not state)
     if agent.loc['sector_abbr'] == 'res':
-        loan = cashloan.default("PVWattsBatteryResidential")
+        loan = get_pysam_module(cashloan, "PVWattsBatteryResidential")
         loan.FinancialParameters.market = 0
 
     else:
-        loan = cashloan.default("PVWattsBatteryCommercial")
+        loan = get_pysam_module(cashloan, "PVWattsBatteryCommercial")
         loan.FinancialParameters.market = 1
 
     loan.FinancialParameters.analysis_period = agent.loc['economic_lifetime_yrs']
@@ -632,107 +1245,114 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
     max_size_roof = agent.loc['developable_roof_sqft'] * agent.loc['pv_kw_per_sqft']
     max_system_kw = min(max_size_load, max_size_roof)
     
-    # set tolerance for minimize_scalar based on max_system_kw value
-    tol = min(0.25 * max_system_kw, 0.5)
+    # set tolerance for minimize_scalar based on max_system_kw value and the agent's fidelity tier, see assign_sizing_fidelity
+    fidelity = config.SIZING_FIDELITY_TIERS[agent.get('sizing_fidelity', 'fine')]
+    tol = min(fidelity['tol_frac'] * max_system_kw, fidelity['max_tol_kw'])
     #tol = 0.25 * max_system_kw
 
+    # Objective evaluations of this agent keyed by (kw, en_batt), see calc_system_performance_cached
+    evaluations = dict()
+
+    return {'agent': agent, 'pv': pv, 'utilityrate': utilityrate, 'loan': loan, 'batt': batt, 'costs': system_costs,
+            'max_system_kw': max_system_kw, 'tol': tol, 'evaluations': evaluations}
+
+
+def get_sizing_args(sizing, rate_switch_table, en_batt):
+    """
+    Arguments of calc_system_performance_cached after kw for an agent set up by setup_system_sizing
+    """
+    return (sizing['evaluations'], sizing['pv'], sizing['utilityrate'], sizing['loan'], sizing['batt'], 
+            sizing['costs'], sizing['agent'], rate_switch_table, en_batt, 0)
+
+
+def size_system(sizing, rate_switch_table):
+    """
+    Find the agent's optimal system with and without battery and report the one with the higher NPV,
+    see calc_system_size_and_performance
+
+    Parameters
+    ----------
+    sizing : 'dict'
+        Agent set up by setup_system_sizing
+    rate_switch_table : 'pd.df'
+        Details on how rates will switch with DG/storage adoption
+
+    Returns
+    -------
+    agent : 'pd.Series'
+        The agent's SIZING_OUTPUT_COLS
+    """
+    agent = sizing['agent']
+    pv, utilityrate, loan, batt, system_costs = sizing['pv'], sizing['utilityrate'], sizing['loan'], sizing['batt'], sizing['costs']
+    max_system_kw, tol, evaluations = sizing['max_system_kw'], sizing['tol'], sizing['evaluations']
+
     # Calculate the PV system size that maximizes the agent's NPV, to a tolerance of 0.5 kW. 
     # Note that the optimization is technically minimizing negative NPV
     # ! As is, because of the tolerance this function would not necessarily return a system size of 0 or max PV size if those are optimal
-    res_with_batt = optimize.minimize_scalar(calc_system_performance,
-                                             args = (pv, utilityrate, loan, batt, system_costs, agent, rate_switch_table, True, 0),
-                                             bounds = (0, max_system_kw),
-                                             method = 'bounded',
-                                             options={'xatol':tol})
-                                             #tol = tol)
-
-    # PySAM Module outputs with battery
-    batt_loan_outputs = loan.Outputs.export()
-    batt_util_outputs = utilityrate.Outputs.export()
-    batt_annual_energy_kwh = np.sum(utilityrate.SystemOutput.gen)
-
-    batt_kw = batt.Battery.batt_simple_kw
-    batt_kwh = batt.Battery.batt_simple_kwh
-    batt_dispatch_profile = batt.Outputs.batt_power 
-
-    # Run without battery
-    res_no_batt = optimize.minimize_scalar(calc_system_performance, 
-                                           args = (pv, utilityrate, loan, batt, system_costs, agent, rate_switch_table, False, 0),
-                                           bounds = (0, max_system_kw),
-                                           method = 'bounded',
-                                           options={'xatol':tol})
-                                        #    tol = tol)
+    if agent.get('sizing_screened_out', False):
+        # no system can reach a positive NPV (see screen_sizing_agents); evaluate the agent without a system
+        res_with_batt = res_no_batt = optimize.OptimizeResult(x=0., success=True, nfev=0)
+        batt_outputs = None
+    else:
+        res_with_batt = optimize_system_size(args = get_sizing_args(sizing, rate_switch_table, True),
+                                             max_system_kw = max_system_kw,
+                                             tol = tol,
+                                             last_system_kw = agent.get('system_kw_with_batt_last_year', np.nan))
 
-    # PySAM Module outputs without battery
-    no_batt_loan_outputs = loan.Outputs.export()
-    no_batt_util_outputs = utilityrate.Outputs.export()
-    no_batt_annual_energy_kwh = np.sum(utilityrate.SystemOutput.gen)
+        # Run without battery
+        res_no_batt = optimize_system_size(args = get_sizing_args(sizing, rate_switch_table, False),
+                                           max_system_kw = max_system_kw,
+                                           tol = tol,
+                                           last_system_kw = agent.get('system_kw_no_batt_last_year', np.nan))
 
-    # Retrieve NPVs of system with batt and system without batt
-    npv_w_batt = batt_loan_outputs['npv']
-    npv_no_batt = no_batt_loan_outputs['npv']
+        # PySAM Module outputs at the optimum with battery
+        batt_outputs = get_cached_evaluation(res_with_batt.x, evaluations, pv, utilityrate, loan, batt, system_costs, agent, rate_switch_table, True, 0)
+
+    # PySAM Module outputs at the optimum without battery
+    no_batt_outputs = get_cached_evaluation(res_no_batt.x, evaluations, pv, utilityrate, loan, batt, system_costs, agent, rate_switch_table, False, 0)
 
     # Choose the system with the higher NPV
-    if npv_w_batt >= npv_no_batt:
+    if batt_outputs is not None and batt_outputs['npv'] >= no_batt_outputs['npv']:
         system_kw = res_with_batt.x
-        annual_energy_production_kwh = batt_annual_energy_kwh
-        first_year_elec_bill_with_system = batt_util_outputs['elec_cost_with_system_year1']
-        first_year_elec_bill_without_system = batt_util_outputs['elec_cost_without_system_year1']
-
-        npv = npv_w_batt
-        payback = batt_loan_outputs['payback']
-        cash_flow = list(batt_loan_outputs['cf_payback_with_expenses']) # ?
-
-        cbi_total = batt_loan_outputs['cbi_total']
-        cbi_total_fed = batt_loan_outputs['cbi_total_fed']
-        cbi_total_oth = batt_loan_outputs['cbi_total_oth']
-        cbi_total_sta = batt_loan_outputs['cbi_total_sta']
-        cbi_total_uti = batt_loan_outputs['cbi_total_uti']
-
-        ibi_total = batt_loan_outputs['ibi_total']
-        ibi_total_fed = batt_loan_outputs['ibi_total_fed']
-        ibi_total_oth = batt_loan_outputs['ibi_total_oth']
-        ibi_total_sta = batt_loan_outputs['ibi_total_sta']
-        ibi_total_uti = batt_loan_outputs['ibi_total_uti']
-
-        cf_pbi_total = batt_loan_outputs['cf_pbi_total']
-        pbi_total_fed = batt_loan_outputs['cf_pbi_total_fed']
-        pbi_total_oth = batt_loan_outputs['cf_pbi_total_oth']
-        pbi_total_sta = batt_loan_outputs['cf_pbi_total_sta']
-        pbi_total_uti = batt_loan_outputs['cf_pbi_total_uti']
+        outputs = batt_outputs
 
+        batt_kw = batt_outputs['batt_kw']
+        batt_kwh = batt_outputs['batt_kwh']
+        batt_dispatch_profile = batt_outputs['batt_dispatch_profile']
 
     else:
         system_kw = res_no_batt.x
-        annual_energy_production_kwh = no_batt_annual_energy_kwh
-        first_year_elec_bill_with_system = no_batt_util_outputs['elec_cost_with_system_year1']
-        first_year_elec_bill_without_system = no_batt_util_outputs['elec_cost_without_system_year1']
-
-        npv = npv_no_batt
-        payback = no_batt_loan_outputs['payback']
-        cash_flow = list(no_batt_loan_outputs['cf_payback_with_expenses'])
+        outputs = no_batt_outputs
 
         batt_kw = 0
         batt_kwh = 0
         batt_dispatch_profile = np.nan
 
-        cbi_total = no_batt_loan_outputs['cbi_total']
-        cbi_total_fed = no_batt_loan_outputs['cbi_total_fed']
-        cbi_total_oth = no_batt_loan_outputs['cbi_total_oth']
-        cbi_total_sta = no_batt_loan_outputs['cbi_total_sta']
-        cbi_total_uti = no_batt_loan_outputs['cbi_total_uti']
-
-        ibi_total = no_batt_loan_outputs['ibi_total']
-        ibi_total_fed = no_batt_loan_outputs['ibi_total_fed']
-        ibi_total_oth = no_batt_loan_outputs['ibi_total_oth']
-        ibi_total_sta = no_batt_loan_outputs['ibi_total_sta']
-        ibi_total_uti = no_batt_loan_outputs['ibi_total_uti']
-
-        cf_pbi_total = no_batt_loan_outputs['cf_pbi_total']
-        pbi_total_fed = no_batt_loan_outputs['cf_pbi_total_fed']
-        pbi_total_oth = no_batt_loan_outputs['cf_pbi_total_oth']
-        pbi_total_sta = no_batt_loan_outputs['cf_pbi_total_sta']
-        pbi_total_uti = no_batt_loan_outputs['cf_pbi_total_uti']
+    annual_energy_production_kwh = outputs['annual_energy_kwh']
+    first_year_elec_bill_with_system = outputs['elec_cost_with_system_year1']
+    first_year_elec_bill_without_system = outputs['elec_cost_without_system_year1']
+
+    npv = outputs['npv']
+    payback = np.nan if system_kw == 0 else outputs['payback']
+    cash_flow = list(outputs['cf_payback_with_expenses'])
+
+    cbi_total = outputs['cbi_total']
+    cbi_total_fed = outputs['cbi_total_fed']
+    cbi_total_oth = outputs['cbi_total_oth']
+    cbi_total_sta = outputs['cbi_total_sta']
+    cbi_total_uti = outputs['cbi_total_uti']
+
+    ibi_total = outputs['ibi_total']
+    ibi_total_fed = outputs['ibi_total_fed']
+    ibi_total_oth = outputs['ibi_total_oth']
+    ibi_total_sta = outputs['ibi_total_sta']
+    ibi_total_uti = outputs['ibi_total_uti']
+
+    cf_pbi_total = outputs['cf_pbi_total']
+    pbi_total_fed = outputs['cf_pbi_total_fed']
+    pbi_total_oth = outputs['cf_pbi_total_oth']
+    pbi_total_sta = outputs['cf_pbi_total_sta']
+    pbi_total_uti = outputs['cf_pbi_total_uti']
         
 
     # change 0 value to 1 to avoid divide by zero errors
@@ -740,7 +1360,7 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
         first_year_elec_bill_without_system = 1.0
 
     # Add outputs to agent df    
-    naep = annual_energy_production_kwh / system_kw
+    naep = annual_energy_production_kwh / system_kw if system_kw > 0 else agent.loc['naep']
     first_year_elec_bill_savings = first_year_elec_bill_without_system - first_year_elec_bill_with_system
     first_year_elec_bill_savings_frac = first_year_elec_bill_savings / first_year_elec_bill_without_system
     avg_elec_price_cents_per_kwh = first_year_elec_bill_without_system / agent.loc['load_kwh_per_customer_in_bin']
@@ -761,6 +1381,9 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
     agent.loc['batt_kw'] = batt_kw
     agent.loc['batt_kwh'] = batt_kwh
     agent.loc['batt_dispatch_profile'] = batt_dispatch_profile
+    agent.loc['system_kw_with_batt'] = res_with_batt.x
+    agent.loc['system_kw_no_batt'] = res_no_batt.x
+    agent.loc['sizing_evaluations'] = len(evaluations)
 
     # Financial outputs (find out which ones to include): 
     agent.loc['cbi'] = np.array({'cbi_total': cbi_total,
@@ -784,68 +1407,670 @@ def calc_system_size_and_performance(agent, sectors, rate_switch_table=None):
     agent.loc['cash_incentives'] = ''
     agent.loc['export_tariff_results'] = '' 
 
-    out_cols = ['agent_id',
-                'system_kw',
-                'batt_kw',
-                'batt_kwh',
-                'npv',
-                'payback_period',
-                'cash_flow',
-                'batt_dispatch_profile',
-                'annual_energy_production_kwh',
-                'naep',
-                'capacity_factor',
-                'first_year_elec_bill_with_system',
-                'first_year_elec_bill_savings',
-                'first_year_elec_bill_savings_frac',
-                'max_system_kw',
-                'first_year_elec_bill_without_system',
-                'avg_elec_price_cents_per_kwh',
-                'cbi',
-                'ibi',
-                'pbi',
-                'cash_incentives',
-                'export_tariff_results'
-                ]
-
-    return agent[out_cols]
+    return agent[SIZING_OUTPUT_COLS]
 
 #%%
-def process_tariff(utilityrate, tariff_dict, net_billing_sell_rate):
+def optimize_system_size(args, max_system_kw, tol, last_system_kw=np.nan):
     """
-    Instantiate the utilityrate5 PySAM model and process the agent's rate json object to conform with PySAM input formatting.
-    
+    Find the system size in (0, max_system_kw) that maximizes the agent's NPV with a bounded 
+    Brent search, or by grid search if config.SIZING_METHOD is 'grid' (see optimize_system_size_grid).
+
+    If config.SIZING_WARM_START is set and the agent's optimum from last model year is known,
+    the search is first run over a bracket around it, config.SIZING_WARM_START_BRACKET_FRAC 
+    of max_system_kw to either side. If the optimum lands on an edge of that bracket that is 
+    not an edge of the full bounds, the search is rerun over (0, max_system_kw).
+
     Parameters
     ----------
-    agent : 'pd.Series'
-        Individual agent object.
+    args : 'tuple'
+        Arguments to calc_system_performance_cached after kw
+    max_system_kw : 'float'
+        Maximum system size
+    tol : 'float'
+        Absolute tolerance on the system size
+    last_system_kw : 'float'
+        Optimal system size from last model year, NaN if unknown
+
     Returns
     -------
-    utilityrate: 'PySAM.Utilityrate5'
-    """    
-    
-    ######################################
-    ###--------- UTILITYRATE5 ---------###
-    ###--- FIXED AND ANNUAL CHARGES ---###
-    ######################################
-    
-    # Monthly fixed charge [$]
-    utilityrate.ElectricityRates.ur_monthly_fixed_charge = tariff_dict['fixed_charge']
-    # Annual minimum charge [$]
-    utilityrate.ElectricityRates.ur_annual_min_charge = 0. # not currently tracked in URDB rate attribute downloads
-    # Monthly minimum charge [$]
-    utilityrate.ElectricityRates.ur_monthly_min_charge = 0. # not currently tracked in URDB rate attribute downloads
-    
-    
+    res : 'scipy.optimize.OptimizeResult'
+    """
+    if config.SIZING_METHOD == 'grid':
+        return optimize_system_size_grid(args, max_system_kw, tol)
+    elif config.SIZING_METHOD != 'brent':
+        raise ValueError("Invalid SIZING_METHOD: {}. Valid options are 'brent' and 'grid'".format(config.SIZING_METHOD))
+
+    if config.SIZING_WARM_START and pd.notnull(last_system_kw) and max_system_kw > 0:
+        half_width = config.SIZING_WARM_START_BRACKET_FRAC * max_system_kw
+        center = min(max(last_system_kw, 0.), max_system_kw)
+        lower = max(center - half_width, 0.)
+        upper = min(center + half_width, max_system_kw)
+
+        res = optimize.minimize_scalar(calc_system_performance_cached,
+                                       args = args,
+                                       bounds = (lower, upper),
+                                       method = 'bounded',
+                                       options={'xatol':tol})
+
+        at_lower_edge = (lower > 0.) and (res.x - lower <= tol)
+        at_upper_edge = (upper < max_system_kw) and (upper - res.x <= tol)
+        if not (at_lower_edge or at_upper_edge):
+            return res
+
+    # Note that the optimization is technically minimizing negative NPV
+    res = optimize.minimize_scalar(calc_system_performance_cached,
+                                   args = args,
+                                   bounds = (0, max_system_kw),
+                                   method = 'bounded',
+                                   options={'xatol':tol})
+
+    return res
+
+
+#%%
+def optimize_system_size_grid(args, max_system_kw, tol):
+    """
+    Find the system size in [0, max_system_kw] that maximizes the agent's NPV by grid search.
+
+    The NPV is evaluated at the sizes of get_sizing_grid, including 0 and max_system_kw, and then 
+    refined with a bounded search between the neighbours of the best grid point. Unlike the Brent 
+    search over the full bounds, an optimum at 0 or max_system_kw is always found. With the 
+    vectorized bill and cash flow engines the grid is evaluated in one batch, see evaluate_system_grids.
+
+    Parameters
+    ----------
+    args : 'tuple'
+        Arguments to calc_system_performance_cached after kw
+    max_system_kw : 'float'
+        Maximum system size
+    tol : 'float'
+        Absolute tolerance on the system size in the refinement
+
+    Returns
+    -------
+    res : 'scipy.optimize.OptimizeResult'
+    """
+    grid = get_sizing_grid(max_system_kw)
+
+    # grid points already evaluated, e.g. by calc_system_size_and_performance_chunk, are not evaluated again
+    if use_batched_grid():
+        evaluate_system_grids([(grid, args)])
+
+    neg_npv = np.array([calc_system_performance_cached(kw, *args) for kw in grid])
+    best = int(np.argmin(neg_npv))
+    res = optimize.OptimizeResult(x=grid[best], fun=neg_npv[best], success=True, nfev=len(grid))
+
+    if len(grid) > 1:
+        refined = optimize.minimize_scalar(calc_system_performance_cached,
+                                           args = args,
+                                           bounds = (grid[max(best - 1, 0)], grid[min(best + 1, len(grid) - 1)]),
+                                           method = 'bounded',
+                                           options={'xatol':tol})
+        if refined.fun < res.fun:
+            res = refined
+
+    return res
+
+
+def get_sizing_grid(max_system_kw):
+    """
+    System sizes of the grid search: config.SIZING_GRID_POINTS evenly spaced sizes in [0, max_system_kw]
+    """
+    if max_system_kw > 0:
+        return np.linspace(0., max_system_kw, max(config.SIZING_GRID_POINTS, 2))
+
+    return np.zeros(1)
+
+
+def use_batched_grid():
+    """
+    Grid points are evaluated in batches only with both the vectorized bill and cash flow engines, 
+    so that the grid and the refinement around it are evaluated with the same engines
+    """
+    return config.BILL_BACKEND == 'numpy' and config.CASHFLOW_BACKEND == 'numpy'
+
+
+def evaluate_system_grids(grids):
+    """
+    Evaluate systems at many sizes, of one or many agents, with and without battery, in few large 
+    array operations: the bills of each agent and tariff in one call to calc_utility_bills_numpy_batch, 
+    and the cash flows of all systems with the same analysis period in one call to cFuncs.calc_cashloan_outputs.
+    The results are stored in each agent's evaluations as get_cached_evaluation would.
+
+    Battwatts and any rate switch are run one size at a time (see setup_system_performance). Sizes 
+    on tariffs the bill engine does not support are left to be evaluated one at a time.
+
+    Parameters
+    ----------
+    grids : 'list'
+        (kws, args) of each agent and battery option: system sizes [kW] and the arguments to 
+        calc_system_performance_cached after kw
+    """
+    # systems to evaluate, grouped by agent and tariff after any rate switch
+    bill_groups = OrderedDict()
+    for kws, args in grids:
+        evaluations, pv, utilityrate, loan, batt, costs, agent, rate_switch_table, en_batt, batt_simple_dispatch = args
+        for kw in kws:
+            key = (round(kw, config.SIZING_EVAL_CACHE_DECIMALS), en_batt)
+            if key in evaluations:
+                continue
+
+            utilityrate, loan, agent, system_gen, net_billing_sell_rate, value_of_resiliency = setup_system_performance(kw, *args[1:])
+
+            compiled = get_compiled_tariff(agent.loc['tariff_id'], agent.loc['tariff_dict'])
+            if 'bill_arrays' not in compiled:
+                compiled['bill_arrays'] = tFuncs.compile_bill_arrays(agent.loc['tariff_dict'])
+            if compiled['bill_arrays'] is None:
+                continue
+
+            # placeholders for the outputs of the bill engine
+            loan.SystemOutput.annual_energy_value = [0.]
+            loan.SystemOutput.gen = [0.]
+            system = {'evaluations': evaluations, 'key': key, 'inputs': cFuncs.get_cashloan_inputs(loan),
+                      'system_gen': np.asarray(system_gen, dtype='float64'), 'value_of_resiliency': value_of_resiliency}
+            if en_batt:
+                system['batt_kw'] = batt.Battery.batt_simple_kw
+                system['batt_kwh'] = batt.Battery.batt_simple_kwh
+                system['batt_dispatch_profile'] = np.array(batt.Outputs.batt_power, dtype=config.HOURLY_PROFILE_DTYPE)
+
+            group = bill_groups.setdefault((id(evaluations), agent.loc['tariff_id']),
+                                           {'bill_arrays': compiled['bill_arrays'], 'agent': agent, 'load_hourly': pv['consumption_hourly'],
+                                            'net_billing_sell_rate': net_billing_sell_rate, 'systems': OrderedDict()})
+            group['systems'][key] = system
+
+    # bills of each agent and tariff in one batch
+    systems_by_period = OrderedDict()
+    for group in bill_groups.values():
+        systems = list(group['systems'].values())
+        system_gens = np.stack([system.pop('system_gen') for system in systems])
+        bills = calc_utility_bills_numpy_batch(group['bill_arrays'], group['agent'], system_gens, group['load_hourly'], group['net_billing_sell_rate'])
+
+        for i, system in enumerate(systems):
+            # Add value_of_resiliency -- should only apply from year 1 onwards, not to year 0
+            annual_energy_value = bills['annual_energy_value'][i].copy()
+            annual_energy_value[1:] += system['value_of_resiliency']
+            system['inputs']['annual_energy_value'] = annual_energy_value
+            system['inputs']['annual_gen'] = float(np.sum(system_gens[i]))
+            system['elec_cost_with_system_year1'] = bills['elec_cost_with_system'][i, 1]
+            system['elec_cost_without_system_year1'] = bills['elec_cost_without_system'][i, 1]
+            systems_by_period.setdefault(system['inputs']['analysis_period'], []).append(system)
+
+    # cash flows of all systems with the same analysis period in one batch
+    for systems in systems_by_period.values():
+        loan_outputs = cFuncs.calc_cashloan_outputs(cFuncs.stack_cashloan_inputs([system['inputs'] for system in systems]))
+
+        for i, system in enumerate(systems):
+            outputs = {'neg_npv': -float(loan_outputs['npv'][i])}
+            for output in SIZING_LOAN_OUTPUTS:
+                value = loan_outputs[output][i]
+                outputs[output] = value.tolist() if np.ndim(value) else float(value)
+            outputs['elec_cost_with_system_year1'] = system['elec_cost_with_system_year1']
+            outputs['elec_cost_without_system_year1'] = system['elec_cost_without_system_year1']
+            outputs['annual_energy_kwh'] = system['inputs']['annual_gen']
+            for output in ['batt_kw', 'batt_kwh', 'batt_dispatch_profile']:
+                if output in system:
+                    outputs[output] = system[output]
+
+            system['evaluations'][system['key']] = outputs
+
+
+#%%
+def get_tariff_screening_prices(tariff_dict):
+    """
+    Bounds on the bill savings per kWh generated or shifted on a tariff: its highest and lowest energy prices.
+    The highest price is infinite for tariffs with demand charges, whose savings are not bounded by 
+    energy prices, for tariffs without energy charges, which Utilityrate5 bills with the energy rates 
+    of its defaults (see compile_tariff), and for tariffs that cannot be read.
+
+    Returns
+    -------
+    'tuple'
+        Highest and lowest energy price [$/kWh]
+    """
+    try:
+        if tariff_dict['d_flat_exists'] or tariff_dict['d_tou_exists'] or not tariff_dict['e_exists']:
+            return np.inf, 0.
+        return float(np.max(tariff_dict['e_prices'])), float(np.min(tariff_dict['e_prices']))
+    except (KeyError, TypeError, ValueError):
+        return np.inf, 0.
+
+
+# Compiled state incentive inputs (see agent_mutation.elec.compile_state_incentives) covered by the
+# screening bound, by source. Agents with nonzero values of any other input, e.g. a fixed IBI amount 
+# or an escalating PBI, are not screened out.
+SCREENING_INCENTIVE_INPUTS = ['cbi_{}_amount', 'cbi_{}_maxvalue', 'cbi_{}_tax_fed', 'cbi_{}_tax_sta', 'cbi_{}_deprbas_fed', 'cbi_{}_deprbas_sta',
+                              'pbi_{}_amount', 'pbi_{}_term', 'pbi_{}_tax_fed', 'pbi_{}_tax_sta',
+                              'ibi_{}_percent', 'ibi_{}_percent_maxvalue', 'ibi_{}_percent_tax_fed', 'ibi_{}_percent_tax_sta',
+                              'ibi_{}_percent_deprbas_fed', 'ibi_{}_percent_deprbas_sta']
+
+
+def get_incentive_screening_bounds(incentives):
+    """
+    Sum the state incentives of an agent over sources, see agent_mutation.elec.compile_state_incentives.
+    Incentives not yet compiled are compiled first, as in process_incentives.
+
+    Returns
+    -------
+    'tuple'
+        CBI [$/kW], IBI [fraction of cost], highest PBI [$/kWh], and whether SCREENING_INCENTIVE_INPUTS 
+        cover all of the incentives
+    """
+    if isinstance(incentives, pd.DataFrame):
+        incentives = agent_mutation.elec.compile_state_incentives(incentives)
+
+    if not isinstance(incentives, dict):
+        # no incentives are applied to the agent, see process_incentives
+        return 0., 0., 0., True
+
+    covered = set(name.format(source) for name in SCREENING_INCENTIVE_INPUTS for source in cFuncs.INCENTIVE_SOURCES)
+    try:
+        bounded = all(key in covered or not np.any(np.asarray(value, dtype=float)) for key, value in incentives.items())
+    except (TypeError, ValueError):
+        bounded = False
+
+    cbi = 1000. * sum(incentives.get('cbi_{}_amount'.format(source), 0.) for source in cFuncs.INCENTIVE_SOURCES)
+    ibi = sum(incentives.get('ibi_{}_percent'.format(source), 0.) for source in cFuncs.INCENTIVE_SOURCES) / 100.
+    pbi = sum(max(list(np.atleast_1d(incentives.get('pbi_{}_amount'.format(source), 0.))) or [0.]) for source in cFuncs.INCENTIVE_SOURCES)
+
+    return cbi, ibi, pbi, bounded
+
+
+def calc_sizing_npv_bound(dataframe, solar_cf_profiles, rate_switch_index):
+    """
+    Upper bound on the NPV of each kW of PV of each agent, with or without battery, see screen_sizing_agents.
+
+    The bound values the generation at the tariff's highest energy price (or the sell rate if higher) 
+    and production-based incentives over the analysis period, escalated by inflation and 
+    elec_price_escalator. It subtracts the capital cost net of the CBI, IBI and the benefit of 
+    financing at the loan rate, plus the ITC and an upper bound on depreciation. O&M, degradation, 
+    fixed costs, taxes on savings and incentive caps are left out, which only raises the bound.
+    A battery only adds to the bound if it can have a positive NPV itself, in which case the agent 
+    is not screened out.
+
+    The bound is infinite for agents whose tariff has demand charges, to whom a rate switch applies, 
+    who have a value of resiliency or incentives not covered by SCREENING_INCENTIVE_INPUTS, for whom 
+    a dollar of cost is worth more in tax credits and incentives than it costs, whose battery can 
+    have a positive NPV, or whose solar profile is not in the prefetched store.
+
+    Parameters
+    ----------
+    dataframe : 'pd.df'
+        Agent dataframe
+    solar_cf_profiles : 'hourly_profiles.ProfileCache'
+        Solar capacity factor profiles, indexed by the agents' solar_cf_idx
+    rate_switch_index : 'dict'
+        Rate switch table indexed by agent_mutation.elec.index_rate_switch_table
+
+    Returns
+    -------
+    npv_per_kw_bound : 'numpy.ndarray'
+        Upper bound on the NPV per kW of PV of each agent [$/kW]
+    """
+    # annual generation per kW of PV
+    solar_cf_idx = dataframe['solar_cf_idx'].values
+    naep = np.full(len(dataframe), np.nan)
+    if solar_cf_profiles is not None and solar_cf_profiles.store is not None and len(solar_cf_profiles.store) > 0:
+        naep_by_profile = solar_cf_profiles.store.array.sum(axis=0, dtype='float64')
+        naep = np.where(solar_cf_idx >= 0, naep_by_profile[np.clip(solar_cf_idx, 0, None)], np.nan)
+
+    # bounds shared by the agents of a tariff and of a set of incentives
+    tariff_prices = dataframe.groupby('tariff_id')['tariff_dict'].first().map(get_tariff_screening_prices)
+    sell_rate = np.where(dataframe['compensation_style'] == 'none', 0., dataframe['wholesale_elec_price_dollars_per_kwh'] * dataframe['elec_price_multiplier'])
+    max_price = np.maximum(dataframe['tariff_id'].map(tariff_prices.str[0]).values, sell_rate)
+    min_price = np.minimum(dataframe['tariff_id'].map(tariff_prices.str[1]).values, sell_rate)
+
+    incentive_bounds = dict()
+    def get_bounds(incentives):
+        if id(incentives) not in incentive_bounds:
+            incentive_bounds[id(incentives)] = get_incentive_screening_bounds(incentives)
+        return incentive_bounds[id(incentives)]
+    cbi, ibi, pbi, incentives_bounded = np.array([get_bounds(incentives) for incentives in dataframe['state_incentives']]).reshape(-1, 4).T
+
+    # present value of an annual amount in years 1 to n, escalating from year 1
+    n_years = dataframe['economic_lifetime_yrs'].astype(float)
+    discount_rate = (1. + dataframe['real_discount_rate']) * (1. + dataframe['inflation_rate']) - 1.
+    growth = 1. + dataframe['inflation_rate'] + dataframe['elec_price_escalator']
+    ratio = growth / (1. + discount_rate)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pv_factor = np.where(np.isclose(ratio, 1.), n_years / (1. + discount_rate), (1. - ratio ** n_years) / (1. + discount_rate - growth))
+
+    benefit_per_kw = (max_price + pbi) * naep * pv_factor
+
+    # present value of loan payments per dollar borrowed, with interest deductible for commercial agents
+    commercial = (dataframe['sector_abbr'] != 'res').values
+    loan_rate = dataframe['loan_interest_rate']
+    loan_term = dataframe['loan_term_yrs'].astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        payment = np.where(loan_rate > 0, loan_rate / (1. - (1. + loan_rate) ** -loan_term), 1. / np.maximum(loan_term, 1.))
+        annuity = np.where(discount_rate > 0, (1. - (1. + discount_rate) ** -loan_term) / discount_rate, loan_term)
+    debt_cost = np.clip(payment * annuity, 0., 1.) * (1. - commercial * dataframe['tax_rate'])
+    financing = dataframe['down_payment_fraction'] + (1. - dataframe['down_payment_fraction']) * debt_cost
+
+    # cost of each dollar of capital cost net of the IBI, the ITC, and at most the tax rate on it from 
+    # depreciation (MACRS depreciates the whole basis). CBI and IBI reduce the amount financed.
+    net_cost = (financing * (1. - ibi) - dataframe['itc_fraction_of_capex'] - commercial * dataframe['tax_rate']).values
+
+    capex_per_kw = (np.minimum(dataframe['system_capex_per_kw'], dataframe['system_capex_per_kw_combined']) * dataframe['cap_cost_multiplier']).values
+    npv_per_kw_bound = np.asarray(benefit_per_kw + cbi * financing - capex_per_kw * net_cost, dtype=float)
+
+    # a battery shifts at most its capacity a day from the lowest to the highest price, and has half its capacity
+    # in power, see setup_system_performance. Its size is not bounded per kW of PV, so agents whose battery can 
+    # have a positive NPV are not screened out.
+    batt_capex_per_kwh = ((dataframe['batt_capex_per_kwh_combined'] + 0.5 * dataframe['batt_capex_per_kw_combined']) * dataframe['cap_cost_multiplier']).values
+    batt_npv_per_kwh_bound = np.asarray(365. * (max_price - min_price) * pv_factor - batt_capex_per_kwh * net_cost, dtype=float)
+
+    rate_switch_keys = set((eia_id, res_com) for (tech, eia_id, res_com) in rate_switch_index)
+    has_rate_switch = np.array([(eia_id, str(sector_abbr).upper()[0]) in rate_switch_keys 
+                                for eia_id, sector_abbr in zip(dataframe['eia_id'], dataframe['sector_abbr'])], dtype=bool)
+
+    unbounded = (~np.isfinite(npv_per_kw_bound) | ~(batt_npv_per_kwh_bound <= 0) | (incentives_bounded == 0) | (net_cost < 0) |
+                 (dataframe['value_of_resiliency_usd'].fillna(0) > 0).values | has_rate_switch)
+    npv_per_kw_bound[unbounded] = np.inf
+
+    return npv_per_kw_bound
+
+
+@decorators.fn_timer(logger = logger, tab_level = 2, prefix = '')
+def screen_sizing_agents(dataframe, solar_cf_profiles, rate_switch_index):
+    """
+    Flag the agents for which no system can reach a positive NPV as sizing_screened_out: those whose
+    upper bound on the NPV per kW of PV (see calc_sizing_npv_bound) is not positive.
+    calc_system_size_and_performance evaluates these agents without a system instead of 
+    optimizing their system size.
+
+    Parameters
+    ----------
+    dataframe : 'pd.df'
+        Agent dataframe
+    solar_cf_profiles : 'hourly_profiles.ProfileCache'
+        Solar capacity factor profiles, indexed by the agents' solar_cf_idx
+    rate_switch_index : 'dict'
+        Rate switch table indexed by agent_mutation.elec.index_rate_switch_table
+
+    Returns
+    -------
+    dataframe : 'pd.df'
+        Agent dataframe with sizing_screened_out
+    """
+    dataframe = dataframe.reset_index()
+
+    dataframe['sizing_screened_out'] = calc_sizing_npv_bound(dataframe, solar_cf_profiles, rate_switch_index) <= 0
+
+    logger.info('\t\tScreened out {s} of {n} agents that cannot reach a positive NPV'.format(s=dataframe['sizing_screened_out'].sum(), n=len(dataframe)))
+
+    dataframe = dataframe.set_index('agent_id')
+
+    return dataframe
+
+
+#%%
+@decorators.fn_timer(logger = logger, tab_level = 2, prefix = '')
+def assign_sizing_fidelity(dataframe, max_market_share_last_year=None):
+    """
+    Assign each agent the sizing fidelity tier, a key of config.SIZING_FIDELITY_TIERS, that sets 
+    the tolerance on its system size. Agents are sized with the 'coarse' tier when
+    config.SIZING_EXPLORATORY is set, when their developable agent weight is below 
+    config.SIZING_COARSE_MAX_DEVELOPABLE_WEIGHT, or when their maximum market share last model year
+    was at most config.SIZING_COARSE_MAX_MARKET_SHARE, and with the 'fine' tier otherwise.
+
+    Parameters
+    ----------
+    dataframe : 'pd.df'
+        Agent dataframe
+    max_market_share_last_year : 'pd.df'
+        agent_id and max_market_share from last model year, None in the first model year
+
+    Returns
+    -------
+    dataframe : 'pd.df'
+        Agent dataframe with sizing_fidelity
+    """
+    dataframe = dataframe.reset_index()
+
+    coarse = np.full(len(dataframe), bool(config.SIZING_EXPLORATORY))
+
+    if config.SIZING_COARSE_MAX_DEVELOPABLE_WEIGHT is not None:
+        developable_agent_weight = dataframe['pct_of_bldgs_developable'] * dataframe['customers_in_bin']
+        coarse |= (developable_agent_weight < config.SIZING_COARSE_MAX_DEVELOPABLE_WEIGHT).values
+
+    if config.SIZING_COARSE_MAX_MARKET_SHARE is not None and max_market_share_last_year is not None:
+        max_market_share = pd.merge(dataframe[['agent_id']], max_market_share_last_year[['agent_id', 'max_market_share']], 
+                                    on='agent_id', how='left')['max_market_share']
+        coarse |= (max_market_share <= config.SIZING_COARSE_MAX_MARKET_SHARE).values
+
+    dataframe['sizing_fidelity'] = np.where(coarse, 'coarse', 'fine')
+
+    dataframe = dataframe.set_index('agent_id')
+
+    return dataframe
+
+
+def log_sizing_evaluations(dataframe):
+    """
+    Log the number of agents and the mean number of system sizes evaluated per agent in each sizing fidelity tier
+    """
+    if 'sizing_fidelity' not in dataframe.columns:
+        return
+
+    summary = dataframe.groupby('sizing_fidelity')['sizing_evaluations'].agg(['count', 'mean'])
+    for fidelity, row in summary.iterrows():
+        logger.info('\t\tSizing fidelity {f}: {n} agents, {e:.1f} evaluations per agent'.format(f=fidelity, n=int(row['count']), e=row['mean']))
+
+
+def get_sizing_dedupe_cols():
+    """
+    Columns of the agents sized once per set of equal values with config.SIZING_DEDUPE, see 
+    agents.Agents.apply_chunk_on_row: SIZING_INPUT_COLS except the warm start and sizing setting
+    columns, which change how the optimal system is searched for but not what it is. Agents of 
+    a set are given the same sizing settings by align_sizing_settings.
+    """
+    return [col for col in SIZING_INPUT_COLS if col not in SIZING_WARM_START_COLS + SIZING_SETTING_COLS]
+
+
+def align_sizing_settings(dataframe):
+    """
+    Give the agents with equal get_sizing_dedupe_cols, which are sized once with config.SIZING_DEDUPE,
+    the same sizing settings: the finest sizing fidelity tier of any of them, and screened out 
+    only if all of them are.
+
+    Parameters
+    ----------
+    dataframe : 'pd.df'
+        Agent dataframe
+
+    Returns
+    -------
+    dataframe : 'pd.df'
+        Agent dataframe with aligned SIZING_SETTING_COLS
+    """
+    dataframe = dataframe.reset_index()
+
+    groups = utilfunc.fingerprint_rows(dataframe, get_sizing_dedupe_cols()).values
+
+    if 'sizing_fidelity' in dataframe.columns:
+        # tiers from the smallest tolerance on the system size
+        tiers = sorted(config.SIZING_FIDELITY_TIERS, key=lambda tier: (config.SIZING_FIDELITY_TIERS[tier]['max_tol_kw'], 
+                                                                        config.SIZING_FIDELITY_TIERS[tier]['tol_frac']))
+        rank = dataframe['sizing_fidelity'].map(tiers.index)
+        dataframe['sizing_fidelity'] = [tiers[r] for r in rank.groupby(groups).transform('min').values]
+
+    if 'sizing_screened_out' in dataframe.columns:
+        dataframe['sizing_screened_out'] = dataframe['sizing_screened_out'].groupby(groups).transform('all').values
+
+    dataframe = dataframe.set_index('agent_id')
+
+    return dataframe
+
+
+#%%
+def fingerprint_sizing_inputs(dataframe):
+    """
+    Fingerprint each agent's sizing inputs, to find the agents whose inputs have not changed 
+    since last model year. Covers SIZING_INPUT_COLS except the warm start columns, and the
+    agent's compiled state incentives, which can change from year to year.
+
+    Parameters
+    ----------
+    dataframe : 'pd.df'
+        Agent dataframe
+
+    Returns
+    -------
+    fingerprints : 'pd.Series'
+        uint64 fingerprint of each agent, indexed by agent_id
+    """
+    if 'agent_id' not in dataframe.columns:
+        dataframe = dataframe.reset_index()
+
+    cols = [col for col in SIZING_INPUT_COLS if col not in SIZING_WARM_START_COLS]
+
+    if 'state_incentives' in dataframe.columns:
+        # agents of a state and sector share one compiled incentives object; hash each object once
+        incentive_keys = dict()
+        def get_incentives_key(incentives):
+            if id(incentives) not in incentive_keys:
+                incentive_keys[id(incentives)] = utilfunc.DiskCache.make_key(incentives)
+            return incentive_keys[id(incentives)]
+
+        dataframe = dataframe.assign(state_incentives_key = dataframe['state_incentives'].map(get_incentives_key))
+        cols = cols + ['state_incentives_key']
+
+    fingerprints = utilfunc.fingerprint_rows(dataframe, cols)
+    fingerprints.index = dataframe['agent_id'].values
+
+    return fingerprints
+
+
+def split_unchanged_agents(dataframe, fingerprints, sizing_results_last_year):
+    """
+    Split the agents into those that must be sized and those whose sizing inputs have not 
+    changed since last model year, which keep last year's sizing results.
+
+    Parameters
+    ----------
+    dataframe : 'pd.df'
+        Agent dataframe
+    fingerprints : 'pd.Series'
+        This year's fingerprints, see fingerprint_sizing_inputs
+    sizing_results_last_year : 'pd.df'
+        SIZING_OUTPUT_COLS and sizing_fingerprint of each agent from last model year
+
+    Returns
+    -------
+    resize_df : 'pd.df'
+        Agents to size
+    carried_df : 'pd.df'
+        Unchanged agents with last year's SIZING_OUTPUT_COLS
+    """
+    if 'agent_id' not in dataframe.columns:
+        dataframe = dataframe.reset_index()
+
+    last_fingerprints = sizing_results_last_year.set_index('agent_id')['sizing_fingerprint']
+    unchanged = (fingerprints.loc[dataframe['agent_id'].values].values == 
+                 last_fingerprints.reindex(dataframe['agent_id'].values).values)
+
+    resize_df = dataframe.loc[~unchanged]
+    carried_df = pd.merge(dataframe.loc[unchanged], sizing_results_last_year.drop('sizing_fingerprint', axis=1), on='agent_id', how='left')
+
+    return resize_df, carried_df
+
+
+def combine_carried_agents(dataframe, sized_df, carried_df):
+    """
+    Recombine the agents sized this model year and those that keep last year's sizing results
+    (see split_unchanged_agents) in the order of the agents in dataframe
+
+    Parameters
+    ----------
+    dataframe : 'pd.df'
+        Agent dataframe before sizing, indexed by agent_id or with an agent_id column
+    sized_df : 'pd.df'
+        Agents sized this model year, with an agent_id column
+    carried_df : 'pd.df'
+        Unchanged agents with last year's SIZING_OUTPUT_COLS, with an agent_id column
+
+    Returns
+    -------
+    dataframe : 'pd.df'
+        Agent dataframe with an agent_id column
+    """
+    agent_order = dataframe.index if 'agent_id' not in dataframe.columns else dataframe['agent_id']
+    if len(sized_df) == 0:
+        sized_df = sized_df.reindex(columns=carried_df.columns)
+
+    return pd.concat([sized_df, carried_df], axis=0, sort=False).set_index('agent_id').loc[agent_order].reset_index()
+
+
+#%%
+@decorators.fn_timer(logger = logger, tab_level = 2, prefix = '')
+def apply_sizing_warm_start(dataframe, sizing_optima):
+    """
+    Merge each agent's optimal system sizes from last model year onto the agent dataframe
+    as system_kw_with_batt_last_year and system_kw_no_batt_last_year.
+
+    Parameters
+    ----------
+    dataframe : 'pd.df'
+        Agent dataframe
+    sizing_optima : 'pd.df'
+        agent_id, system_kw_with_batt and system_kw_no_batt from last model year's sizing
+
+    Returns
+    -------
+    dataframe : 'pd.df'
+        Agent dataframe with last year's optimal system sizes
+    """
+    dataframe = dataframe.reset_index()
+
+    sizing_optima = sizing_optima[['agent_id', 'system_kw_with_batt', 'system_kw_no_batt']].rename(
+        columns={'system_kw_with_batt':'system_kw_with_batt_last_year', 'system_kw_no_batt':'system_kw_no_batt_last_year'})
+    dataframe = pd.merge(dataframe, sizing_optima, on='agent_id', how='left')
+
+    dataframe = dataframe.set_index('agent_id')
+
+    return dataframe
+
+
+#%%
+def compile_tariff(tariff_dict):
+    """
+    Process the agent's rate json object to conform with PySAM Utilityrate5 input formatting.
+    
+    Parameters
+    ----------
+    tariff_dict : 'dict'
+        Agent's rate json object.
+    Returns
+    -------
+    compiled : 'dict'
+        - rates - ElectricityRates inputs ready to assign
+        - ec_tou_mat - energy rates table without the sell rate column, or None if the tariff has no energy charges
+        - ur_ec_tou_mats - energy rates tables with the sell rate column, by sell rate, see process_tariff
+    """
+    rates = dict()
+    
+    ######################################
+    ###--------- UTILITYRATE5 ---------###
+    ###--- FIXED AND ANNUAL CHARGES ---###
+    ######################################
+    
+    # Monthly fixed charge [$]
+    rates['ur_monthly_fixed_charge'] = tariff_dict['fixed_charge']
+    # Annual minimum charge [$]
+    rates['ur_annual_min_charge'] = 0. # not currently tracked in URDB rate attribute downloads
+    # Monthly minimum charge [$]
+    rates['ur_monthly_min_charge'] = 0. # not currently tracked in URDB rate attribute downloads
+    
+    
     ######################################
     ###--------- UTILITYRATE5 ---------###
     ###-------- DEMAND CHARGES --------###
     ######################################
     
     # Enable demand charge
-    utilityrate.ElectricityRates.ur_dc_enable = (tariff_dict['d_flat_exists']) | (tariff_dict['d_tou_exists'])
+    rates['ur_dc_enable'] = (tariff_dict['d_flat_exists']) | (tariff_dict['d_tou_exists'])
     
-    if utilityrate.ElectricityRates.ur_dc_enable:
+    if rates['ur_dc_enable']:
     
         if tariff_dict['d_flat_exists']:
             
@@ -859,7 +2084,7 @@ def process_tariff(utilityrate, tariff_dict, net_billing_sell_rate):
                     ur_dc_flat_mat.append(row)
             
             # Demand rates (flat) table
-            utilityrate.ElectricityRates.ur_dc_flat_mat = ur_dc_flat_mat
+            rates['ur_dc_flat_mat'] = ur_dc_flat_mat
         
         
         if tariff_dict['d_tou_exists']:
@@ -874,7 +2099,7 @@ def process_tariff(utilityrate, tariff_dict, net_billing_sell_rate):
                     ur_dc_tou_mat.append(row)
             
             # Demand rates (TOU) table
-            utilityrate.ElectricityRates.ur_dc_tou_mat = ur_dc_tou_mat
+            rates['ur_dc_tou_mat'] = ur_dc_tou_mat
     
     
         # Reformat 12x24 tables - original are indexed to 0, PySAM needs index starting at 1
@@ -889,9 +2114,9 @@ def process_tariff(utilityrate, tariff_dict, net_billing_sell_rate):
             d_wkend_12by24.append(row)
 
         # Demand charge weekday schedule
-        utilityrate.ElectricityRates.ur_dc_sched_weekday = d_wkday_12by24
+        rates['ur_dc_sched_weekday'] = d_wkday_12by24
         # Demand charge weekend schedule
-        utilityrate.ElectricityRates.ur_dc_sched_weekend = d_wkend_12by24
+        rates['ur_dc_sched_weekend'] = d_wkend_12by24
     
     
     ######################################
@@ -899,25 +2124,21 @@ def process_tariff(utilityrate, tariff_dict, net_billing_sell_rate):
     ###-------- ENERGY CHARGES --------###
     ######################################
     
+    ec_tou_mat = None
     if tariff_dict['e_exists']:
         
         # Dictionary to map dGen max usage units to PySAM options
         max_usage_dict = {'kWh':0, 'kWh/kW':1, 'kWh daily':2, 'kWh/kW daily':3}
-        # If max usage units are 'kWh daily', divide max usage by 30 -- rate download procedure converts daily to monthly
-        modifier = 30. if tariff_dict['energy_rate_unit'] == 'kWh daily' else 1.
         
-        # Reformat energy charge table from dGen format
+        # Reformat energy charge table from dGen format, the sell rate column is added per agent
         n_periods = len(tariff_dict['e_levels'][0])
         n_tiers = len(tariff_dict['e_levels'])
-        ur_ec_tou_mat = []
+        ec_tou_mat = []
         for period in range(n_periods):
             for tier in range(n_tiers):
                 row = [period+1, tier+1, tariff_dict['e_levels'][tier][period], max_usage_dict[tariff_dict['energy_rate_unit']],
-                 tariff_dict['e_prices'][tier][period], net_billing_sell_rate]
-                ur_ec_tou_mat.append(row)
-        
-        # Energy rates table
-        utilityrate.ElectricityRates.ur_ec_tou_mat = ur_ec_tou_mat
+                 tariff_dict['e_prices'][tier][period]]
+                ec_tou_mat.append(row)
         
         # Reformat 12x24 tables - original are indexed to 0, PySAM needs index starting at 1
         e_wkday_12by24 = []
@@ -931,11 +2152,86 @@ def process_tariff(utilityrate, tariff_dict, net_billing_sell_rate):
             e_wkend_12by24.append(row)
         
         # Energy charge weekday schedule
-        utilityrate.ElectricityRates.ur_ec_sched_weekday = e_wkday_12by24
+        rates['ur_ec_sched_weekday'] = e_wkday_12by24
         # Energy charge weekend schedule
-        utilityrate.ElectricityRates.ur_ec_sched_weekend = e_wkend_12by24
+        rates['ur_ec_sched_weekend'] = e_wkend_12by24
         
     
+    return {'rates': rates, 'ec_tou_mat': ec_tou_mat, 'ur_ec_tou_mats': OrderedDict()}
+
+
+#%%
+def get_compiled_tariff(tariff_id, tariff_dict):
+    """
+    Return the compiled tariff for tariff_id from the worker's tariff cache, compiling it on first use.
+    The cache holds at most config.TARIFF_CACHE_MAX_SIZE tariffs and evicts the least recently used.
+    
+    Parameters
+    ----------
+    tariff_id : 'int'
+        Id of the tariff
+    tariff_dict : 'dict'
+        Rate json object of the tariff, only read if the tariff is not cached
+    Returns
+    -------
+    compiled : 'dict'
+        See compile_tariff
+    """
+    if not hasattr(_compiled_tariffs, 'cache'):
+        _compiled_tariffs.cache = OrderedDict()
+
+    cache = _compiled_tariffs.cache
+    if tariff_id in cache:
+        cache.move_to_end(tariff_id)
+        return cache[tariff_id]
+
+    compiled = compile_tariff(tariff_dict)
+    cache[tariff_id] = compiled
+    if len(cache) > config.TARIFF_CACHE_MAX_SIZE:
+        cache.popitem(last=False)
+
+    return compiled
+
+
+#%%
+def process_tariff(utilityrate, tariff_dict, net_billing_sell_rate, tariff_id=None):
+    """
+    Assign the agent's tariff to the utilityrate5 PySAM model.
+    
+    Parameters
+    ----------
+    utilityrate : 'PySAM.Utilityrate5'
+        Utilityrate5 model of the agent
+    tariff_dict : 'dict'
+        Agent's rate json object
+    net_billing_sell_rate : 'float'
+        Sell rate for exported generation [$/kWh]
+    tariff_id : 'int'
+        Id of the tariff. If given, the compiled tariff is cached and reused by other agents.
+    Returns
+    -------
+    utilityrate: 'PySAM.Utilityrate5'
+    """    
+    if tariff_id is None:
+        compiled = compile_tariff(tariff_dict)
+    else:
+        compiled = get_compiled_tariff(tariff_id, tariff_dict)
+
+    utilityrate.ElectricityRates.assign(compiled['rates'])
+
+    if compiled['ec_tou_mat'] is not None:
+        # energy rates table with the sell rate column, kept for the last config.TARIFF_CACHE_MAX_SELL_RATES sell rates
+        ur_ec_tou_mats = compiled['ur_ec_tou_mats']
+        if net_billing_sell_rate in ur_ec_tou_mats:
+            ur_ec_tou_mats.move_to_end(net_billing_sell_rate)
+        else:
+            ur_ec_tou_mats[net_billing_sell_rate] = [row + [net_billing_sell_rate] for row in compiled['ec_tou_mat']]
+            if len(ur_ec_tou_mats) > config.TARIFF_CACHE_MAX_SELL_RATES:
+                ur_ec_tou_mats.popitem(last=False)
+
+        # Energy rates table
+        utilityrate.ElectricityRates.ur_ec_tou_mat = ur_ec_tou_mats[net_billing_sell_rate]
+    
     return utilityrate
 
 
@@ -947,136 +2243,16 @@ def process_incentives(loan, kw, batt_kw, batt_kwh, generation_hourly, agent):
     ###------ PAYMENT INCENTIVES ------###
     ######################################
 
-    # Read incentive dataframe from agent attributes
-    incentive_df = agent.loc['state_incentives']
-    
-    # Check dtype of incentive_df - process incentives if pd.DataFrame, otherwise do not assign incentive values to cashloan
-    if isinstance(incentive_df, pd.DataFrame):
-        
-        # Fill NaNs in incentive_df - assume max incentive duration of 5 years and max incentive value of $10,000
-        incentive_df = incentive_df.fillna(value={'incentive_duration_yrs' : 5, 'max_incentive_usd' : 10000})
-        # Filter for CBI's in incentive_df
-        cbi_df = (incentive_df.loc[pd.notnull(incentive_df['cbi_usd_p_w'])]                  
-                  .sort_values(['cbi_usd_p_w'], axis=0, ascending=False)
-                  .reset_index(drop=True)
-                 )
-        
-        # Process state capacity-based incentives (CBI)
-        #cbi_value = calculate_capacity_based_incentives(kw, batt_kw, batt_kwh, agent)
-        
-        # For multiple CBIs that are applicable to the agent, cap at 2 and use PySAM's "state" and "other" option
-        if len(cbi_df) == 1:
-            
-            loan.PaymentIncentives.cbi_sta_amount = cbi_df['cbi_usd_p_w'].iloc[0]
-            loan.PaymentIncentives.cbi_sta_deprbas_fed = 0
-            loan.PaymentIncentives.cbi_sta_deprbas_sta = 0
-            loan.PaymentIncentives.cbi_sta_maxvalue = cbi_df['max_incentive_usd'].iloc[0]
-            loan.PaymentIncentives.cbi_sta_tax_fed = 0
-            loan.PaymentIncentives.cbi_sta_tax_sta = 0
-            
-        elif len(cbi_df) >= 2:
-            
-            loan.PaymentIncentives.cbi_sta_amount = cbi_df['cbi_usd_p_w'].iloc[0]
-            loan.PaymentIncentives.cbi_sta_deprbas_fed = 0
-            loan.PaymentIncentives.cbi_sta_deprbas_sta = 0
-            loan.PaymentIncentives.cbi_sta_maxvalue = cbi_df['max_incentive_usd'].iloc[0]
-            loan.PaymentIncentives.cbi_sta_tax_fed = 1
-            loan.PaymentIncentives.cbi_sta_tax_sta = 1
-            
-            loan.PaymentIncentives.cbi_oth_amount = cbi_df['cbi_usd_p_w'].iloc[1]
-            loan.PaymentIncentives.cbi_oth_deprbas_fed = 0
-            loan.PaymentIncentives.cbi_oth_deprbas_sta = 0
-            loan.PaymentIncentives.cbi_oth_maxvalue = cbi_df['max_incentive_usd'].iloc[1]
-            loan.PaymentIncentives.cbi_oth_tax_fed = 1
-            loan.PaymentIncentives.cbi_oth_tax_sta = 1
-            
-        else:
-            pass
-        
-        # Filter for PBI's in incentive_df
-        pbi_df = (incentive_df.loc[pd.notnull(incentive_df['pbi_usd_p_kwh'])]
-                  .sort_values(['pbi_usd_p_kwh'], axis=0, ascending=False)
-                  .reset_index(drop=True)
-                 )
-        
-        # Process state production-based incentives (CBI)
-        agent.loc['timesteps_per_year'] = 1
-        pv_kwh_by_year = np.array(list(map(lambda x: sum(x), np.split(np.array(generation_hourly), agent.loc['timesteps_per_year']))))
-        pv_kwh_by_year = np.concatenate([(pv_kwh_by_year - (pv_kwh_by_year * agent.loc['pv_degradation_factor'] * i)) for i in range(1, agent.loc['economic_lifetime_yrs']+1)])
-        kwh_by_timestep = kw * pv_kwh_by_year
-        
-        #pbi_value = calculate_production_based_incentives(kw, kwh_by_timestep, agent)
+    # Read incentives from agent attributes, compiled per state and sector by agent_mutation.elec.apply_state_incentives
+    incentives = agent.loc['state_incentives']
     
-        # For multiple PBIs that are applicable to the agent, cap at 2 and use PySAM's "state" and "other" option
-        if len(pbi_df) == 1:
-            
-            # Aamount input [$/kWh] requires sequence -- repeat pbi_usd_p_kwh using incentive_duration_yrs 
-            loan.PaymentIncentives.pbi_sta_amount = [pbi_df['pbi_usd_p_kwh'].iloc[0]] * int(pbi_df['incentive_duration_yrs'].iloc[0])
-            loan.PaymentIncentives.pbi_sta_escal = 0.
-            loan.PaymentIncentives.pbi_sta_tax_fed = 1
-            loan.PaymentIncentives.pbi_sta_tax_sta = 1
-            loan.PaymentIncentives.pbi_sta_term = pbi_df['incentive_duration_yrs'].iloc[0]
-            
-        elif len(pbi_df) >= 2:
-            
-            # Aamount input [$/kWh] requires sequence -- repeat pbi_usd_p_kwh using incentive_duration_yrs 
-            loan.PaymentIncentives.pbi_sta_amount = [pbi_df['pbi_usd_p_kwh'].iloc[0]] * int(pbi_df['incentive_duration_yrs'].iloc[0])
-            loan.PaymentIncentives.pbi_sta_escal = 0.
-            loan.PaymentIncentives.pbi_sta_tax_fed = 1
-            loan.PaymentIncentives.pbi_sta_tax_sta = 1
-            loan.PaymentIncentives.pbi_sta_term = pbi_df['incentive_duration_yrs'].iloc[0]
-            
-            # Aamount input [$/kWh] requires sequence -- repeat pbi_usd_p_kwh using incentive_duration_yrs 
-            loan.PaymentIncentives.pbi_oth_amount = [pbi_df['pbi_usd_p_kwh'].iloc[1]] * int(pbi_df['incentive_duration_yrs'].iloc[1])
-            loan.PaymentIncentives.pbi_oth_escal = 0.
-            loan.PaymentIncentives.pbi_oth_tax_fed = 1
-            loan.PaymentIncentives.pbi_oth_tax_sta = 1
-            loan.PaymentIncentives.pbi_oth_term = pbi_df['incentive_duration_yrs'].iloc[1]
-            
-        else:
-            pass
-        
-        # Filter for IBI's in incentive_df
-        ibi_df = (incentive_df.loc[pd.notnull(incentive_df['ibi_pct'])]
-                  .sort_values(['ibi_pct'], axis=0, ascending=False)
-                  .reset_index(drop=True)
-                 )
-        
-        # Process state investment-based incentives (CBI)
-        #ibi_value = calculate_investment_based_incentives(kw, batt_kw, batt_kwh, agent)
-        
-        # For multiple IBIs that are applicable to the agent, cap at 2 and use PySAM's "state" and "other" option
-        # NOTE: this specifies IBI percentage, instead of IBI absolute amount
-        if len(ibi_df) == 1:
-    
-            loan.PaymentIncentives.ibi_sta_percent = ibi_df['ibi_pct'].iloc[0]
-            loan.PaymentIncentives.ibi_sta_percent_deprbas_fed = 0
-            loan.PaymentIncentives.ibi_sta_percent_deprbas_sta = 0
-            loan.PaymentIncentives.ibi_sta_percent_maxvalue = ibi_df['max_incentive_usd'].iloc[0]
-            loan.PaymentIncentives.ibi_sta_percent_tax_fed = 1
-            loan.PaymentIncentives.ibi_sta_percent_tax_sta = 1
-            
-        elif len(ibi_df) >= 2:
-            
-            loan.PaymentIncentives.ibi_sta_percent = ibi_df['ibi_pct'].iloc[0]
-            loan.PaymentIncentives.ibi_sta_percent_deprbas_fed = 0
-            loan.PaymentIncentives.ibi_sta_percent_deprbas_sta = 0
-            loan.PaymentIncentives.ibi_sta_percent_maxvalue = ibi_df['max_incentive_usd'].iloc[0]
-            loan.PaymentIncentives.ibi_sta_percent_tax_fed = 1
-            loan.PaymentIncentives.ibi_sta_percent_tax_sta = 1
-            
-            loan.PaymentIncentives.ibi_oth_percent = ibi_df['ibi_pct'].iloc[1]
-            loan.PaymentIncentives.ibi_oth_percent_deprbas_fed = 0
-            loan.PaymentIncentives.ibi_oth_percent_deprbas_sta = 0
-            loan.PaymentIncentives.ibi_oth_percent_maxvalue = ibi_df['max_incentive_usd'].iloc[1]
-            loan.PaymentIncentives.ibi_oth_percent_tax_fed = 1
-            loan.PaymentIncentives.ibi_oth_percent_tax_sta = 1
-            
-        else:
-            pass
-        
-    else:
-        pass
+    # incentives not yet compiled
+    if isinstance(incentives, pd.DataFrame):
+        incentives = agent_mutation.elec.compile_state_incentives(incentives)
+
+    # Check dtype of incentives - assign if dict, otherwise do not assign incentive values to cashloan
+    if isinstance(incentives, dict):
+        loan.PaymentIncentives.assign(incentives)
     
     return loan
 
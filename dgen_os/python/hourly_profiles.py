@@ -0,0 +1,249 @@
+"""
+Contiguous stores of hourly (8760) profiles shared by many agents.
+"""
+
+from collections import OrderedDict
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import utility_functions as utilfunc
+
+#==============================================================================
+# Load logger
+logger = utilfunc.get_logger()
+#==============================================================================
+
+HOURS_PER_YEAR = 8760
+
+
+#%%
+class HourlyProfiles(object):
+    """
+    Store of hourly profiles held in a single 8760 x N array. Each profile is one
+    column of the array and is looked up by its key. The array is Fortran-ordered
+    so that each column (profile) is contiguous in memory.
+
+    After share() the array lives in a shared memory block. Pickling the store 
+    (e.g. to send it to a worker process) then carries only the block name and 
+    the worker attaches to the same memory read-only instead of receiving a copy.
+
+    Attributes
+    ----------
+    keys : 'list'
+        Key of each profile, in column order
+    array : 'numpy.ndarray'
+        8760 x N array of profiles
+    """
+    def __init__(self, keys, array):
+        """
+        Initialize HourlyProfiles Class
+        Parameters
+        ----------
+        keys : 'list'
+            Key of each profile, in column order
+        array : 'numpy.ndarray'
+            8760 x N array of profiles
+        """
+        if array.shape[1] != len(keys):
+            raise ValueError('Number of profiles ({}) does not match number of keys ({})'.format(array.shape[1], len(keys)))
+
+        self.keys = list(keys)
+        self.array = array
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self._shm = None
+        self._owner = False
+
+    @classmethod
+    def from_profiles(cls, keys, profiles, dtype='float32'):
+        """
+        Build a store by copying profiles into a new contiguous array
+
+        Parameters
+        ----------
+        keys : 'list'
+            Key of each profile
+        profiles : 'iterable'
+            Hourly profiles (array-like of length 8760) in the same order as keys
+        dtype : 'str'
+            Data type of the array. float32 halves the memory of the store and
+            is ample precision for hourly load and capacity factor profiles.
+
+        Returns
+        -------
+        'HourlyProfiles'
+        """
+        keys = list(keys)
+        array = np.empty((HOURS_PER_YEAR, len(keys)), dtype=dtype, order='F')
+        for i, profile in enumerate(profiles):
+            array[:, i] = profile
+
+        return cls(keys, array)
+
+    def __getstate__(self):
+        state = {'keys': self.keys}
+        if self._shm is not None:
+            state.update({'shm_name': self._shm.name, 'shape': self.array.shape, 'dtype': self.array.dtype.str})
+        else:
+            state['array'] = self.array
+
+        return state
+
+    def __setstate__(self, state):
+        self.keys = state['keys']
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self._owner = False
+
+        if 'shm_name' in state:
+            self._shm = shared_memory.SharedMemory(name=state['shm_name'])
+            # the creating process unlinks the block; keep this process's resource tracker
+            # from unlinking it as well when the worker exits
+            if mp.get_start_method() != 'fork':
+                resource_tracker.unregister(self._shm._name, 'shared_memory')
+            self.array = np.ndarray(state['shape'], dtype=state['dtype'], buffer=self._shm.buf, order='F')
+            self.array.flags.writeable = False
+        else:
+            self._shm = None
+            self.array = state['array']
+
+    def share(self):
+        """
+        Move the profiles into a new shared memory block owned by this process.
+        Call close() when the store is no longer needed to free the block.
+        """
+        if self._shm is not None:
+            return self
+
+        shm = shared_memory.SharedMemory(create=True, size=max(self.array.nbytes, 1))
+        shared_array = np.ndarray(self.array.shape, dtype=self.array.dtype, buffer=shm.buf, order='F')
+        shared_array[:] = self.array
+
+        self.array = shared_array
+        self._shm = shm
+        self._owner = True
+
+        return self
+
+    def close(self):
+        """
+        Detach from the shared memory block, and free it if this process created it.
+        The store cannot be used afterwards.
+        """
+        if self._shm is None:
+            return
+
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+        self._owner = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __repr__(self):
+        return '{} with {} profiles'.format(self.__class__.__name__, len(self))
+
+    def get(self, key):
+        """
+        Return the profile for key as a view into the store. Do not modify the returned array.
+        """
+        return self.array[:, self.index[key]]
+
+    def column(self, i):
+        """
+        Return the profile in column i as a view into the store. Do not modify the returned array.
+        """
+        return self.array[:, i]
+
+    def index_of(self, keys):
+        """
+        Return the column of each key, or -1 for keys not in the store.
+        Agents carry these integer columns instead of the profiles themselves.
+
+        Parameters
+        ----------
+        keys : 'iterable'
+            Profile keys
+
+        Returns
+        -------
+        'numpy.ndarray'
+            Integer column of each key
+        """
+        return np.array([self.index.get(key, -1) for key in keys], dtype='int64')
+
+
+#%%
+class ProfileCache(object):
+    """
+    Deduplicated cache of hourly profiles. Profiles are served from a prefetched
+    HourlyProfiles store when present, and otherwise loaded on first use and kept 
+    in a least-recently-used cache of bounded size. Each process holds its own 
+    cache of misses; the prefetched store is shared.
+    """
+    def __init__(self, store=None, max_size=1000):
+        """
+        Initialize ProfileCache Class
+        Parameters
+        ----------
+        store : 'HourlyProfiles'
+            Profiles loaded in bulk ahead of time
+        max_size : 'int'
+            Maximum number of profiles held in addition to the store
+        """
+        self.store = store
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+    def __repr__(self):
+        return ('{} with {} stored and {} cached profiles'
+                .format(self.__class__.__name__, 0 if self.store is None else len(self.store), len(self.cache)))
+
+    def __getstate__(self):
+        # workers start with an empty cache of misses
+        return {'store': self.store, 'max_size': self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get(self, key, loader):
+        """
+        Return the profile for key
+
+        Parameters
+        ----------
+        key : 'tuple'
+            Profile key
+        loader : 'function'
+            Called with no arguments to load the profile if it is not stored or cached
+
+        Returns
+        -------
+        'numpy.ndarray'
+            Hourly profile. Do not modify the returned array.
+        """
+        if self.store is not None and key in self.store:
+            return self.store.get(key)
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        profile = np.asarray(loader())
+        self.cache[key] = profile
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+        return profile
+
+    def close(self):
+        """
+        Close the store and clear the cache
+        """
+        if self.store is not None:
+            self.store.close()
+        self.cache.clear()
@@ -1,7 +1,8 @@
 import pandas as pd
 import numpy as np
 import os
-import sqlalchemy
+from io import StringIO
+import config
 import data_functions as datfunc
 import utility_functions as utilfunc
 import agent_mutation
@@ -37,9 +38,175 @@ def get_psql_table_fields(engine, schema, name):
     sql = "SELECT column_name FROM information_schema.columns WHERE table_schema = '{}' AND table_name   = '{}'".format(schema, name)
     return np.concatenate(pd.read_sql_query(sql, engine).values)
 
+# types whose values are serialized to strings before writing to the database (see get_psql_columns)
+PSQL_TRANSFORMED_TYPES = ['list', 'ndarray', 'dict', 'interval', 'dataframe']
+
+
+def is_null(value):
+    """
+    Return True for the nulls of object columns, None and NaN
+    """
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def encode_json_arrays(series):
+    """
+    JSON-encode a column of lists or 1d arrays. Columns of equal-length, finite numeric arrays
+    are stacked into one 2d array and formatted in a single pass; other columns are encoded row by row.
+
+    Parameters
+    ----------
+    series : 'pd.Series'
+        Column of lists or arrays, possibly with nulls
+
+    Returns
+    -------
+    'pd.Series'
+        JSON strings, with None for nulls
+    """
+    encoded = pd.Series([None] * len(series), index=series.index, dtype=object)
+    notnull = ~series.map(is_null).values
+    values = series.values[notnull]
+    if len(values) == 0:
+        return encoded
+
+    stacked = None
+    if len(set(len(x) for x in values)) == 1 and len(values[0]) > 0:
+        stacked = np.vstack(values)
+        if stacked.shape[0] != len(values) or stacked.dtype.kind not in 'iuf' or (stacked.dtype.kind == 'f' and not np.isfinite(stacked).all()):
+            stacked = None
+
+    if stacked is not None:
+        rows = pd.DataFrame(stacked).to_csv(header=False, index=False, sep=',').splitlines()
+        encoded[notnull] = ['[' + row.replace(',', ', ') + ']' for row in rows]
+    else:
+        encoded[notnull] = [json.dumps(np.asarray(x).tolist() if isinstance(x, np.ndarray) else x) for x in values]
+
+    return encoded
+
+
+def encode_json_dicts(series):
+    """
+    JSON-encode a column of dicts, writing array values as lists
+
+    Parameters
+    ----------
+    series : 'pd.Series'
+        Column of dicts, possibly with nulls
+
+    Returns
+    -------
+    'pd.Series'
+        JSON strings, with None for nulls
+    """
+    return series.map(lambda x: json.dumps({k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in x.items()})
+                      if isinstance(x, dict) else None)
+
+
+def get_psql_columns(df, append_transformations=False):
+    """
+    Map each column of a dataframe to the database column it is written to. The type of each column
+    is taken from its dtype, or from its first non-null value for object columns, once per write.
+    All-null columns are not written.
+
+    Parameters
+    ----------
+    df : 'pd.df'
+        Dataframe with lower case column names
+    append_transformations : 'bool'
+        If True, columns serialized to strings are written with the name of their type appended, e.g. 'cash_flow_ndarray'
+
+    Returns
+    -------
+    'list'
+        (column, database column, database type, encoder) of each column to write. encoder is None for 
+        columns written as they are, or a function of the column returning its string values.
+    """
+    columns = []
+    for f in df.columns:
+        series = df[f]
+        kind = series.dtype.kind
+        if kind == 'b':
+            f_d_type = 'bool'
+        elif kind in 'iu':
+            f_d_type = 'int'
+        elif kind == 'f':
+            f_d_type = 'float'
+        elif kind == 'M':
+            f_d_type = 'datetime'
+        else:
+            df_filter = pd.notnull(series).values
+            if df_filter.sum() == 0:
+                continue
+            f_d_type = type(series.values[df_filter][0]).__name__.lower()
+
+        if kind in 'fM' and series.isnull().all():
+            continue
+
+        encoder = None
+        if f_d_type.startswith('bool'):
+            sql_type = 'BOOLEAN'
+        elif f_d_type.startswith('int') and f_d_type not in PSQL_TRANSFORMED_TYPES:
+            sql_type = 'BIGINT'
+        elif f_d_type.startswith('float'):
+            sql_type = 'NUMERIC'
+        elif f_d_type in ['datetime', 'timestamp']:
+            sql_type = 'TIMESTAMP'
+        elif f_d_type in ['list', 'ndarray']:
+            sql_type = 'VARCHAR'
+            encoder = encode_json_arrays
+        elif f_d_type == 'dict':
+            sql_type = 'VARCHAR'
+            encoder = encode_json_dicts
+        elif f_d_type == 'dataframe':
+            sql_type = 'VARCHAR'
+            encoder = lambda s: s.map(lambda x: x.to_json() if isinstance(x, DataFrame) else (None if is_null(x) else str(x)))
+        else:
+            sql_type = 'VARCHAR'
+            if not f_d_type.startswith('str'):
+                encoder = lambda s: s.map(lambda x: None if is_null(x) else str(x))
+
+        name = f + '_' + f_d_type if append_transformations and f_d_type in PSQL_TRANSFORMED_TYPES else f
+        columns.append((f, name, sql_type, encoder))
+
+    return columns
+
+
+def write_psql_batch(cur, df, schema, name, columns):
+    """
+    Load a batch of rows into a table with COPY ... FROM STDIN in csv format
+
+    Parameters
+    ----------
+    cur : 'SQL cursor'
+        Cursor of the connection the table is written with
+    df : 'pd.df'
+        Batch of rows to write
+    schema : 'SQL schema'
+        Schema of the table
+    name : 'string'
+        Name of the table
+    columns : 'list'
+        Columns to write, from get_psql_columns
+    """
+    batch = pd.DataFrame({db_name: df[f] if encoder is None else encoder(df[f]) for f, db_name, _, encoder in columns},
+                         index=df.index)
+
+    s = StringIO()
+    batch.to_csv(s, header=False, index=False, na_rep='\\N')
+    s.seek(0)
+
+    sql = 'COPY {}."{}" ({}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')'.format(
+        schema, name, ', '.join('"{}"'.format(db_name) for _, db_name, _, _ in columns))
+    cur.copy_expert(sql, s)
+    s.close()
+
+
 def df_to_psql(df, engine, schema, owner, name, if_exists='replace', append_transformations=False):
     """
-    Uploads dataframe to database
+    Uploads dataframe to database. Column types are mapped once per column (get_psql_columns), array
+    and dict columns are serialized to JSON strings, and rows are loaded with COPY in batches of 
+    config.PSQL_COPY_BATCH_ROWS rows within one transaction.
     
     Parameters
     ----------
@@ -56,7 +223,7 @@ def df_to_psql(df, engine, schema, owner, name, if_exists='replace', append_tran
     if_exists : 'replace or append'
         If table exists and if if_exists set to replace, replaces table in database. If table exists and if if_exists set to append, appendss table in database. 
     append_transformations : 'bool'
-        IDK
+        If True, columns serialized to strings are written with the name of their type appended, e.g. 'cash_flow_ndarray'
     
     Returns
     -------
@@ -65,84 +232,39 @@ def df_to_psql(df, engine, schema, owner, name, if_exists='replace', append_tran
 
     """
 
-    d_types = {}
-    transform = {}
-    f_d_type = {}
-    sql_type = {}
-
-    delete_list = []
-    orig_fields = df.columns.values
-    df.columns = [i.lower() for i in orig_fields]
-    for f in df.columns:
-        df_filter = pd.notnull(df[f]).values
-        if sum(df_filter) > 0:
-            f_d_type[f] = type(df[f][df_filter].values[0]).__name__.lower()
-
-            if f_d_type[f][0:3].lower() == 'int':
-                sql_type[f] = 'INTEGER'
-
-            if f_d_type[f][0:5].lower() == 'float':
-                d_types[f] = sqlalchemy.types.NUMERIC
-                sql_type[f] = 'NUMERIC'
-
-            if f_d_type[f][0:3].lower() == 'str':
-                sql_type[f] = 'VARCHAR'
-
-            if f_d_type[f] == 'list':
-                d_types[f] = sqlalchemy.types.ARRAY(sqlalchemy.types.STRINGTYPE)
-                transform[f] = lambda x: json.dumps(x)
-                sql_type[f] = 'VARCHAR'
-
-            if f_d_type[f] == 'ndarray':
-                d_types[f] = sqlalchemy.types.ARRAY(sqlalchemy.types.STRINGTYPE)
-                transform[f] = lambda x: json.dumps(list(x))
-                sql_type[f] = 'VARCHAR'
-
-            if f_d_type[f] == 'dict':
-                d_types[f] = sqlalchemy.types.STRINGTYPE
-                transform[f] = lambda x: json.dumps(
-                    dict([(k_v[0], list(k_v[1])) if (type(k_v[1]).__name__ == 'ndarray') else (k_v[0], k_v[1]) for k_v in list(x.items())]))
-                sql_type[f] = 'VARCHAR'
-
-            if f_d_type[f] == 'interval':
-                d_types[f] = sqlalchemy.types.STRINGTYPE
-                transform[f] = lambda x: str(x)
-                sql_type[f] = 'VARCHAR'
-
-            if f_d_type[f] == 'dataframe':
-                d_types[f] = sqlalchemy.types.STRINGTYPE
-                transform[f] = lambda x: x.to_json() if isinstance(x,DataFrame) else str(x)
-                sql_type[f] = 'VARCHAR'
-        else:
-            orig_fields = [i for i in orig_fields if i.lower()!=f]
-            delete_list.append(f)
-
-    df = df.drop(delete_list, axis=1)
-
-    for k, v in list(transform.items()):
-        if append_transformations:
-            df[k + "_" + f_d_type[k]] = df[k].apply(v)
-            sql_type[k + "_" + f_d_type[k]] = sql_type[k]
-            del df[k]
-            del sql_type[k]
-        else:
-            df[k] = df[k].apply(v)   
-
-    conn = engine.connect()
-    if if_exists == 'append':
-        fields = [i.lower() for i in get_psql_table_fields(engine, schema, name)]
-        for f in list(set(df.columns.values) - set(fields)):
-            sql = "ALTER TABLE {}.{} ADD COLUMN {} {}".format(schema, name, f, sql_type[f])
-            conn.execute(sql)
-        
-    df.to_sql(name, engine, schema=schema, index=False, dtype=d_types, if_exists=if_exists)
-    sql = 'ALTER TABLE {}."{}" OWNER to "{}"'.format(schema, name, owner)
-    conn.execute(sql)
-
-    conn.close()
-    engine.dispose() 
+    if if_exists not in ['replace', 'append']:
+        raise ValueError("if_exists must be 'replace' or 'append', not {}".format(if_exists))
+
+    df_lower = df.rename(columns=lambda f: f.lower())
+    columns = get_psql_columns(df_lower, append_transformations)
+    column_defs = ', '.join('"{}" {}'.format(db_name, sql_type) for _, db_name, sql_type, _ in columns)
+
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        if if_exists == 'replace':
+            cur.execute('DROP TABLE IF EXISTS {}."{}"'.format(schema, name))
+        cur.execute('CREATE TABLE IF NOT EXISTS {}."{}" ({})'.format(schema, name, column_defs))
+
+        if if_exists == 'append':
+            cur.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = %s AND table_name = %s", (schema, name))
+            fields = [row[0].lower() for row in cur.fetchall()]
+            for _, db_name, sql_type, _ in columns:
+                if db_name not in fields:
+                    cur.execute('ALTER TABLE {}."{}" ADD COLUMN "{}" {}'.format(schema, name, db_name, sql_type))
+
+        batch_rows = config.PSQL_COPY_BATCH_ROWS
+        for start in range(0, len(df_lower), batch_rows):
+            write_psql_batch(cur, df_lower.iloc[start:start + batch_rows], schema, name, columns)
+
+        cur.execute('ALTER TABLE {}."{}" OWNER to "{}"'.format(schema, name, owner))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-    df.columns = orig_fields
     return df
     
 
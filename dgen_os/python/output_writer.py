@@ -0,0 +1,216 @@
+"""
+Background writer that persists model outputs while the model goes on to the next year,
+and the parquet dataset of agent outputs.
+"""
+
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import utility_functions as utilfunc
+import config
+
+#==============================================================================
+# Load logger
+logger = utilfunc.get_logger()
+#==============================================================================
+
+
+#%%
+class OutputWriter(object):
+    """
+    Runs output writes on a background thread, in the order they are submitted, so that
+    writing one model year overlaps with computing the next. At most max_queued writes wait
+    in the queue; submit() blocks while it is full, which bounds the memory held by pending outputs.
+
+    Submitted writes must not be modified after they are handed off (pass a copy of any data
+    the model goes on to change). If a write fails, the writes after it are skipped and the
+    error is raised by the next call to submit(), flush() or close().
+
+    With background=False, writes run immediately in the calling thread.
+    """
+    def __init__(self, background=config.OUTPUT_WRITER_BACKGROUND, max_queued=config.OUTPUT_WRITER_MAX_QUEUED):
+        """
+        Initialize OutputWriter Class
+        Parameters
+        ----------
+        background : 'bool'
+            If True, run writes on a background thread
+        max_queued : 'int'
+            Maximum number of writes waiting to run
+        """
+        self.background = background
+        self.error = None
+        self.queue = None
+        self.thread = None
+
+        if background:
+            self.queue = queue.Queue(maxsize=max_queued)
+            self.thread = threading.Thread(target=self._run, name='OutputWriter', daemon=True)
+            self.thread.start()
+
+    def __repr__(self):
+        pending = 0 if self.queue is None else self.queue.qsize()
+        return '{} with {} pending writes'.format(self.__class__.__name__, pending)
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                if self.error is None:
+                    func, args, kwargs = task
+                    func(*args, **kwargs)
+            except Exception as e:
+                logger.error('Output write failed: {}'.format(e), exc_info=True)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) after the writes submitted before it
+
+        Parameters
+        ----------
+        func : 'function'
+            Write to run
+        """
+        self._raise_error()
+        if not self.background:
+            func(*args, **kwargs)
+            return
+
+        self.queue.put((func, args, kwargs))
+
+    def flush(self):
+        """
+        Wait for all submitted writes to finish and raise the error of any that failed
+        """
+        if self.background:
+            self.queue.join()
+        self._raise_error()
+
+    def close(self, discard=False):
+        """
+        Finish the submitted writes and stop the background thread
+
+        Parameters
+        ----------
+        discard : 'bool'
+            If True, skip the writes that have not started yet and do not raise errors, e.g. when
+            closing the writer after the model has failed
+        """
+        if self.thread is None:
+            if not discard:
+                self._raise_error()
+            return
+
+        if discard:
+            self.error = self.error or RuntimeError('Output writer closed')
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        # any later writes run immediately
+        self.background = False
+
+        if discard:
+            self.error = None
+        else:
+            self._raise_error()
+
+
+#%%
+def object_column_to_arrow(series):
+    """
+    Convert an object column to an arrow array. Columns of lists or arrays become list columns of
+    the dtype of their first value, with nulls for missing (non-list) values. Columns arrow cannot
+    convert, or that are all null, are written as strings so that every year has the same schema.
+
+    Parameters
+    ----------
+    series : 'pd.Series'
+        Object column
+
+    Returns
+    -------
+    'pyarrow.Array'
+    """
+    is_list = series.map(lambda x: isinstance(x, (list, tuple, np.ndarray))).values
+    if is_list.any():
+        values = [np.asarray(x) if listed else None for x, listed in zip(series.values, is_list)]
+        first = values[is_list.argmax()]
+        return pa.array(values, type=pa.list_(pa.from_numpy_dtype(first.dtype)))
+
+    try:
+        array = pa.array(series, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        array = None
+    if array is None or pa.types.is_null(array.type):
+        array = pa.array(series.map(lambda x: None if pd.isnull(x) else str(x)), type=pa.string())
+
+    return array
+
+
+def agents_to_arrow(df):
+    """
+    Convert agent outputs to an arrow table, with the index as a column if it is named.
+    String columns are dictionary-encoded.
+
+    Parameters
+    ----------
+    df : 'pd.df'
+        Agent outputs
+
+    Returns
+    -------
+    'pyarrow.Table'
+    """
+    if df.index.name is not None:
+        df = df.reset_index()
+
+    arrays = []
+    for f in df.columns:
+        series = df[f]
+        if series.dtype == object:
+            array = object_column_to_arrow(series)
+        else:
+            array = pa.array(series, from_pandas=True)
+        if pa.types.is_string(array.type):
+            array = array.dictionary_encode()
+        arrays.append(array)
+
+    return pa.Table.from_arrays(arrays, names=[str(f) for f in df.columns])
+
+
+def write_agent_parquet(df, root_path, scenario, compression=config.AGENT_PARQUET_COMPRESSION):
+    """
+    Write one model year of agent outputs to a parquet dataset partitioned by scenario, year and state,
+    i.e. files in root_path/scenario=.../year=.../state_abbr=.../
+
+    Parameters
+    ----------
+    df : 'pd.df'
+        Agent outputs of one model year, with year and state_abbr columns
+    root_path : 'str'
+        Directory of the dataset
+    scenario : 'str'
+        Scenario partition of the outputs
+    compression : 'str'
+        Parquet compression codec, e.g. 'snappy', 'zstd' or 'gzip', or None
+    """
+    table = agents_to_arrow(df)
+    table = table.append_column('scenario', pa.array([scenario] * table.num_rows, type=pa.string()).dictionary_encode())
+
+    os.makedirs(root_path, exist_ok=True)
+    pq.write_to_dataset(table, root_path, partition_cols=['scenario', 'year', 'state_abbr'],
+                        compression=compression, use_dictionary=True)
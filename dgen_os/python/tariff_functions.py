@@ -1,6 +1,9 @@
 """
 
-Deprecated. Nullified by new PySAM code and will be taken out in Beta release.
+Tariff classes and bill_calculator are deprecated. Nullified by new PySAM code and will be taken out in Beta release.
+
+compile_bill_arrays and calc_annual_bills are a vectorized bill engine that can be used
+in place of PySAM Utilityrate5 when sizing systems, see financial_functions.calc_utility_bills.
 
 """
 
@@ -939,6 +942,230 @@ def bill_calculator(load_profile, tariff, export_tariff):
     return annual_bill, results_dict
 
     
+#%%
+# Hours at the start of each month and days in each month of an 8760 year
+MONTH_HOURS = np.array([0, 744, 1416, 2160, 2880, 3624, 4344, 5088, 5832, 6552, 7296, 8016, 8760], int)
+DAYS_PER_MONTH = np.diff(MONTH_HOURS) // 24
+
+# Metering options, same as PySAM Utilityrate5 ur_metering_option
+NET_METERING = 0
+NET_BILLING = 2
+BUY_ALL_SELL_ALL = 4
+
+# Utilityrate5 years start on a Monday (start_day of build_8760_from_12by24s)
+UTILITYRATE_START_DAY = 0
+
+
+def compile_bill_arrays(tariff_dict):
+    """
+    Convert an agent's rate json object into the arrays used by calc_annual_bills.
+
+    Parameters
+    ----------
+    tariff_dict : 'dict'
+        Agent's rate json object
+
+    Returns
+    -------
+    bill_arrays : 'dict'
+        Fixed charge, tier levels and prices, and 8760 period schedules of the tariff.
+        None if the tariff has a structure calc_annual_bills does not support 
+        (energy tiers per kW of demand, energy tiers in more than one TOU period, 
+        or flat demand charges not given by month), or lacks energy charges or one of 
+        flat and TOU demand charges while having demand charges. Utilityrate5 bills these 
+        tariffs with the tables of its defaults, see financial_functions.compile_tariff.
+    """
+    if not tariff_dict['e_exists'] or tariff_dict['d_flat_exists'] != tariff_dict['d_tou_exists']:
+        return None
+
+    bill_arrays = {'fixed_charge': float(tariff_dict['fixed_charge'])}
+
+    energy_rate_unit = tariff_dict.get('energy_rate_unit', 'kWh')
+    if energy_rate_unit not in ['kWh', 'kWh daily']:
+        return None
+
+    # tier levels by month, tier and period
+    e_levels = np.array(tariff_dict['e_levels'], float)
+    # Utilityrate5 allocates tiered TOU usage to tiers hour by hour, which is not reproduced here
+    if e_levels.shape[0] > 1 and e_levels.shape[1] > 1:
+        return None
+
+    if energy_rate_unit == 'kWh daily':
+        e_levels = DAYS_PER_MONTH[:, np.newaxis, np.newaxis] * e_levels[np.newaxis, :, :]
+    else:
+        e_levels = np.repeat(e_levels[np.newaxis, :, :], 12, axis=0)
+
+    bill_arrays['e_levels'] = e_levels
+    bill_arrays['e_prices'] = np.array(tariff_dict['e_prices'], float)
+    bill_arrays['e_periods'] = build_8760_from_12by24s(np.array(tariff_dict['e_wkday_12by24']), np.array(tariff_dict['e_wkend_12by24']), start_day=UTILITYRATE_START_DAY)
+
+    if tariff_dict['d_tou_exists']:
+        bill_arrays['d_tou_levels'] = np.array(tariff_dict['d_tou_levels'], float)
+        bill_arrays['d_tou_prices'] = np.array(tariff_dict['d_tou_prices'], float)
+        bill_arrays['d_tou_periods'] = build_8760_from_12by24s(np.array(tariff_dict['d_wkday_12by24']), np.array(tariff_dict['d_wkend_12by24']), start_day=UTILITYRATE_START_DAY)
+
+    if tariff_dict['d_flat_exists']:
+        d_flat_levels = np.array(tariff_dict['d_flat_levels'], float)
+        if d_flat_levels.shape[1] != 12:
+            return None
+
+        bill_arrays['d_flat_levels'] = d_flat_levels
+        bill_arrays['d_flat_prices'] = np.array(tariff_dict['d_flat_prices'], float)
+
+    return bill_arrays
+
+
+def tiered_charges(values, levels, prices):
+    """
+    Charges for values billed in tiers. Tier levels are the cumulative upper limit of 
+    each tier; anything above the last level is billed at the last tier's price.
+    Negative values are not charged.
+
+    Parameters
+    ----------
+    values : 'numpy.ndarray'
+        Usage or demand, any shape
+    levels : 'numpy.ndarray'
+        Tier levels, tiers in the first dimension and the rest broadcastable to values
+    prices : 'numpy.ndarray'
+        Tier prices, same shape as levels
+
+    Returns
+    -------
+    charges : 'numpy.ndarray'
+        Same shape as values
+    """
+    charges = np.zeros(np.shape(values))
+    lower = 0.
+    n_tiers = len(levels)
+    for tier in range(n_tiers):
+        upper = levels[tier] if tier < n_tiers - 1 else np.inf
+        charges += prices[tier] * np.clip(values - lower, 0, upper - lower)
+        lower = upper
+
+    return charges
+
+
+def sum_by_month_and_period(hourly, periods, n_periods):
+    """
+    Sum each row of an (n x 8760) array by month and period, returns an (n x 12 x n_periods) array
+    """
+    sums = np.zeros((hourly.shape[0], 12, n_periods))
+    for month in range(12):
+        start, end = MONTH_HOURS[month], MONTH_HOURS[month + 1]
+        for period in range(n_periods):
+            mask = periods[start:end] == period
+            sums[:, month, period] = hourly[:, start:end][:, mask].sum(axis=1)
+
+    return sums
+
+
+def max_by_month_and_period(hourly, periods, n_periods):
+    """
+    Maximum of each row of an (n x 8760) array by month and period, returns an (n x 12 x n_periods) array
+    """
+    maxs = np.zeros((hourly.shape[0], 12, n_periods))
+    for month in range(12):
+        start, end = MONTH_HOURS[month], MONTH_HOURS[month + 1]
+        for period in range(n_periods):
+            mask = periods[start:end] == period
+            if mask.any():
+                maxs[:, month, period] = hourly[:, start:end][:, mask].max(axis=1)
+
+    return maxs
+
+
+def calc_annual_bills(load, gen, bill_arrays, metering_option=NET_METERING, sell_rate=0., yearend_sell_rate=0.):
+    """
+    Vectorized annual electricity bills for many load and generation profiles on one tariff.
+
+    Energy charges are tiered by month and period. Net metering nets energy within each month 
+    and period, carries surplus kWh forward to later months, and credits surplus left at the end 
+    of the year at yearend_sell_rate. Net billing charges hourly imports and credits hourly exports 
+    at sell_rate. Buy all sell all charges the whole load and credits all generation at sell_rate;
+    negative generation (a battery charging from the grid) is charged at the first tier price of its period.
+    Demand charges apply to the monthly (flat) and monthly per period (TOU) maximum grid demand; under
+    buy all sell all, the peaks of the load and of battery charging are added.
+
+    Parameters
+    ----------
+    load : 'numpy.ndarray'
+        (n x 8760) hourly load [kWh]
+    gen : 'numpy.ndarray'
+        (n x 8760) hourly generation [kWh]
+    bill_arrays : 'dict'
+        Compiled tariff, see compile_bill_arrays
+    metering_option : 'int'
+        NET_METERING, NET_BILLING or BUY_ALL_SELL_ALL
+    sell_rate : 'float'
+        Compensation for exported generation under net billing and buy all sell all [$/kWh]
+    yearend_sell_rate : 'float'
+        Compensation for surplus generation at the end of the year under net metering [$/kWh]
+
+    Returns
+    -------
+    annual_bills : 'numpy.ndarray'
+        (n,) annual bills [$]
+    """
+    load = np.atleast_2d(np.asarray(load, float))
+    gen = np.atleast_2d(np.asarray(gen, float))
+
+    if metering_option == BUY_ALL_SELL_ALL:
+        imported = load
+        exported = np.clip(gen, 0, None)
+        charging = np.clip(-gen, 0, None)
+        demands = [load, charging]
+    else:
+        net = load - gen
+        imported = np.clip(net, 0, None)
+        exported = np.clip(-net, 0, None)
+        demands = [imported]
+
+    annual_bills = np.full(load.shape[0], 12. * bill_arrays['fixed_charge'])
+
+    # energy charges
+    if 'e_levels' in bill_arrays:
+        e_prices = bill_arrays['e_prices']
+        n_periods = e_prices.shape[1]
+        # tier levels by tier, month and period
+        e_levels = np.transpose(bill_arrays['e_levels'], (1, 0, 2))
+        e_prices = e_prices[:, np.newaxis, :]
+
+        if metering_option == NET_METERING:
+            net_sums = sum_by_month_and_period(net, bill_arrays['e_periods'], n_periods)
+            usage = np.zeros(net_sums.shape)
+            carryover = np.zeros((net.shape[0], n_periods))
+            for month in range(12):
+                month_net = net_sums[:, month, :] - carryover
+                usage[:, month, :] = np.clip(month_net, 0, None)
+                carryover = np.clip(-month_net, 0, None)
+            annual_bills += tiered_charges(usage, e_levels, e_prices).sum(axis=(1, 2))
+            annual_bills -= carryover.sum(axis=1) * yearend_sell_rate
+        else:
+            import_sums = sum_by_month_and_period(imported, bill_arrays['e_periods'], n_periods)
+            annual_bills += tiered_charges(import_sums, e_levels, e_prices).sum(axis=(1, 2))
+            annual_bills -= exported.sum(axis=1) * sell_rate
+            if metering_option == BUY_ALL_SELL_ALL:
+                charging_sums = sum_by_month_and_period(charging, bill_arrays['e_periods'], n_periods)
+                annual_bills += (charging_sums * e_prices[0]).sum(axis=(1, 2))
+    elif metering_option != NET_METERING:
+        annual_bills -= exported.sum(axis=1) * sell_rate
+
+    # demand charges on grid demand
+    if 'd_tou_levels' in bill_arrays:
+        d_tou_prices = bill_arrays['d_tou_prices']
+        n_periods = d_tou_prices.shape[1]
+        tou_maxs = sum(max_by_month_and_period(demand, bill_arrays['d_tou_periods'], n_periods) for demand in demands)
+        annual_bills += tiered_charges(tou_maxs, bill_arrays['d_tou_levels'][:, np.newaxis, :], d_tou_prices[:, np.newaxis, :]).sum(axis=(1, 2))
+
+    if 'd_flat_levels' in bill_arrays:
+        flat_maxs = sum(np.stack([demand[:, MONTH_HOURS[month]:MONTH_HOURS[month + 1]].max(axis=1) for month in range(12)], axis=1)
+                        for demand in demands)
+        annual_bills += tiered_charges(flat_maxs, bill_arrays['d_flat_levels'], bill_arrays['d_flat_prices']).sum(axis=1)
+
+    return annual_bills
+
+
 #%%
 # Bulk Downloader from URDB API
 def download_tariffs_from_urdb(api_key, sector=None, utility=None, print_progress=False):
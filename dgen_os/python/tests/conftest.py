@@ -0,0 +1,252 @@
+"""
+Shared fixtures of the dGen model tests: synthetic agents, tariffs and hourly profiles
+that can be sized without a database connection.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# model modules are imported by name from dgen_os/python
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import config
+import hourly_profiles
+import agent_mutation
+import financial_functions
+import PySAM
+
+
+HOURS = np.arange(8760)
+
+# comparisons with the PySAM modules need the PySAM 2 interface the model is written against (see dg3n.yml)
+requires_pysam_2 = pytest.mark.skipif(str(PySAM.__version__).split('.')[0] != '2',
+                                      reason='PySAM {} does not have the PySAM 2 interface'.format(PySAM.__version__))
+
+TARIFF_KINDS = ['flat', 'tiered', 'tou', 'tiered_tou', 'daily', 'demand_flat', 'demand_tou', 'per_kw', 'demand']
+
+
+#%%
+def make_load_profile(seed=0, peak_hour=18):
+    """
+    Normalized hourly load profile with a daily peak at peak_hour and a summer peak
+    """
+    rng = np.random.RandomState(seed)
+    daily = 1. + 0.6 * np.exp(-0.5 * ((HOURS % 24 - peak_hour) / 3.) ** 2)
+    seasonal = 1. + 0.3 * np.cos(2. * np.pi * (HOURS / 8760. - 0.55))
+    profile = daily * seasonal * rng.uniform(0.8, 1.2, 8760)
+
+    return profile / profile.sum()
+
+
+def make_solar_cf_profile(seed=0):
+    """
+    Hourly solar capacity factor profile, zero at night
+    """
+    rng = np.random.RandomState(seed)
+    hour = HOURS % 24
+    sun = np.clip(np.sin(np.pi * (hour - 6) / 12.), 0, None)
+    seasonal = 1. + 0.25 * np.cos(2. * np.pi * (HOURS / 8760. - 0.47))
+    clouds = rng.uniform(0.5, 1., 8760)
+
+    return 0.8 * sun * seasonal * clouds
+
+
+def make_12by24(periods_by_hour, summer_periods_by_hour=None):
+    """
+    12x24 period schedule with periods_by_hour in every month, or summer_periods_by_hour in June to September
+    """
+    schedule = [list(periods_by_hour) for month in range(12)]
+    if summer_periods_by_hour is not None:
+        for month in range(5, 9):
+            schedule[month] = list(summer_periods_by_hour)
+
+    return schedule
+
+
+def make_tariff(kind='flat', fixed_charge=10.):
+    """
+    Rate json object of a synthetic tariff
+
+    Parameters
+    ----------
+    kind : 'str'
+        'flat', 'tiered', 'tou', 'tiered_tou', 'daily' (tiers in kWh daily), 'demand_flat', 'demand_tou',
+        'demand' (flat and TOU demand charges) or 'per_kw' (tiers in kWh/kW). The vectorized bill engine
+        does not support 'tiered_tou', 'per_kw', and tariffs with only one of flat and TOU demand charges.
+    """
+    tariff = {'fixed_charge': fixed_charge,
+              'e_exists': True, 'energy_rate_unit': 'kWh',
+              'e_levels': [[1e10]], 'e_prices': [[0.12]],
+              'e_wkday_12by24': make_12by24([0] * 24), 'e_wkend_12by24': make_12by24([0] * 24),
+              'd_flat_exists': False, 'd_tou_exists': False,
+              'd_wkday_12by24': make_12by24([0] * 24), 'd_wkend_12by24': make_12by24([0] * 24)}
+
+    peak = [0] * 14 + [1] * 6 + [0] * 4
+    if kind in ['tiered', 'daily', 'per_kw']:
+        tariff['e_levels'] = [[500.], [1e10]] if kind != 'daily' else [[15.], [1e10]]
+        tariff['e_prices'] = [[0.10], [0.15]]
+        tariff['energy_rate_unit'] = {'tiered': 'kWh', 'daily': 'kWh daily', 'per_kw': 'kWh/kW'}[kind]
+    elif kind in ['tou', 'tiered_tou']:
+        tariff['e_levels'] = [[1e10, 1e10]] if kind == 'tou' else [[400., 100.], [1e10, 1e10]]
+        tariff['e_prices'] = [[0.09, 0.28]] if kind == 'tou' else [[0.09, 0.28], [0.11, 0.33]]
+        tariff['e_wkday_12by24'] = make_12by24(peak)
+        tariff['e_wkend_12by24'] = make_12by24([0] * 24)
+    if kind in ['demand_flat', 'demand']:
+        tariff['e_prices'] = [[0.08]]
+        tariff['d_flat_exists'] = True
+        tariff['d_flat_levels'] = [[1e10] * 12]
+        tariff['d_flat_prices'] = [[12.] * 5 + [18.] * 4 + [12.] * 3]
+    if kind in ['demand_tou', 'demand']:
+        tariff['e_prices'] = [[0.08]]
+        tariff['d_tou_exists'] = True
+        tariff['d_tou_levels'] = [[1e10, 1e10]]
+        tariff['d_tou_prices'] = [[4., 15.]]
+        tariff['d_wkday_12by24'] = make_12by24([0] * 24, peak)
+        tariff['d_wkend_12by24'] = make_12by24([0] * 24)
+    if kind not in TARIFF_KINDS:
+        raise ValueError('Unknown tariff kind: {}'.format(kind))
+
+    return tariff
+
+
+def make_state_incentives(cbi_usd_p_w=None, ibi_pct=None, pbi_usd_p_kwh=None):
+    """
+    Compiled state incentives, see agent_mutation.elec.compile_state_incentives
+    """
+    incentive_df = pd.DataFrame({'cbi_usd_p_w': [cbi_usd_p_w], 'ibi_pct': [ibi_pct], 'pbi_usd_p_kwh': [pbi_usd_p_kwh],
+                                 'incentive_duration_yrs': [10.], 'max_incentive_usd': [5000.]}, dtype=float)
+
+    return agent_mutation.elec.compile_state_incentives(incentive_df)
+
+
+def make_agent(agent_id=1, sector_abbr='res', tariff_kind='flat', tariff_id=None, incentives=None, **attrs):
+    """
+    Agent with every attribute calc_system_size_and_performance reads. Its profiles are the first
+    columns of the stores returned by make_profile_stores.
+    """
+    commercial = sector_abbr != 'res'
+    agent = {'agent_id': agent_id,
+             'bldg_id': 100 + agent_id, 'sector_abbr': sector_abbr, 'state_abbr': 'CO',
+             'load_kwh_per_customer_in_bin': 60000. if commercial else 9000., 'load_profile_idx': 0,
+             'solar_re_9809_gid': 1, 'tilt': 25, 'azimuth': 'S', 'solar_cf_idx': 0,
+             'tariff_id': tariff_id if tariff_id is not None else 1000 + TARIFF_KINDS.index(tariff_kind),
+             'tariff_dict': make_tariff(tariff_kind), 'eia_id': '15466', 'compensation_style': 'net metering',
+             'wholesale_elec_price_dollars_per_kwh': 0.035, 'elec_price_multiplier': 1.,
+             'elec_price_escalator': 0.005, 'inflation_rate': 0.025, 'economic_lifetime_yrs': 25,
+             'pv_degradation_factor': 0.005, 'developable_roof_sqft': 3000. if commercial else 600.,
+             'pv_kw_per_sqft': 0.015, 'down_payment_fraction': 0.2, 'loan_interest_rate': 0.05,
+             'loan_term_yrs': 20, 'real_discount_rate': 0.06, 'tax_rate': 0.26 if commercial else 0.22,
+             'itc_fraction_of_capex': 0.26, 'batt_lifetime_yrs': 10, 'value_of_resiliency_usd': 0.,
+             'system_capex_per_kw': 2200. if commercial else 2900., 'system_om_per_kw': 18.,
+             'system_variable_om_per_kw': 0., 'cap_cost_multiplier': 1.,
+             'batt_capex_per_kw': 900., 'batt_capex_per_kwh': 450., 'batt_om_per_kw': 10., 'batt_om_per_kwh': 0.,
+             'linear_constant': 1500., 'system_capex_per_kw_combined': 2100. if commercial else 2800.,
+             'batt_capex_per_kw_combined': 850., 'batt_capex_per_kwh_combined': 420.,
+             'batt_om_per_kw_combined': 10., 'batt_om_per_kwh_combined': 0., 'linear_constant_combined': 1200.,
+             'system_kw_with_batt_last_year': np.nan, 'system_kw_no_batt_last_year': np.nan,
+             'sizing_screened_out': False, 'sizing_fidelity': 'fine',
+             'state_incentives': incentives if incentives is not None else dict(),
+             'deprec_sch': [0.6, 0.16, 0.096, 0.0576, 0.0576, 0.03] if commercial else [0.] * 6,
+             'nem_system_kw_limit': 1e6}
+    agent.update(attrs)
+
+    return pd.Series(agent)
+
+
+def make_agent_df(agents):
+    """
+    Agent dataframe indexed by agent_id, as held by agents.Agents
+    """
+    return pd.DataFrame([agent.to_dict() for agent in agents]).set_index('agent_id')
+
+
+def make_profile_stores(n_profiles=2):
+    """
+    Load and solar capacity factor profile stores as loaded by agent_mutation.elec at scenario start
+
+    Returns
+    -------
+    'tuple'
+        (load_profiles, solar_cf_profiles)
+    """
+    load_profiles = hourly_profiles.HourlyProfiles.from_profiles(list(range(n_profiles)),
+                                                                 [make_load_profile(seed) for seed in range(n_profiles)],
+                                                                 dtype=config.HOURLY_PROFILE_DTYPE)
+    solar_cf_store = hourly_profiles.HourlyProfiles.from_profiles(list(range(n_profiles)),
+                                                                  [make_solar_cf_profile(seed) for seed in range(n_profiles)],
+                                                                  dtype=config.HOURLY_PROFILE_DTYPE)
+
+    return load_profiles, hourly_profiles.ProfileCache(solar_cf_store)
+
+
+#%%
+@pytest.fixture(autouse=True)
+def clear_worker_caches():
+    """
+    Clear the compiled tariffs cached by tariff_id, which tests reuse for different tariffs
+    """
+    financial_functions._compiled_tariffs.__dict__.pop('cache', None)
+    yield
+    financial_functions._compiled_tariffs.__dict__.pop('cache', None)
+
+
+@pytest.fixture
+def profile_stores():
+    return make_profile_stores()
+
+
+@pytest.fixture
+def size_agent(profile_stores):
+    """
+    Size one agent with calc_system_size_and_performance, without a rate switch table
+    """
+    load_profiles, solar_cf_profiles = profile_stores
+
+    def size(agent, rate_switch_table=None):
+        return financial_functions.calc_system_size_and_performance(agent.copy(), sectors={'res': 'Residential', 'com': 'Commercial'},
+                                                                    rate_switch_table=rate_switch_table if rate_switch_table is not None else dict(),
+                                                                    load_profiles=load_profiles, solar_cf_profiles=solar_cf_profiles)
+
+    return size
+
+
+@pytest.fixture
+def sizing_args(profile_stores, monkeypatch):
+    """
+    Set up the PySAM modules of an agent as calc_system_size_and_performance does, and return the
+    arguments of evaluate_system_performance between kw and en_batt, and the agent's maximum system size
+    """
+    load_profiles, solar_cf_profiles = profile_stores
+
+    def get_args(agent):
+        captured = dict()
+        def optimize_system_size(args, max_system_kw, tol, last_system_kw=np.nan):
+            captured['args'] = args
+            captured['max_system_kw'] = max_system_kw
+            return financial_functions.optimize.OptimizeResult(x=0.5 * max_system_kw, success=True, nfev=0)
+
+        with monkeypatch.context() as m:
+            m.setattr(financial_functions, 'optimize_system_size', optimize_system_size)
+            financial_functions.calc_system_size_and_performance(agent.copy(), sectors={'res': 'Residential', 'com': 'Commercial'},
+                                                                 rate_switch_table=dict(), load_profiles=load_profiles,
+                                                                 solar_cf_profiles=solar_cf_profiles)
+
+        return captured['args'][1:8], captured['max_system_kw']
+
+    return get_args
+
+
+@pytest.fixture
+def sizing_config(monkeypatch):
+    """
+    Set config settings for the duration of a test, e.g. sizing_config(BILL_BACKEND='numpy')
+    """
+    def set_config(**settings):
+        for setting, value in settings.items():
+            monkeypatch.setattr(config, setting, value)
+
+    return set_config
@@ -0,0 +1,76 @@
+"""
+Parity of the vectorized cash flow engine with the PySAM Cashloan module
+"""
+
+import numpy as np
+import pytest
+
+import config
+import cashflow_functions as cFuncs
+import financial_functions
+
+from conftest import make_agent, make_state_incentives, requires_pysam_2
+
+
+#%%
+@requires_pysam_2
+@pytest.mark.parametrize('sector_abbr, with_deprec_sch', [('res', True), ('com', True), ('com', False)])
+@pytest.mark.parametrize('en_batt', [False, True])
+@pytest.mark.parametrize('with_incentives', [False, True])
+def test_cashloan_outputs_match_pysam(sizing_args, sizing_config, sector_abbr, with_deprec_sch, en_batt, with_incentives):
+    incentives = make_state_incentives(cbi_usd_p_w=0.2, ibi_pct=10., pbi_usd_p_kwh=0.02) if with_incentives else None
+    agent = make_agent(sector_abbr=sector_abbr, incentives=incentives)
+    if not with_deprec_sch:
+        agent = agent.drop('deprec_sch')
+    args, max_system_kw = sizing_args(agent)
+    loan = args[2]
+
+    sizing_config(BILL_BACKEND='pysam', CASHFLOW_BACKEND='pysam')
+    for kw in [0.5, 0.05 * max_system_kw, 0.7 * max_system_kw, max_system_kw]:
+        financial_functions.evaluate_system_performance(kw, *args, en_batt, 0)
+        # commercial agents depreciate by MACRS whether or not they have a deprec_sch
+        assert loan.Depreciation.depr_fed_type == (0 if sector_abbr == 'res' else 1)
+
+        outputs = cFuncs.calc_cashloan_outputs_single(loan)
+
+        assert outputs['npv'] == pytest.approx(loan.Outputs.npv, rel=1e-6, abs=1e-3)
+        assert outputs['payback'] == pytest.approx(loan.Outputs.payback, rel=1e-6, nan_ok=True)
+        np.testing.assert_allclose(outputs['cf_payback_with_expenses'], loan.Outputs.cf_payback_with_expenses, rtol=1e-6, atol=1e-3)
+        for output in ['cbi_total', 'ibi_total']:
+            assert outputs[output] == pytest.approx(getattr(loan.Outputs, output), rel=1e-6, abs=1e-6)
+        np.testing.assert_allclose(outputs['cf_pbi_total'], loan.Outputs.cf_pbi_total, rtol=1e-6, atol=1e-6)
+
+
+@requires_pysam_2
+def test_sizing_matches_between_cashflow_backends(size_agent, sizing_config):
+    agent = make_agent(sector_abbr='com', incentives=make_state_incentives(cbi_usd_p_w=0.2))
+
+    results = dict()
+    for backend in ['pysam', 'numpy']:
+        sizing_config(BILL_BACKEND='pysam', CASHFLOW_BACKEND=backend)
+        results[backend] = size_agent(agent)
+
+    for output in ['system_kw', 'batt_kwh', 'npv', 'payback_period']:
+        assert results['numpy'][output] == pytest.approx(results['pysam'][output], rel=1e-4)
+
+
+@requires_pysam_2
+@pytest.mark.parametrize('en_batt', [False, True])
+def test_pysam_backend_prices_no_system_without_engine(sizing_args, sizing_config, monkeypatch, en_batt):
+    def calc_cashloan_outputs(inputs):
+        raise AssertionError('0 kW system priced by the cash flow engine')
+
+    monkeypatch.setattr(cFuncs, 'calc_cashloan_outputs', calc_cashloan_outputs)
+    agent = make_agent(sector_abbr='com', incentives=make_state_incentives(cbi_usd_p_w=0.2, pbi_usd_p_kwh=0.02))
+    args, max_system_kw = sizing_args(agent)
+
+    sizing_config(BILL_BACKEND='pysam', CASHFLOW_BACKEND='pysam')
+    # the first point of the grid search
+    kw = financial_functions.get_sizing_grid(max_system_kw)[0]
+    assert kw == 0.
+    outputs = financial_functions.evaluate_system_performance(kw, *args, en_batt, 0)
+
+    assert outputs['npv'] == 0.
+    assert np.isnan(outputs['payback'])
+    assert outputs['cf_payback_with_expenses'] == [0.] * (agent['economic_lifetime_yrs'] + 1)
+    assert outputs['cbi_total'] == 0.
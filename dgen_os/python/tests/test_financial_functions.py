@@ -0,0 +1,300 @@
+"""
+Agent sizing in financial_functions
+"""
+
+import inspect
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import agents
+import agent_mutation
+import config
+import financial_functions
+
+from conftest import make_agent, make_agent_df, make_state_incentives, make_tariff, requires_pysam_2
+
+
+#%%
+@requires_pysam_2
+def test_sizing_does_not_depend_on_previous_agent(size_agent):
+    # agent_a leaves incentives, a battery and demand charges on the PySAM modules of the worker
+    agent_a = make_agent(agent_id=1, sector_abbr='com', tariff_kind='demand_tou',
+                         incentives=make_state_incentives(cbi_usd_p_w=0.3, ibi_pct=20., pbi_usd_p_kwh=0.03))
+    agent_b = make_agent(agent_id=2, sector_abbr='com', tariff_kind='flat', compensation_style='net billing')
+
+    alone = size_agent(agent_b)
+    size_agent(agent_a)
+    after_a = size_agent(agent_b)
+
+    for output in ['system_kw', 'batt_kwh', 'npv', 'payback_period', 'first_year_elec_bill_with_system']:
+        assert after_a[output] == pytest.approx(alone[output], rel=1e-9, nan_ok=True)
+    np.testing.assert_allclose(after_a['cash_flow'], alone['cash_flow'], rtol=1e-9)
+    for incentive in ['cbi', 'ibi']:
+        assert after_a[incentive].item()[incentive + '_total'] == alone[incentive].item()[incentive + '_total'] == 0.
+
+
+#%%
+@requires_pysam_2
+@pytest.mark.parametrize('sector_abbr', ['res', 'com'])
+@pytest.mark.parametrize('en_batt', [False, True])
+def test_grid_evaluations_match_single_evaluations(sizing_args, sizing_config, sector_abbr, en_batt):
+    sizing_config(BILL_BACKEND='numpy', CASHFLOW_BACKEND='numpy')
+    agent = make_agent(sector_abbr=sector_abbr, tariff_kind='demand', value_of_resiliency_usd=50.,
+                       incentives=make_state_incentives(cbi_usd_p_w=0.2, pbi_usd_p_kwh=0.02))
+    args, max_system_kw = sizing_args(agent)
+    grid = financial_functions.get_sizing_grid(max_system_kw)
+
+    batched = dict()
+    financial_functions.evaluate_system_grids([(grid, (batched, *args, en_batt, 0))])
+    assert len(batched) == len(grid)
+
+    for kw in grid:
+        single = financial_functions.get_cached_evaluation(kw, dict(), *args, en_batt, 0)
+        evaluation = batched[(round(kw, config.SIZING_EVAL_CACHE_DECIMALS), en_batt)]
+        assert set(evaluation) == set(single)
+        for output in ['neg_npv', 'npv', 'payback', 'elec_cost_with_system_year1', 'annual_energy_kwh', 'cbi_total']:
+            assert evaluation[output] == pytest.approx(single[output], rel=1e-9, abs=1e-9, nan_ok=True)
+        np.testing.assert_allclose(evaluation['cf_payback_with_expenses'], single['cf_payback_with_expenses'], rtol=1e-9, atol=1e-9)
+        if en_batt:
+            assert evaluation['batt_kwh'] == single['batt_kwh']
+            np.testing.assert_array_equal(evaluation['batt_dispatch_profile'], single['batt_dispatch_profile'])
+
+
+@requires_pysam_2
+def test_grid_search_uses_configured_backends(size_agent, sizing_config, monkeypatch):
+    # with Cashloan as the cash flow backend, grid points are evaluated one at a time like the refinement around them
+    def evaluate_system_grids(grids):
+        raise AssertionError('grid evaluated with the numpy engines')
+
+    monkeypatch.setattr(financial_functions, 'evaluate_system_grids', evaluate_system_grids)
+    sizing_config(SIZING_METHOD='grid', BILL_BACKEND='numpy', CASHFLOW_BACKEND='pysam')
+    results = size_agent(make_agent())
+
+    assert results['sizing_evaluations'] >= 2 * config.SIZING_GRID_POINTS
+
+
+@requires_pysam_2
+@pytest.mark.parametrize('system_capex_per_kw, at_max_size', [(20000., False), (100., True)])
+def test_grid_search_finds_boundary_optima(size_agent, sizing_config, system_capex_per_kw, at_max_size):
+    sizing_config(SIZING_METHOD='grid', BILL_BACKEND='numpy', CASHFLOW_BACKEND='numpy')
+    agent = make_agent(tariff_kind='tou', system_capex_per_kw=system_capex_per_kw, system_capex_per_kw_combined=system_capex_per_kw)
+
+    results = size_agent(agent)
+
+    assert results['system_kw'] == pytest.approx(results['max_system_kw'] if at_max_size else 0.)
+
+
+@requires_pysam_2
+@pytest.mark.parametrize('sizing_method', ['brent', 'grid'])
+def test_chunk_sizing_matches_agent_sizing(size_agent, profile_stores, sizing_config, sizing_method):
+    sizing_config(SIZING_METHOD=sizing_method, BILL_BACKEND='numpy', CASHFLOW_BACKEND='numpy', SIZING_GRID_BATCH_AGENTS=2)
+    agent_list = [make_agent(agent_id=1, tariff_kind='tou'),
+                  make_agent(agent_id=2, sector_abbr='com', tariff_kind='demand_flat', load_profile_idx=1, solar_cf_idx=1),
+                  make_agent(agent_id=3, tariff_kind='tiered_tou', compensation_style='net billing'),
+                  make_agent(agent_id=4, tariff_kind='flat', sizing_screened_out=True),
+                  make_agent(agent_id=5, sector_abbr='com', tariff_kind='tou', economic_lifetime_yrs=20)]
+    agent_chunk = pd.DataFrame([agent.to_dict() for agent in agent_list], index=[10, 11, 12, 13, 14])
+    load_profiles, solar_cf_profiles = profile_stores
+
+    results_df = financial_functions.calc_system_size_and_performance_chunk(agent_chunk, sectors={'res': 'Residential', 'com': 'Commercial'},
+                                                                            rate_switch_table=dict(), load_profiles=load_profiles,
+                                                                            solar_cf_profiles=solar_cf_profiles)
+
+    assert list(results_df.index) == list(agent_chunk.index)
+    for idx, agent in agent_chunk.iterrows():
+        expected = size_agent(agent)
+        for output in ['agent_id', 'system_kw', 'batt_kwh', 'npv', 'first_year_elec_bill_with_system', 'sizing_evaluations']:
+            assert results_df.loc[idx, output] == pytest.approx(expected[output], rel=1e-9, nan_ok=True)
+
+
+#%%
+@requires_pysam_2
+def test_deduped_sizing_matches_sizing_every_agent(profile_stores, sizing_config):
+    load_profiles, solar_cf_profiles = profile_stores
+    # agents 1, 3 and 4 and agents 2 and 5 have equal sizing inputs, but differ in agent_id and warm start
+    agent_list = [make_agent(agent_id=1, tariff_kind='tou'),
+                  make_agent(agent_id=2, sector_abbr='com', tariff_kind='demand_flat', load_profile_idx=1, solar_cf_idx=1),
+                  make_agent(agent_id=3, bldg_id=101, tariff_kind='tou', system_kw_with_batt_last_year=4., system_kw_no_batt_last_year=3.),
+                  make_agent(agent_id=4, bldg_id=101, tariff_kind='tou', sizing_fidelity='coarse'),
+                  make_agent(agent_id=5, bldg_id=102, sector_abbr='com', tariff_kind='demand_flat', load_profile_idx=1, solar_cf_idx=1,
+                             sizing_screened_out=True),
+                  make_agent(agent_id=6, tariff_kind='tou', system_capex_per_kw=2500.)]
+    agent_df = financial_functions.align_sizing_settings(make_agent_df(agent_list)).reset_index()
+
+    assert list(agent_df['sizing_fidelity']) == ['fine'] * 6
+    assert list(agent_df['sizing_screened_out']) == [False] * 6
+    assert financial_functions.utilfunc.fingerprint_rows(agent_df, financial_functions.get_sizing_dedupe_cols()).nunique() == 3
+
+    results = dict()
+    for dedupe_cols in [None, financial_functions.get_sizing_dedupe_cols()]:
+        results[dedupe_cols is None] = agents.Agents(agent_df.copy()).chunk_on_row(financial_functions.calc_system_size_and_performance, cores=None,
+                                                                                   in_place=False, dedupe_cols=dedupe_cols,
+                                                                                   chunk_func=financial_functions.calc_system_size_and_performance_chunk,
+                                                                                   sectors={'res': 'Residential', 'com': 'Commercial'},
+                                                                                   rate_switch_table=dict(), load_profiles=load_profiles,
+                                                                                   solar_cf_profiles=solar_cf_profiles)
+
+    deduped, every_agent = results[False], results[True]
+    assert list(deduped['agent_id']) == list(every_agent['agent_id']) == [1, 2, 3, 4, 5, 6]
+    for output in ['system_kw', 'batt_kwh', 'npv', 'payback_period', 'first_year_elec_bill_with_system', 'sizing_evaluations']:
+        np.testing.assert_array_equal(deduped[output].values, every_agent[output].values)
+    assert deduped['npv'].nunique() == 3
+
+
+#%%
+def test_sizing_cache_key_covers_rate_switch_and_data_source():
+    agent = make_agent()
+    sectors = {'res': 'Residential', 'com': 'Commercial'}
+    rate_switch_table = pd.DataFrame({'tech': ['solar', 'storage', 'solar'], 'eia_id': [agent['eia_id'], agent['eia_id'], '999'],
+                                      'res_com': ['R', 'R', 'R'], 'min_kw_limit': [0., 0., 0.], 'max_kw_limit': [1e6, 1e6, 1e6],
+                                      'rate_id_alias': [2001, 2002, 2003], 'one_time_charge': [100., 0., 0.],
+                                      'json': [make_tariff('tou'), make_tariff('demand_tou'), make_tariff('flat')]})
+
+    def get_key(table, data_source=None):
+        return financial_functions.get_sizing_cache_key(agent, sectors, agent_mutation.elec.index_rate_switch_table(table), data_source)
+
+    key = get_key(rate_switch_table)
+    # rates of other utilities are not inputs of the agent
+    assert get_key(rate_switch_table.assign(one_time_charge=[100., 0., 50.])) == key
+    assert get_key(rate_switch_table.assign(one_time_charge=[150., 0., 0.])) != key
+    assert get_key(rate_switch_table.assign(max_kw_limit=[1e6, 10., 1e6])) != key
+    assert get_key(rate_switch_table.iloc[[0, 2]]) != key
+    assert financial_functions.get_sizing_cache_key(agent, sectors, rate_switch_table.assign(one_time_charge=[150., 0., 0.])) != \
+        financial_functions.get_sizing_cache_key(agent, sectors, rate_switch_table)
+
+    data_sources = [{'host': 'localhost', 'port': 5432, 'dbname': 'dgen_db', 'data_version': version} for version in ['2020', '2021']]
+    assert len({key, get_key(rate_switch_table, data_sources[0]), get_key(rate_switch_table, data_sources[1])}) == 3
+
+
+#%%
+# agent attributes sizing reads that are not in SIZING_INPUT_COLS: agent_id is reported, naep is set during
+# sizing, and tariff_dict and state_incentives are given by tariff_id and by state_abbr and sector_abbr
+SIZING_NON_INPUT_READS = ['agent_id', 'naep', 'tariff_dict', 'state_incentives']
+
+
+def test_sizing_input_cols_cover_agent_attributes_read():
+    # reads of agent.loc['...'], agent['...'] and agent.get('...') outside of comments, but not assignments
+    read = re.compile(r"""\bagent(?:\.loc)?\[\s*'(\w+)'\s*\](?!\s*=[^=])|\bagent\.get\(\s*'(\w+)'""")
+    sources = [inspect.getsource(financial_functions), inspect.getsource(agent_mutation.elec.apply_rate_switch),
+               inspect.getsource(agent_mutation.elec.get_and_apply_agent_load_profiles),
+               inspect.getsource(agent_mutation.elec.get_and_apply_normalized_hourly_resource_solar)]
+    code = '\n'.join(line.split('#')[0] for source in sources for line in source.splitlines())
+
+    attributes = {a or b for a, b in read.findall(code)}
+
+    assert attributes - set(financial_functions.SIZING_INPUT_COLS) == set(SIZING_NON_INPUT_READS)
+
+
+def test_carried_and_sized_agents_recombine_in_agent_order():
+    agent_ids = [5, 3, 9, 1, 7]
+    agent_df = make_agent_df([make_agent(agent_id=agent_id, tariff_kind='tou') for agent_id in agent_ids])
+    fingerprints = financial_functions.fingerprint_sizing_inputs(agent_df)
+
+    # agents 3 and 1 are unchanged since last model year
+    sizing_results_last_year = pd.DataFrame({col: 0. for col in financial_functions.SIZING_OUTPUT_COLS}, index=range(len(agent_ids)))
+    sizing_results_last_year['agent_id'] = agent_ids
+    sizing_results_last_year['system_kw'] = [100. * agent_id for agent_id in agent_ids]
+    sizing_results_last_year['sizing_fingerprint'] = [fingerprints[agent_id] if agent_id in [3, 1] else 0 for agent_id in agent_ids]
+
+    resize_df, carried_df = financial_functions.split_unchanged_agents(agent_df, fingerprints, sizing_results_last_year)
+    assert sorted(resize_df['agent_id']) == [5, 7, 9]
+    assert sorted(carried_df['agent_id']) == [1, 3]
+
+    # sized agents in another order, as returned by chunk_on_row
+    sized_df = resize_df.iloc[::-1].assign(system_kw=lambda df: 10. * df['agent_id'])
+    combined = financial_functions.combine_carried_agents(agent_df, sized_df, carried_df)
+
+    assert list(combined['agent_id']) == agent_ids
+    assert list(combined['system_kw']) == [50., 300., 90., 100., 70.]
+    assert list(combined['tariff_id']) == list(agent_df['tariff_id'])
+
+    # no agents sized
+    combined = financial_functions.combine_carried_agents(agent_df.iloc[[1, 3]], resize_df.iloc[:0], carried_df)
+    assert list(combined['agent_id']) == [3, 1]
+    assert list(combined['system_kw']) == [300., 100.]
+
+
+#%%
+def test_incentive_screening_bounds_read_compiled_incentives():
+    incentives = make_state_incentives(cbi_usd_p_w=0.3, ibi_pct=20., pbi_usd_p_kwh=0.03)
+    cbi, ibi, pbi, bounded = financial_functions.get_incentive_screening_bounds(incentives)
+    assert (cbi, ibi, pbi, bounded) == (pytest.approx(300.), pytest.approx(0.2), pytest.approx(0.03), True)
+
+    incentive_df = pd.DataFrame({'cbi_usd_p_w': [0.3, 0.1], 'ibi_pct': [20., np.nan], 'pbi_usd_p_kwh': [np.nan, 0.03],
+                                 'incentive_duration_yrs': [10., 5.], 'max_incentive_usd': [5000., 1000.]})
+    cbi, ibi, pbi, bounded = financial_functions.get_incentive_screening_bounds(incentive_df)
+    assert (cbi, ibi, pbi, bounded) == (pytest.approx(400.), pytest.approx(0.2), pytest.approx(0.03), True)
+
+    assert financial_functions.get_incentive_screening_bounds(np.nan) == (0., 0., 0., True)
+    # a fixed IBI amount or an escalating PBI is not covered by the bound
+    assert not financial_functions.get_incentive_screening_bounds(dict(incentives, ibi_sta_amount=1000.))[3]
+    assert not financial_functions.get_incentive_screening_bounds(dict(incentives, pbi_sta_escal=0.02))[3]
+
+
+@requires_pysam_2
+def test_sizing_npv_bound_is_above_npv_of_every_system(sizing_args, profile_stores, sizing_config):
+    sizing_config(BILL_BACKEND='numpy', CASHFLOW_BACKEND='numpy')
+    rng = np.random.RandomState(0)
+    agent_list = []
+    for agent_id in range(1, 33):
+        sector_abbr = ['res', 'com'][agent_id % 2]
+        capex = rng.uniform(300., 10000.)
+        incentives = make_state_incentives(cbi_usd_p_w=rng.choice([np.nan, 0.2, 0.5]), ibi_pct=rng.choice([np.nan, 10., 30.]),
+                                           pbi_usd_p_kwh=rng.choice([np.nan, 0.02]))
+        agent_list.append(make_agent(agent_id=agent_id, sector_abbr=sector_abbr, incentives=incentives,
+                                     tariff_kind=rng.choice(['flat', 'tiered', 'tou', 'tiered_tou', 'daily']),
+                                     compensation_style=rng.choice(['net metering', 'net billing']),
+                                     load_profile_idx=agent_id % 2, solar_cf_idx=(agent_id // 2) % 2,
+                                     system_capex_per_kw=capex, system_capex_per_kw_combined=0.95 * capex,
+                                     down_payment_fraction=rng.choice([0., 0.2, 1.]), loan_interest_rate=rng.uniform(0.02, 0.09),
+                                     real_discount_rate=rng.uniform(0.03, 0.1), itc_fraction_of_capex=rng.choice([0., 0.26, 0.3]),
+                                     wholesale_elec_price_dollars_per_kwh=rng.uniform(0.02, 0.06),
+                                     batt_capex_per_kwh_combined=rng.uniform(400., 2000.)))
+    agent_df = make_agent_df(agent_list).reset_index()
+
+    npv_per_kw_bound = financial_functions.calc_sizing_npv_bound(agent_df, profile_stores[1], dict())
+
+    assert 0 < (npv_per_kw_bound <= 0).sum() < np.isfinite(npv_per_kw_bound).sum()
+    for agent, bound in zip(agent_list, npv_per_kw_bound):
+        if not np.isfinite(bound):
+            continue
+        args, max_system_kw = sizing_args(agent)
+        for en_batt in [False, True]:
+            for kw in financial_functions.get_sizing_grid(max_system_kw):
+                npv = financial_functions.get_cached_evaluation(kw, dict(), *args, en_batt, 0)['npv']
+                # systems with no capacity have no NPV
+                assert not npv > bound * kw + 1e-6
+
+
+#%%
+def test_compiled_tariff_keeps_energy_rates_per_sell_rate(sizing_config):
+    class ElectricityRates(object):
+        def assign(self, rates):
+            self.__dict__.update(rates)
+
+    class Utilityrate(object):
+        def __init__(self):
+            self.ElectricityRates = ElectricityRates()
+
+    sizing_config(TARIFF_CACHE_MAX_SELL_RATES=2)
+    tariff = make_tariff('tou')
+    utilityrate = Utilityrate()
+
+    tables = dict()
+    for sell_rate in [0.03, 0.05, 0.03, 0.05]:
+        financial_functions.process_tariff(utilityrate, tariff, sell_rate, tariff_id=1)
+        table = utilityrate.ElectricityRates.ur_ec_tou_mat
+        assert [row[-1] for row in table] == [sell_rate] * 2
+        # agents alternating sell rates reuse the table of their sell rate
+        assert tables.setdefault(sell_rate, table) is table
+
+    compiled = financial_functions.get_compiled_tariff(1, tariff)
+    assert [len(row) for row in compiled['ec_tou_mat']] == [5, 5]
+    assert list(compiled['ur_ec_tou_mats']) == [0.03, 0.05]
+
+    # the least recently used sell rate is dropped
+    financial_functions.process_tariff(utilityrate, tariff, 0.04, tariff_id=1)
+    assert list(compiled['ur_ec_tou_mats']) == [0.05, 0.04]
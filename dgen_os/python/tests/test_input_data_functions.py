@@ -0,0 +1,106 @@
+"""
+Serialization of agent outputs for COPY in input_data_functions, compared with the json.dumps
+encoding the to_sql writer used
+"""
+
+import csv
+import json
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import input_data_functions as iFuncs
+
+
+class CopyCursor(object):
+    """
+    Cursor that keeps the statement and csv rows of copy_expert
+    """
+    def copy_expert(self, sql, f):
+        self.sql = sql
+        self.rows = list(csv.reader(StringIO(f.read())))
+
+
+def old_encoding(value):
+    # encoding of lists, arrays and dicts by the to_sql writer
+    if isinstance(value, np.ndarray):
+        return json.dumps(list(value.tolist()))
+    if isinstance(value, dict):
+        return json.dumps(dict((k, list(v.tolist())) if isinstance(v, np.ndarray) else (k, v) for k, v in value.items()))
+    return json.dumps(value)
+
+
+def make_outputs():
+    return pd.DataFrame({'agent_id': [1, 2, 3],
+                         'npv': [10.5, np.nan, -3.],
+                         'cash_flow': [np.array([-100., 20.5, 30.]), np.array([-50., np.nan, 10.]), None],
+                         'batt_dispatch_profile': [np.array([0.1, 0.2], 'float32'), np.array([0., -1.5], 'float32'), np.nan],
+                         'pbi': [[0.01, 0.01], [0.02], None],
+                         'cbi': [{'cbi_total': np.array([1., 2.]), 'note': 'x'}, None, {'cbi_total': 0.}],
+                         'batt_fits': pd.Series([True, None, False], dtype=object),
+                         'tariff_name': ['flat', None, 'tou'],
+                         'interval': [pd.Interval(0, 1), None, pd.Interval(1, 2)],
+                         'empty': [None, None, None]})
+
+
+#%%
+@pytest.mark.parametrize('column', ['cash_flow', 'pbi', 'cbi'])
+def test_json_encoders_match_old_encoding(column):
+    outputs = make_outputs()
+    encoder = iFuncs.encode_json_dicts if column == 'cbi' else iFuncs.encode_json_arrays
+
+    encoded = encoder(outputs[column])
+
+    for value, text in zip(outputs[column], encoded):
+        if value is None:
+            assert text is None
+        else:
+            assert text == old_encoding(value)
+
+
+def test_stacked_arrays_match_old_encoding():
+    rng = np.random.RandomState(0)
+    values = [rng.normal(scale=1000., size=25) for i in range(20)] + [np.arange(25.)]
+    encoded = iFuncs.encode_json_arrays(pd.Series(values))
+
+    assert list(encoded) == [old_encoding(value) for value in values]
+
+
+def test_float32_arrays_encode_their_values():
+    outputs = make_outputs()
+    encoded = iFuncs.encode_json_arrays(outputs['batt_dispatch_profile'])
+
+    for value, text in zip(outputs['batt_dispatch_profile'][:2], encoded[:2]):
+        np.testing.assert_array_equal(np.array(json.loads(text), 'float32'), value)
+    assert encoded[2] is None
+
+
+def test_psql_columns_with_append_transformations():
+    columns = iFuncs.get_psql_columns(make_outputs(), append_transformations=True)
+
+    assert [(f, name, sql_type) for f, name, sql_type, encoder in columns] == \
+        [('agent_id', 'agent_id', 'BIGINT'), ('npv', 'npv', 'NUMERIC'),
+         ('cash_flow', 'cash_flow_ndarray', 'VARCHAR'), ('batt_dispatch_profile', 'batt_dispatch_profile_ndarray', 'VARCHAR'),
+         ('pbi', 'pbi_list', 'VARCHAR'), ('cbi', 'cbi_dict', 'VARCHAR'), ('batt_fits', 'batt_fits', 'BOOLEAN'),
+         ('tariff_name', 'tariff_name', 'VARCHAR'), ('interval', 'interval_interval', 'VARCHAR')]
+    assert [name for f, name, sql_type, encoder in iFuncs.get_psql_columns(make_outputs())][2:6] == ['cash_flow', 'batt_dispatch_profile', 'pbi', 'cbi']
+
+
+def test_write_psql_batch_copies_encoded_rows():
+    outputs = make_outputs()
+    columns = iFuncs.get_psql_columns(outputs, append_transformations=True)
+    cur = CopyCursor()
+
+    iFuncs.write_psql_batch(cur, outputs, 'diffusion_results', 'agent_outputs', columns)
+
+    assert cur.sql.startswith('COPY diffusion_results."agent_outputs" ("agent_id", "npv", "cash_flow_ndarray"')
+    assert len(cur.rows) == 3
+    rows = [dict(zip([name for f, name, sql_type, encoder in columns], row)) for row in cur.rows]
+    assert [row['npv'] for row in rows] == ['10.5', '\\N', '-3.0']
+    assert [row['cash_flow_ndarray'] for row in rows] == [old_encoding(outputs['cash_flow'][0]), old_encoding(outputs['cash_flow'][1]), '\\N']
+    assert [row['cbi_dict'] for row in rows] == [old_encoding(outputs['cbi'][0]), '\\N', old_encoding(outputs['cbi'][2])]
+    assert [row['batt_fits'] for row in rows] == ['True', '\\N', 'False']
+    assert [row['tariff_name'] for row in rows] == ['flat', '\\N', 'tou']
+    assert [row['interval_interval'] for row in rows] == [str(outputs['interval'][0]), '\\N', str(outputs['interval'][2])]
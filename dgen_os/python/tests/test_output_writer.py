@@ -0,0 +1,139 @@
+"""
+Background output writes and the parquet dataset of agent outputs in output_writer
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import output_writer
+
+
+#%%
+@pytest.mark.parametrize('background', [True, False])
+def test_writes_run_in_order(background):
+    writer = output_writer.OutputWriter(background=background, max_queued=2)
+    written = []
+    for year in range(2014, 2030, 2):
+        writer.submit(written.append, year)
+    writer.flush()
+    assert written == list(range(2014, 2030, 2))
+
+    writer.submit(written.append, 2030)
+    writer.close()
+    assert written[-1] == 2030
+
+
+def test_failed_write_skips_later_writes_and_raises_on_next_submit():
+    writer = output_writer.OutputWriter(background=True, max_queued=4)
+    written = []
+    def fail(year):
+        raise ValueError('cannot write {}'.format(year))
+
+    writer.submit(written.append, 2014)
+    writer.submit(fail, 2016)
+    writer.submit(written.append, 2018)
+    writer.queue.join()
+    assert written == [2014]
+
+    with pytest.raises(ValueError, match='2016'):
+        writer.submit(written.append, 2020)
+
+    # the error is raised once, and writes go on after it
+    writer.submit(written.append, 2022)
+    writer.close()
+    assert written == [2014, 2022]
+
+
+@pytest.mark.parametrize('method', ['flush', 'close'])
+def test_failed_write_raises_on_flush_and_close(method):
+    writer = output_writer.OutputWriter(background=True, max_queued=4)
+    def fail():
+        raise ValueError('cannot write')
+
+    writer.submit(fail)
+    with pytest.raises(ValueError):
+        getattr(writer, method)()
+
+    writer.close()
+
+
+def test_close_discard_skips_pending_writes():
+    writer = output_writer.OutputWriter(background=True, max_queued=4)
+    started = threading.Event()
+    release = threading.Event()
+    written = []
+    def block(year):
+        started.set()
+        release.wait()
+        written.append(year)
+
+    writer.submit(block, 2014)
+    writer.submit(written.append, 2016)
+    started.wait()
+    closing = threading.Thread(target=writer.close, kwargs={'discard': True})
+    closing.start()
+    while writer.error is None:
+        closing.join(0.001)
+    release.set()
+    closing.join()
+
+    # the running write finishes, the pending one is skipped and nothing is raised
+    assert written == [2014]
+    assert writer.thread is None and writer.error is None
+    writer.close()
+
+
+#%%
+def make_agent_outputs(year):
+    df = pd.DataFrame({'agent_id': [1, 2, 3],
+                       'year': year,
+                       'state_abbr': ['CO', 'CO', 'DE'],
+                       'sector_abbr': ['res', 'com', 'res'],
+                       'system_kw': [5., 0., 12.5],
+                       'cash_flow': [np.array([-100., 20., 30.]), np.array([0., 0., 0.]), None],
+                       'batt_dispatch_profile': [np.array([0.5, -0.5], 'float32'), None, np.array([0., 1.], 'float32')],
+                       'tariff_name': ['flat', None, 'tou'],
+                       'empty': [None, None, None],
+                       'mixed': [1, 'a', None]})
+    return df.set_index('agent_id')
+
+
+def test_write_agent_parquet_round_trips_years(tmp_path):
+    pads = pytest.importorskip('pyarrow.dataset')
+    root_path = str(tmp_path / 'agent_outputs')
+    for year in [2014, 2016]:
+        output_writer.write_agent_parquet(make_agent_outputs(year), root_path, 'baseline')
+
+    partitions = sorted(str(p.relative_to(root_path).parent) for p in (tmp_path / 'agent_outputs').rglob('*.parquet'))
+    assert partitions == ['scenario=baseline/year={}/state_abbr={}'.format(year, state)
+                          for year in [2014, 2016] for state in ['CO', 'DE']]
+
+    dataset = pads.dataset(root_path, format='parquet', partitioning='hive')
+    columns = ['agent_id', 'year', 'state_abbr', 'cash_flow', 'batt_dispatch_profile', 'tariff_name', 'empty', 'mixed']
+    table = dataset.to_table(columns=columns)
+    assert table.column_names == columns
+    assert table.num_rows == 6
+
+    schema = dataset.schema
+    assert schema.field('cash_flow').type == pa.list_(pa.float64())
+    assert schema.field('batt_dispatch_profile').type == pa.list_(pa.float32())
+    assert pa.types.is_dictionary(schema.field('sector_abbr').type)
+    assert pa.types.is_dictionary(schema.field('tariff_name').type)
+    # columns arrow cannot type fall back to strings
+    for f in ['empty', 'mixed']:
+        assert pa.types.is_dictionary(schema.field(f).type)
+        assert pa.types.is_string(schema.field(f).type.value_type)
+
+    df = table.to_pandas().sort_values(['year', 'agent_id']).reset_index(drop=True)
+    assert list(df['year']) == [2014] * 3 + [2016] * 3
+    assert list(df['state_abbr']) == ['CO', 'CO', 'DE'] * 2
+    np.testing.assert_array_equal(df['cash_flow'][0], [-100., 20., 30.])
+    assert df['cash_flow'][2] is None
+    np.testing.assert_array_equal(df['batt_dispatch_profile'][5], np.array([0., 1.], 'float32'))
+    assert list(df['tariff_name'][[0, 2]]) == ['flat', 'tou'] and pd.isnull(df['tariff_name'][1])
+    assert df['empty'].isnull().all()
+    assert list(df['mixed'][:2]) == ['1', 'a'] and pd.isnull(df['mixed'][2])
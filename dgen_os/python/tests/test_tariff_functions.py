@@ -0,0 +1,124 @@
+"""
+Vectorized bill engine (tariff_functions.calc_annual_bills) and its parity with PySAM Utilityrate5
+"""
+
+import numpy as np
+import pytest
+
+import config
+import financial_functions
+import tariff_functions as tFuncs
+
+from conftest import make_agent, make_tariff, requires_pysam_2
+
+
+COMPENSATION_STYLES = ['net metering', 'net billing', 'buy all sell all', 'none']
+
+
+#%%
+def test_net_metering_carries_surplus_forward():
+    bill_arrays = tFuncs.compile_bill_arrays(make_tariff('flat', fixed_charge=0.))
+    load = np.full(8760, 1.)
+    gen = np.zeros(8760)
+    # January surplus of 100 kWh offsets February usage
+    gen[:tFuncs.MONTH_HOURS[1]] = 1. + 100. / tFuncs.MONTH_HOURS[1]
+
+    bill = tFuncs.calc_annual_bills(load, gen, bill_arrays, tFuncs.NET_METERING, yearend_sell_rate=0.03)
+
+    assert bill[0] == pytest.approx(0.12 * (8760 - tFuncs.MONTH_HOURS[1] - 100.))
+
+
+def test_net_billing_credits_hourly_exports():
+    bill_arrays = tFuncs.compile_bill_arrays(make_tariff('tiered', fixed_charge=5.))
+    load = np.full(8760, 1.)
+    gen = np.zeros(8760)
+    gen[12] = 3.
+
+    bill = tFuncs.calc_annual_bills(load, gen, bill_arrays, tFuncs.NET_BILLING, sell_rate=0.04)
+    no_system = tFuncs.calc_annual_bills(load, np.zeros(8760), bill_arrays, tFuncs.NET_BILLING, sell_rate=0.04)
+
+    # the hour's load is not bought at the second tier price and 2 kWh are sold
+    assert bill[0] - no_system[0] == pytest.approx(-0.15 - 2. * 0.04)
+
+
+def test_buy_all_sell_all_charges_battery_charging():
+    bill_arrays = tFuncs.compile_bill_arrays(make_tariff('demand', fixed_charge=0.))
+    load = np.full(8760, 1.)
+    gen = np.zeros(8760)
+    gen[10] = -5.
+    gen[12] = 3.
+
+    bill = tFuncs.calc_annual_bills(load, gen, bill_arrays, tFuncs.BUY_ALL_SELL_ALL, sell_rate=0.04)
+    no_system = tFuncs.calc_annual_bills(load, np.zeros(8760), bill_arrays, tFuncs.BUY_ALL_SELL_ALL, sell_rate=0.04)
+
+    # charging is bought at the energy price and its peak adds to the load's flat and off-peak demand in January
+    assert bill[0] - no_system[0] == pytest.approx(5. * 0.08 - 3. * 0.04 + 5. * (12. + 4.))
+
+
+@pytest.mark.parametrize('tariff_kind', ['tiered_tou', 'per_kw', 'demand_flat', 'demand_tou'])
+def test_compile_bill_arrays_unsupported(tariff_kind):
+    assert tFuncs.compile_bill_arrays(make_tariff(tariff_kind)) is None
+
+
+def test_compile_bill_arrays_without_energy_charges():
+    # Utilityrate5 bills tariffs without energy charges with the energy rates of its defaults
+    tariff = make_tariff('demand')
+    tariff['e_exists'] = False
+
+    assert tFuncs.compile_bill_arrays(tariff) is None
+
+
+#%%
+@requires_pysam_2
+@pytest.mark.parametrize('tariff_kind', ['flat', 'tiered', 'tou', 'daily', 'demand'])
+@pytest.mark.parametrize('compensation_style', COMPENSATION_STYLES)
+@pytest.mark.parametrize('en_batt', [False, True])
+def test_bills_match_utilityrate5(sizing_args, sizing_config, tariff_kind, compensation_style, en_batt):
+    agent = make_agent(sector_abbr='com', tariff_kind=tariff_kind, compensation_style=compensation_style)
+    args, max_system_kw = sizing_args(agent)
+    pv, utilityrate, loan, batt, costs, agent, rate_switch_table = args
+
+    # hourly generation of the system, net of the battery's charging and discharging
+    sizing_config(BILL_BACKEND='pysam', CASHFLOW_BACKEND='pysam')
+    financial_functions.evaluate_system_performance(0.7 * max_system_kw, *args, en_batt, 0)
+    system_gen = np.array(batt.Outputs.gen) if en_batt else np.array(utilityrate.SystemOutput.gen)
+    load_hourly = np.asarray(pv['consumption_hourly'], float)
+    sell_rate = 0. if compensation_style == 'none' else agent.loc['wholesale_elec_price_dollars_per_kwh']
+
+    pysam_bills = financial_functions.calc_utility_bills_pysam(utilityrate, system_gen, load_hourly)
+    numpy_bills = financial_functions.calc_utility_bills_numpy(tFuncs.compile_bill_arrays(agent.loc['tariff_dict']), agent,
+                                                               system_gen, load_hourly, sell_rate)
+
+    # Utilityrate5 allocates tiered usage to tiers hour by hour under net billing and buy all sell all,
+    # which moves a few kWh between tiers; other bills match exactly
+    rtol = 5e-3 if tariff_kind in ['tiered', 'daily'] and compensation_style != 'net metering' else 1e-6
+    for output in ['elec_cost_with_system', 'elec_cost_without_system']:
+        np.testing.assert_allclose(numpy_bills[output], pysam_bills[output], rtol=rtol, atol=1e-6)
+
+
+@requires_pysam_2
+@pytest.mark.parametrize('tariff_kind', ['tiered_tou', 'per_kw', 'demand_flat', 'demand_tou'])
+def test_unsupported_tariffs_fall_back_to_utilityrate5(size_agent, sizing_config, tariff_kind):
+    agent = make_agent(sector_abbr='com', tariff_kind=tariff_kind, compensation_style='net billing')
+
+    results = dict()
+    for backend in ['pysam', 'numpy']:
+        sizing_config(BILL_BACKEND=backend, CASHFLOW_BACKEND='pysam')
+        results[backend] = size_agent(agent)
+
+    for output in ['system_kw', 'npv', 'first_year_elec_bill_with_system', 'first_year_elec_bill_without_system']:
+        assert results['numpy'][output] == pytest.approx(results['pysam'][output], rel=1e-9)
+
+
+def test_validation_sampling_is_seeded_and_skipped_when_off(monkeypatch):
+    monkeypatch.setattr(financial_functions, '_validation_rng', np.random.RandomState(0))
+    global_state = np.random.get_state()[1].copy()
+    rng_state = financial_functions._validation_rng.get_state()[1].copy()
+
+    assert not any(financial_functions.sample_validation(0.) for i in range(10))
+    np.testing.assert_array_equal(financial_functions._validation_rng.get_state()[1], rng_state)
+
+    draws = [financial_functions.sample_validation(0.5) for i in range(20)]
+    monkeypatch.setattr(financial_functions, '_validation_rng', np.random.RandomState(0))
+    assert [financial_functions.sample_validation(0.5) for i in range(20)] == draws
+    np.testing.assert_array_equal(np.random.get_state()[1], global_state)
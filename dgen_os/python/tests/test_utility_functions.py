@@ -0,0 +1,217 @@
+"""
+Shared utilities in utility_functions
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import financial_functions
+import utility_functions as utilfunc
+
+
+class Unpicklable(object):
+    def __reduce__(self):
+        raise RuntimeError('cannot pickle')
+
+
+class Cached(object):
+    def __init__(self, value):
+        self.value = value
+
+
+#%%
+def test_disk_cache_round_trips_values(tmp_path):
+    cache = utilfunc.DiskCache(str(tmp_path))
+    key = cache.make_key('agent', {'b': 2, 'a': np.arange(3)})
+    value = pd.Series({'system_kw': 5., 'cash_flow': [1., 2.]})
+
+    assert key == cache.make_key('agent', {'a': [0, 1, 2], 'b': 2})
+    assert cache.get(key) is None
+    cache.set(key, value)
+
+    pd.testing.assert_series_equal(cache.get(key), value)
+
+
+def test_disk_cache_write_is_atomic(tmp_path):
+    cache = utilfunc.DiskCache(str(tmp_path))
+    key = cache.make_key('agent')
+    cache.set(key, 1.)
+
+    # a failed write leaves the stored value and no temporary file
+    with pytest.raises(RuntimeError):
+        cache.set(key, Unpicklable())
+
+    assert cache.get(key) == 1.
+    assert [f for root, dirs, files in os.walk(str(tmp_path)) for f in files] == [key + '.pkl']
+
+
+@pytest.mark.parametrize('contents', ['truncated', 'corrupt'])
+def test_disk_cache_misses_unreadable_files(tmp_path, contents):
+    cache = utilfunc.DiskCache(str(tmp_path))
+    key = cache.make_key('agent')
+    cache.set(key, pd.Series(np.arange(100.)))
+
+    file_path = cache._file_path(key)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    with open(file_path, 'wb') as f:
+        f.write(data[:len(data) // 2] if contents == 'truncated' else b'not a pickle' + data)
+
+    assert cache.get(key, default='miss') == 'miss'
+
+
+def test_disk_cache_misses_values_of_missing_classes(tmp_path, monkeypatch):
+    cache = utilfunc.DiskCache(str(tmp_path))
+    key = cache.make_key('agent')
+    cache.set(key, Cached(1.))
+
+    # e.g. a value pickled with another version of pandas
+    monkeypatch.delattr(sys.modules[__name__], 'Cached')
+
+    assert cache.get(key, default='miss') == 'miss'
+
+
+def test_sizing_code_version_covers_library_versions(monkeypatch):
+    monkeypatch.setattr(financial_functions, '_sizing_code_version', None)
+    version = financial_functions.get_sizing_code_version()
+
+    for module in [pd, np]:
+        with monkeypatch.context() as m:
+            m.setattr(financial_functions, '_sizing_code_version', None)
+            m.setattr(module, '__version__', '0.0.0')
+            assert financial_functions.get_sizing_code_version() != version
+
+
+#%%
+class FakeCursor(object):
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, query):
+        if not self.con.alive:
+            raise utilfunc.pg.OperationalError('server closed the connection unexpectedly')
+        self.con.queries.append(query)
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.alive = True
+        self.closed = 0
+        self.queries = []
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def fake_connect(monkeypatch):
+    """
+    Stub pg.connect with FakeConnection objects, and clear the connection managers of the process
+    """
+    opened = []
+    def connect(connection_string, **kwargs):
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(utilfunc.pg, 'connect', connect)
+    monkeypatch.setattr(utilfunc, '_connection_managers', {})
+
+    return opened
+
+
+def test_connection_manager_bounds_checkouts(fake_connect):
+    manager = utilfunc.ConnectionManager('dbname=dgen_db', 'postgres', max_connections=2, timeout=0.01, pre_ping=True)
+    con_a, cur_a = manager.getconn()
+    con_b, cur_b = manager.getconn()
+
+    with pytest.raises(RuntimeError):
+        manager.getconn()
+
+    # a released connection is reused without opening another
+    manager.putconn(con_a)
+    con_c, cur_c = manager.getconn()
+    assert con_c is con_a
+    assert len(fake_connect) == 2
+    assert con_a.queries == ['SET ROLE "postgres";', 'SELECT 1;']
+
+
+def test_connection_manager_ignores_connections_not_checked_out(fake_connect, monkeypatch):
+    monkeypatch.setattr(utilfunc.config, 'DB_POOL_MAX_CONNECTIONS', 1)
+    monkeypatch.setattr(utilfunc.config, 'DB_POOL_TIMEOUT', 0.01)
+    manager = utilfunc.get_connection_manager('dbname=dgen_db', 'postgres')
+    con, cur = manager.getconn()
+    manager.putconn(con)
+
+    # releasing again, or releasing another connection, does not free a slot or close the idle connection
+    other = FakeConnection()
+    manager.putconn(con)
+    manager.putconn(other)
+    utilfunc.release_con(con)
+    assert not con.closed and manager.is_idle(con)
+    assert manager.getconn()[0] is con
+
+    with pytest.raises(RuntimeError):
+        manager.getconn()
+
+    # connections not from a manager are closed
+    utilfunc.release_con(other)
+    assert other.closed
+
+
+def test_connection_manager_replaces_dead_idle_connections(fake_connect):
+    manager = utilfunc.ConnectionManager('dbname=dgen_db', 'postgres', max_connections=2, pre_ping=True)
+    con, cur = manager.getconn()
+    manager.putconn(con)
+    con.alive = False
+
+    new_con, new_cur = manager.getconn()
+
+    assert new_con is not con and con.closed
+    assert not manager.is_idle(con)
+    assert len(fake_connect) == 2
+
+
+def test_connection_manager_keeps_max_idle_connections(fake_connect):
+    manager = utilfunc.ConnectionManager('dbname=dgen_db', 'postgres', max_connections=3, max_idle=1)
+    cons = [manager.getconn()[0] for i in range(3)]
+    for con in cons:
+        manager.putconn(con)
+
+    assert [manager.is_idle(con) for con in cons] == [True, False, False]
+    assert [con.closed for con in cons] == [0, 1, 1]
+
+    manager.close()
+    assert cons[0].closed and not manager.is_idle(cons[0])
+
+
+def test_connection_manager_reads_config_when_created(fake_connect, monkeypatch):
+    monkeypatch.setattr(utilfunc.config, 'DB_POOL_MAX_CONNECTIONS', 1)
+    monkeypatch.setattr(utilfunc.config, 'DB_POOL_TIMEOUT', 0.01)
+    manager = utilfunc.ConnectionManager('dbname=dgen_db', 'postgres')
+    manager.getconn()
+
+    assert manager.max_connections == 1
+    with pytest.raises(RuntimeError):
+        manager.getconn()
@@ -4,6 +4,7 @@ import sys
 import colorama
 import logging
 import colorlog
+import numpy as np
 import pandas as pd
 import datetime
 import select
@@ -12,8 +13,12 @@ import psycopg2.extras as pgx
 import time
 import subprocess
 import os
+import hashlib
+import pickle
+import tempfile
+import threading
 from sqlalchemy import create_engine
-from sqlalchemy.pool import  NullPool
+import config
 #==============================================================================
 #       Logging Functions
 #==============================================================================
@@ -99,6 +104,73 @@ class Timer:
         self.end = time.time()
         self.interval = self.end - self.start
 
+
+def _json_default(value):
+    # arrays and numpy scalars as plain lists and numbers, anything else by its string
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class DiskCache(object):
+    """
+    Content-addressed cache of pickled values on disk, safe to share between concurrent
+    processes and runs. Each value is stored in a file named by the sha256 hash of its key,
+    in a subdirectory named by the first two characters of the hash. Values are written to
+    a temporary file and renamed into place, so readers never see a partial value.
+    """
+    def __init__(self, path):
+        """
+        Initialize DiskCache Class
+        Parameters
+        ----------
+        path : 'str'
+            Directory of the cache, created if it does not exist
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def __repr__(self):
+        return '{} at {}'.format(self.__class__.__name__, self.path)
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Hash JSON-serializable parts (dicts, lists, numbers, strings, numpy arrays) into a key
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=_json_default).encode('utf-8')).hexdigest()
+
+    def _file_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.pkl')
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key, or default if there is none or it cannot be read, 
+        e.g. a corrupt file or a value pickled with other versions of the libraries of its classes
+        """
+        try:
+            with open(self._file_path(key), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return default
+
+    def set(self, key, value):
+        """
+        Store value under key, replacing any value stored before
+        """
+        file_path = self._file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
 #==============================================================================
 #       Postgres Functions
 #==============================================================================
@@ -121,10 +193,194 @@ def pylist_2_pglist(l):
     return str(l)[1:-1]
 
 
+class ConnectionManager(object):
+    """
+    Bounded pool of psycopg2 connections to one database with one role. The role is set once
+    when a connection is opened, and idle connections are checked (pre-ping) before they are 
+    handed out again so that connections dropped by the server are replaced transparently.
+    At most max_connections are open at once; further checkouts wait for a connection to be released.
+
+    Use get_connection_manager() rather than creating managers directly, so that each process
+    holds one manager per database and role.
+    """
+    def __init__(self, connection_string, role, max_connections=None, max_idle=None, timeout=None, pre_ping=None):
+        """
+        Initialize ConnectionManager Class
+        Parameters
+        ----------
+        connection_string : 'str'
+            Connection string
+        role : 'str'
+            Database role set on each connection
+        max_connections : 'int'
+            Maximum number of connections open at once, config.DB_POOL_MAX_CONNECTIONS if None
+        max_idle : 'int'
+            Maximum number of released connections kept open for reuse, config.DB_POOL_MAX_IDLE if None
+        timeout : 'float'
+            Seconds to wait for a connection when max_connections are checked out, config.DB_POOL_TIMEOUT if None
+        pre_ping : 'bool'
+            If True, check that an idle connection is alive before handing it out, config.DB_POOL_PRE_PING if None
+        """
+        self.connection_string = connection_string
+        self.role = role
+        self.max_connections = config.DB_POOL_MAX_CONNECTIONS if max_connections is None else max_connections
+        self.max_idle = config.DB_POOL_MAX_IDLE if max_idle is None else max_idle
+        self.timeout = config.DB_POOL_TIMEOUT if timeout is None else timeout
+        self.pre_ping = config.DB_POOL_PRE_PING if pre_ping is None else pre_ping
+
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._checked_out = {}
+
+    def __repr__(self):
+        return ('{} for role {} with {} checked out and {} idle connections'
+                .format(self.__class__.__name__, self.role, len(self._checked_out), len(self._idle)))
+
+    def _open(self):
+        con = pg.connect(self.connection_string)
+        cur = con.cursor()
+        # set role (this should avoid permissions issues)
+        cur.execute('SET ROLE "{}";'.format(self.role))
+        con.commit()
+        cur.close()
+
+        return con
+
+    def _is_alive(self, con):
+        if con.closed:
+            return False
+        if not self.pre_ping:
+            return True
+        try:
+            with con.cursor() as cur:
+                cur.execute('SELECT 1;')
+            con.rollback()
+        except pg.Error:
+            return False
+
+        return True
+
+    @staticmethod
+    def _discard(con):
+        try:
+            con.close()
+        except pg.Error:
+            pass
+
+    def getconn(self):
+        """
+        Check out a connection, waiting up to timeout seconds if none is available
+
+        Returns
+        -------
+        con : 'SQL connection'
+            Postgres Database Connection.
+        cur : 'SQL cursor'
+            Postgres Database Cursor.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError('No database connection available after {} seconds ({} connections checked out)'
+                               .format(self.timeout, self.max_connections))
+        try:
+            while True:
+                with self._lock:
+                    con = self._idle.pop() if self._idle else None
+                if con is None:
+                    con = self._open()
+                    break
+                if self._is_alive(con):
+                    break
+                self._discard(con)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._checked_out[id(con)] = con
+
+        return con, con.cursor(cursor_factory=pgx.RealDictCursor)
+
+    def owns(self, con):
+        """
+        Return True if con is checked out of this manager
+        """
+        return id(con) in self._checked_out
+
+    def is_idle(self, con):
+        """
+        Return True if con is kept open for reuse by this manager
+        """
+        with self._lock:
+            return any(c is con for c in self._idle)
+
+    def putconn(self, con):
+        """
+        Return a checked out connection. Its open transaction is rolled back, so commit
+        anything to keep first. Connections that are not checked out are ignored.
+        """
+        with self._lock:
+            if self._checked_out.pop(id(con), None) is None:
+                return
+        try:
+            if not con.closed:
+                con.rollback()
+        except pg.Error:
+            self._discard(con)
+
+        with self._lock:
+            if not con.closed and len(self._idle) < self.max_idle:
+                self._idle.append(con)
+                con = None
+        if con is not None:
+            self._discard(con)
+        self._slots.release()
+
+    def close(self):
+        """
+        Close all idle connections. Checked out connections are closed when they are returned.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for con in idle:
+            self._discard(con)
+
+
+_connection_managers = {}
+_engines = {}
+_managers_lock = threading.Lock()
+
+
+def get_connection_manager(connection_string, role):
+    """
+    Return the connection manager of this process for the database and role, creating it on first use.
+    Managers are kept per process, so that worker processes never reuse connections opened by their parent.
+
+    Parameters
+    ----------
+    connection_string : 'str'
+        Connection string
+    role : 'str'
+        Database role
+
+    Returns
+    -------
+    'ConnectionManager'
+    """
+    key = (os.getpid(), connection_string, role)
+    with _managers_lock:
+        if key not in _connection_managers:
+            _connection_managers[key] = ConnectionManager(connection_string, role)
+
+        return _connection_managers[key]
+
+
 def make_con(connection_string, role, async_=False):
 
     '''
     Returns the psql connection and cursor objects to be used with functions that query from the database.
+    Connections are checked out of the pool of the process (get_connection_manager), so return them 
+    with release_con() rather than closing them. Asynchronous connections are not pooled.
         
     Parameters
     ----------    
@@ -141,23 +397,73 @@ def make_con(connection_string, role, async_=False):
         Postgres Database Cursor.
     '''
 
+    if not async_:
+        return get_connection_manager(connection_string, role).getconn()
+
     con = pg.connect(connection_string, async_=async_)
-    if async_:
-        wait(con)
+    wait(con)
     # create cursor object
     cur = con.cursor(cursor_factory=pgx.RealDictCursor)
     # set role (this should avoid permissions issues)
     cur.execute('SET ROLE "{}";'.format(role))
-    if async_:
-        wait(con)
-    else:
-        con.commit()
+    wait(con)
 
     return con, cur
 
+
+def release_con(con):
+    '''
+    Returns a connection from make_con() to its pool, rolling back its open transaction. 
+    Connections that were not checked out of a pool are closed.
+
+    Parameters
+    ----------    
+    con : 'SQL connection'
+        Postgres Database Connection.
+    '''
+
+    pid = os.getpid()
+    with _managers_lock:
+        managers = [m for k, m in _connection_managers.items() if k[0] == pid]
+    for manager in managers:
+        if manager.owns(con):
+            manager.putconn(con)
+            return
+    if not any(manager.is_idle(con) for manager in managers):
+        con.close()
+
+
 def make_engine(pg_engine_con):
+    '''
+    Returns the SQLAlchemy engine of this process for the connection string, creating it on first use.
+    The engine keeps a bounded pool of connections that are checked (pre-ping) before use.
+    '''
+
+    key = (os.getpid(), pg_engine_con)
+    with _managers_lock:
+        if key not in _engines:
+            _engines[key] = create_engine(pg_engine_con, pool_size=config.DB_ENGINE_POOL_SIZE,
+                                          max_overflow=config.DB_ENGINE_MAX_OVERFLOW,
+                                          pool_timeout=config.DB_POOL_TIMEOUT,
+                                          pool_pre_ping=config.DB_POOL_PRE_PING)
+
+        return _engines[key]
 
-    return create_engine(pg_engine_con, poolclass=NullPool)
+
+def close_connections():
+    '''
+    Closes the idle connections of every connection manager and engine pool of this process.
+    Managers and engines stay usable and open new connections as needed.
+    '''
+
+    pid = os.getpid()
+    with _managers_lock:
+        managers = [m for k, m in _connection_managers.items() if k[0] == pid]
+        engines = [e for k, e in _engines.items() if k[0] == pid]
+    for manager in managers:
+        manager.close()
+    for engine in engines:
+        engine.dispose()
 
 
 def get_pg_params(json_file):
@@ -252,3 +558,30 @@ def get_formatted_time():
     formatted_time = time.strftime('%Y%m%d_%H%M%S')
 
     return formatted_time
+
+
+def fingerprint_rows(df, cols):
+    """
+    Hash the values of cols in each row of df. Rows with equal values in cols have equal fingerprints.
+    
+    Parameters
+    ----------
+    df : 'pd.df'
+        Dataframe to fingerprint
+    cols : 'list'
+        Columns to hash. Columns not in df are ignored
+    
+    Returns
+    -------
+    fingerprints : 'pd.Series'
+        uint64 fingerprint of each row, indexed as df
+    """
+    cols = [col for col in cols if col in df.columns]
+    df = df[cols].copy()
+
+    # sequences, e.g. depreciation schedules, are hashed by value
+    for col in cols:
+        if df[col].dtype == object:
+            df[col] = df[col].map(lambda x: tuple(x) if isinstance(x, (list, np.ndarray)) else x)
+
+    return pd.util.hash_pandas_object(df, index=False)